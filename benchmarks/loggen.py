@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""Generate synthetic log lines for benchmarks.
+
+Lines are generated from a seeded random generator, so that the same options
+always produce the same content.  A fraction of lines (the match ratio)
+matches the rules in ``RULES``, while the rest only share their prefix.
+
+"""
+
+import argparse
+import random
+import sys
+import time
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    IO,
+    Iterator,
+)
+
+# Rules matching generated lines, in Lua format
+RULES = r"""
+rules.request = Rule([[request (?P<method>[A-Z]+) (?P<status>\d+) (?P<time>[\d.]+)]])
+function rules.request.action(match)
+  metrics.requests.labels(match.method).inc()
+  metrics.request_time.observe(match.time)
+end
+"""
+
+# Metrics used by rules
+METRICS: Dict[str, Dict[str, Any]] = {
+    "requests": {
+        "type": "counter",
+        "description": "Requests",
+        "labels": ["method"],
+    },
+    "request_time": {"type": "summary", "description": "Request time"},
+}
+
+_METHODS = ("GET", "POST", "PUT", "DELETE")
+_WORDS = ("alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta")
+
+
+def _short_line(rand: random.Random, match: bool) -> str:
+    status = rand.choice((200, 201, 404, 500))
+    method = rand.choice(_METHODS)
+    if not match:
+        method = method.lower()
+    return f"request {method} {status} {rand.random() * 10:.3f}"
+
+
+def _long_line(rand: random.Random, match: bool) -> str:
+    words = " ".join(rand.choice(_WORDS) for _ in range(30))
+    return f"{_short_line(rand, match)} {words}"
+
+
+def _kv_line(rand: random.Random, match: bool) -> str:
+    fields = " ".join(f"{word}={rand.randint(0, 1000)}" for word in _WORDS)
+    return f"{_short_line(rand, match)} {fields}"
+
+
+# Line shapes, mapped to functions generating a line
+SHAPES: Dict[str, Callable[[random.Random, bool], str]] = {
+    "short": _short_line,
+    "long": _long_line,
+    "kv": _kv_line,
+}
+
+
+def generate_lines(
+    count: int, shape: str = "short", match_ratio: float = 0.5, seed: int = 0
+) -> Iterator[str]:
+    """Generate ``count`` log lines of the given shape."""
+    rand = random.Random(seed)
+    make_line = SHAPES[shape]
+    for _ in range(count):
+        yield make_line(rand, rand.random() < match_ratio)
+
+
+def write_lines(
+    fd: IO, count: int, shape: str, match_ratio: float, seed: int, rate: float = 0
+):
+    """Write lines to a file, at ``rate`` lines per second if not zero."""
+    start = time.monotonic()
+    for index, line in enumerate(generate_lines(count, shape, match_ratio, seed)):
+        fd.write(line + "\n")
+        if rate:
+            delay = start + (index + 1) / rate - time.monotonic()
+            if delay > 0:
+                fd.flush()
+                time.sleep(delay)
+    fd.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=100000, help="number of lines")
+    parser.add_argument(
+        "--shape", choices=sorted(SHAPES), default="short", help="shape of lines"
+    )
+    parser.add_argument(
+        "--match-ratio",
+        type=float,
+        default=0.5,
+        help="fraction of lines matching rules",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        help="lines per second to write (0 to write as fast as possible)",
+    )
+    parser.add_argument(
+        "--output",
+        type=argparse.FileType("a"),
+        default=sys.stdout,
+        help="file to append lines to",
+    )
+    args = parser.parse_args()
+    write_lines(
+        args.output, args.count, args.shape, args.match_ratio, args.seed, args.rate
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""Run benchmarks for log lines parsing and file watching.
+
+Results are printed as JSON, so that they can be compared across releases.
+For each benchmark, the best time of all repetitions is reported.
+
+"""
+
+import argparse
+import asyncio
+import json
+import os
+from pathlib import Path
+import platform
+import sys
+import tempfile
+import time
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+)
+
+from loggen import (
+    generate_lines,
+    METRICS,
+    RULES,
+    SHAPES,
+    write_lines,
+)
+from prometheus_aioexporter import MetricConfig
+from prometheus_aioexporter.metric import MetricsRegistry
+
+from lmetrics import __version__
+from lmetrics.config import (
+    DEFAULT_LUA_RUNTIME,
+    LUA_RUNTIMES,
+)
+from lmetrics.rule import (
+    FileAnalyzer,
+    RuleRegistry,
+)
+from lmetrics.watch import (
+    DEFAULT_CHUNK_SIZE,
+    FileWatcher,
+)
+
+# Directory for files written by benchmarks, in memory if possible
+TMPFS_DIR = "/dev/shm"
+
+
+def create_analyzer(
+    tmpdir: Path,
+    log_file: Path,
+    lua_runtime: str = DEFAULT_LUA_RUNTIME,
+    buffer_metrics: bool = False,
+) -> FileAnalyzer:
+    """Return a FileAnalyzer with benchmark rules, for the log file."""
+    rules_file = tmpdir / "rules.lua"
+    rules_file.write_text(RULES)
+    configs = [
+        MetricConfig(name, config["description"], config["type"], config)
+        for name, config in METRICS.items()
+    ]
+    metrics = MetricsRegistry().create_metrics(configs)
+    return RuleRegistry(metrics, buffer_updates=buffer_metrics).get_file_analyzer(
+        str(log_file), str(rules_file), lua_runtime=lua_runtime
+    )
+
+
+def timed(func: Callable[[], Any], repeat: int) -> float:
+    """Return the best time in seconds for calling a function."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def result(name: str, count: int, seconds: float) -> Dict[str, Any]:
+    """Return a benchmark result."""
+    return {
+        "name": name,
+        "count": count,
+        "seconds": seconds,
+        "per_second": count / seconds if seconds else None,
+    }
+
+
+def bench_rule(analyzer: FileAnalyzer, lines: List[str], repeat: int) -> List[Dict]:
+    """Microbenchmarks for a rule."""
+    [rule] = analyzer.rules
+    matches = (rule.regexp.search(line) for line in lines)
+    values = [match.groupdict() for match in matches if match]
+    converted = [rule._convert_values(match) for match in values]
+
+    def analyze_line():
+        for line in lines:
+            rule.analyze_line(line)
+
+    def convert_values():
+        for match in values:
+            rule._convert_values(match)
+
+    def lua_action():
+        for match in converted:
+            rule.action(match)
+
+    def analyze_lines():
+        analyzer.analyze_lines(lines)
+
+    return [
+        result("rule.analyze_line", len(lines), timed(analyze_line, repeat)),
+        result("rule.convert_values", len(values), timed(convert_values, repeat)),
+        result("rule.lua_action", len(converted), timed(lua_action, repeat)),
+        result("analyzer.analyze_lines", len(lines), timed(analyze_lines, repeat)),
+    ]
+
+
+def bench_watch(
+    analyzer: FileAnalyzer, log_file: Path, args: argparse.Namespace
+) -> Dict:
+    """End-to-end benchmark of reading and analyzing a file."""
+    with log_file.open("w") as fd:
+        write_lines(fd, args.count, args.shape, args.match_ratio, args.seed)
+
+    def run():
+        loop = asyncio.new_event_loop()
+        done = loop.create_future()
+        read = 0
+
+        def callback(lines: List[str]):
+            nonlocal read
+            analyzer.analyze_lines(lines)
+            read += len(lines)
+            if read == args.count:
+                done.set_result(None)
+
+        watcher = FileWatcher(
+            log_file, callback, chunk_size=args.read_chunk_size, loop=loop
+        )
+        watcher.watch()
+        loop.run_until_complete(done)
+        loop.run_until_complete(watcher.stop())
+        loop.close()
+
+    return result("watcher.read_file", args.count, timed(run, args.repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=100000, help="number of lines")
+    parser.add_argument(
+        "--shape", choices=sorted(SHAPES), default="short", help="shape of lines"
+    )
+    parser.add_argument(
+        "--match-ratio",
+        type=float,
+        default=0.5,
+        help="fraction of lines matching rules",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="times each benchmark is run"
+    )
+    parser.add_argument(
+        "--read-chunk-size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help="size of chunks read from the log file",
+    )
+    parser.add_argument(
+        "--lua-runtime",
+        choices=sorted(LUA_RUNTIMES),
+        default=DEFAULT_LUA_RUNTIME,
+        help="Lua runtime for rules",
+    )
+    parser.add_argument(
+        "--buffer-metrics",
+        action="store_true",
+        help="buffer metric updates from rules",
+    )
+    parser.add_argument(
+        "--output",
+        type=argparse.FileType("w"),
+        default=sys.stdout,
+        help="file to write results to",
+    )
+    args = parser.parse_args()
+
+    tmp_base = TMPFS_DIR if os.path.isdir(TMPFS_DIR) else None
+    with tempfile.TemporaryDirectory(dir=tmp_base) as tmp:
+        tmpdir = Path(tmp)
+        log_file = tmpdir / "bench.log"
+        analyzer = create_analyzer(
+            tmpdir, log_file, args.lua_runtime, args.buffer_metrics
+        )
+        lines = list(
+            generate_lines(args.count, args.shape, args.match_ratio, args.seed)
+        )
+        results = bench_rule(analyzer, lines, args.repeat)
+        results.append(bench_watch(analyzer, log_file, args))
+
+    report = {
+        "version": str(__version__),
+        "python": platform.python_version(),
+        "options": {
+            "count": args.count,
+            "shape": args.shape,
+            "match_ratio": args.match_ratio,
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "read_chunk_size": args.read_chunk_size,
+            "lua_runtime": args.lua_runtime,
+            "buffer_metrics": args.buffer_metrics,
+        },
+        "results": results,
+    }
+    json.dump(report, args.output, indent=2)
+    args.output.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""Analysis of existing content of large log files in worker processes."""
+
+import asyncio
+import mmap
+import multiprocessing
+from multiprocessing.connection import Connection
+import os
+from pathlib import Path
+import signal
+from typing import (
+    Any,
+    Callable,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+from prometheus_client import CollectorRegistry
+from toolrack.log import Loggable
+
+from .rule import FileAnalyzer
+from .workers import MergedCollector
+
+# Default number of processes analyzing ranges of a file
+DEFAULT_PROCESSES = 2
+
+# Default minimum size of content to read from a file for it to be backfilled
+DEFAULT_MIN_SIZE = 64 * 1024 * 1024
+
+# Default maximum size of data analyzed at once by processes
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+class BackfillResult(NamedTuple):
+    """Result of backfilling a file."""
+
+    # offset after the last line analyzed
+    end: int
+    lines: int
+    long_lines: int = 0
+
+
+class Backfill(Loggable):
+    """Analyze existing content of a file in parallel worker processes.
+
+    Content from the current read position to the end of the last full line
+    is memory-mapped and split in up to ``processes`` ranges of full lines.
+    Each range is analyzed in a forked process, with an analyzer returned by
+    ``create_analyzer``, along with the registry for the metrics it updates.
+    Once all processes are done, metrics from each range are passed to the
+    :class:`MergedCollector`, ordered by offset.
+
+    Only files with at least ``min_size`` bytes to read are backfilled.
+
+    """
+
+    def __init__(
+        self,
+        create_analyzer: Callable[[], Tuple[FileAnalyzer, CollectorRegistry]],
+        collector: MergedCollector,
+        processes: int = DEFAULT_PROCESSES,
+        min_size: int = DEFAULT_MIN_SIZE,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        loop: Optional[asyncio.AbstractEventLoop] = None,
+    ):
+        self.loop = loop or asyncio.get_event_loop()
+        self._create_analyzer = create_analyzer
+        self._collector = collector
+        self._processes = processes
+        self._min_size = min_size
+        self._chunk_size = chunk_size
+
+    async def run(
+        self, path: Path, start: int, new_stream: Callable[[], Any]
+    ) -> Optional[BackfillResult]:
+        """Analyze content of a file from an offset, if it's large enough.
+
+        ``new_stream`` returns a stream splitting data in lines, as
+        :class:`LineStream`.
+
+        None is returned if the file isn't backfilled, either because it's
+        too small or because analysis of a range failed, in which case no
+        metric is updated.
+
+        """
+        ranges = self._line_ranges(path, start)
+        if not ranges:
+            return None
+        end = ranges[-1][1]
+        self.logger.info(
+            f"backfilling {end - start} bytes in {len(ranges)} process(es): {path}"
+        )
+        results = await asyncio.gather(
+            *(
+                self._run_range(path, range_start, range_end, new_stream)
+                for range_start, range_end in ranges
+            )
+        )
+        completed = [result for result in results if result is not None]
+        if len(completed) < len(ranges):
+            self.logger.error(f"backfill failed, reading content instead: {path}")
+            return None
+
+        lines = long_lines = 0
+        for (range_start, _), (range_lines, range_long_lines, families) in zip(
+            ranges, completed
+        ):
+            self._collector.update((path, range_start), families)
+            lines += range_lines
+            long_lines += range_long_lines
+        return BackfillResult(end, lines, long_lines)
+
+    def _line_ranges(self, path: Path, start: int) -> List[Tuple[int, int]]:
+        """Return ranges of full lines to analyze, empty if too small."""
+        with path.open("rb") as fd:
+            size = os.fstat(fd.fileno()).st_size
+            if size - start < max(self._min_size, 1):
+                return []
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                end = data.rfind(b"\n", start) + 1
+                if end - start < self._min_size:
+                    return []
+                return line_ranges(data, start, end, self._processes)
+
+    async def _run_range(
+        self, path: Path, start: int, end: int, new_stream: Callable[[], Any]
+    ) -> Optional[Tuple[int, int, List[Any]]]:
+        """Analyze a range in a forked process, returning its result."""
+        conn, child_conn = multiprocessing.Pipe(duplex=False)
+        context = multiprocessing.get_context("fork")
+        process = context.Process(
+            target=self.analyze_range,
+            args=(path, start, end, new_stream, child_conn),
+            name="lmetrics-backfill",
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        try:
+            return await self.loop.run_in_executor(None, _receive, conn)
+        finally:
+            conn.close()
+            await self.loop.run_in_executor(None, process.join)
+
+    def analyze_range(
+        self,
+        path: Path,
+        start: int,
+        end: int,
+        new_stream: Callable[[], Any],
+        conn: Connection,
+    ):
+        """Analyze lines in a range of a file, sending the result.
+
+        This is run in a worker process.  The number of lines and long lines
+        analyzed is sent through the connection, along with metrics.
+
+        """
+        # the parent process handles interruption
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        analyzer, registry = self._create_analyzer()
+        stream = new_stream()
+        lines = 0
+        with path.open("rb") as fd:
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for offset in range(start, end, self._chunk_size):
+                    chunk = data[offset : min(offset + self._chunk_size, end)]
+                    batch = stream.feed(chunk)
+                    lines += len(batch)
+                    analyzer.analyze_lines(batch)
+        conn.send((lines, stream.pop_long_lines(), list(registry.collect())))
+        conn.close()
+
+
+def line_ranges(data: Any, start: int, end: int, count: int) -> List[Tuple[int, int]]:
+    """Split data between offsets in up to count ranges ending after newlines.
+
+    The ``end`` offset must follow a newline.
+
+    """
+    size = max((end - start) // count, 1)
+    ranges = []
+    offset = start
+    while offset < end:
+        split = data.find(b"\n", min(offset + size, end) - 1, end) + 1
+        ranges.append((offset, split))
+        offset = split
+    return ranges
+
+
+def _receive(conn: Connection) -> Optional[Any]:
+    """Return the message from a connection, None if it's closed."""
+    try:
+        return conn.recv()
+    except EOFError:
+        return None
@@ -0,0 +1,170 @@
+"""Buffering of metric updates, applied in batches."""
+
+from bisect import bisect_left
+from collections import defaultdict
+import threading
+from typing import (
+    Any,
+    DefaultDict,
+    Dict,
+    List,
+    Tuple,
+)
+
+from prometheus_client import Metric
+
+# Metric and label values for a series
+SeriesKey = Tuple[Any, Tuple[str, ...]]
+
+# Maximum number of series proxies reused for each metric
+MAX_CACHED_SERIES = 1000
+
+
+class _Updates(threading.local):
+    """Updates buffered by a thread."""
+
+    def __init__(self):
+        self.increments: DefaultDict[SeriesKey, float] = defaultdict(float)
+        self.observations: DefaultDict[SeriesKey, List[float]] = defaultdict(list)
+
+
+class MetricsBuffer:
+    """Buffer counter increments and observations for metrics.
+
+    Increments for each series are summed, and observations grouped, until
+    :meth:`flush` applies them to metrics.  Updates are buffered separately
+    for each thread, and flushed by the thread that made them.
+
+    """
+
+    def __init__(self):
+        self.updates = _Updates()
+
+    def flush(self):
+        """Apply updates buffered by the current thread."""
+        updates = self.updates
+        increments, updates.increments = updates.increments, defaultdict(float)
+        observations, updates.observations = updates.observations, defaultdict(list)
+        for (metric, labelvalues), amount in increments.items():
+            _series(metric, labelvalues).inc(amount)
+        for (metric, labelvalues), amounts in observations.items():
+            series = _series(metric, labelvalues)
+            if metric._type == "histogram":
+                _observe_histogram(series, amounts)
+            else:
+                series._count.inc(len(amounts))
+                series._sum.inc(sum(amounts))
+
+
+class BufferedMetric:
+    """Base proxy to a metric, buffering updates in a MetricsBuffer.
+
+    Proxies for series are reused, since actions usually update few series.
+
+    Other attributes are proxied to the metric.
+
+    """
+
+    def __init__(
+        self,
+        metric: Any,
+        buffer: MetricsBuffer,
+        labelvalues: Tuple[str, ...] = (),
+    ):
+        self._metric = metric
+        self._updates = buffer.updates
+        self._buffer = buffer
+        self._labelvalues = labelvalues
+        self._key = (metric, labelvalues)
+        labelnames: Tuple[str, ...] = metric._labelnames
+        self._labelnames = labelnames
+        # updates are only valid for a series
+        self._is_series = not labelnames or bool(labelvalues)
+        self._series: Dict[Tuple[Any, ...], BufferedMetric] = {}
+
+    def labels(self, *labelvalues: Any, **labelkwargs: Any) -> Any:
+        """Return a proxy for the series with labels."""
+        if not labelkwargs:
+            series = self._series.get(labelvalues)
+            if series is not None:
+                return series
+
+        # invalid labels are reported by the metric
+        if self._labelvalues:
+            metric = _series(self._metric, self._labelvalues)
+            return metric.labels(*labelvalues, **labelkwargs)
+        if labelkwargs:
+            if labelvalues or set(labelkwargs) != set(self._labelnames):
+                return self._metric.labels(*labelvalues, **labelkwargs)
+            labelvalues = tuple(labelkwargs[name] for name in self._labelnames)
+        elif not self._labelnames or len(labelvalues) != len(self._labelnames):
+            return self._metric.labels(*labelvalues)
+
+        values = tuple(str(value) for value in labelvalues)
+        series = self.__class__(self._metric, self._buffer, values)
+        if len(self._series) >= MAX_CACHED_SERIES:
+            self._series.clear()
+        self._series[labelvalues] = series
+        return series
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._metric, name)
+
+
+class BufferedCounter(BufferedMetric):
+    """Proxy to a counter, buffering increments."""
+
+    def inc(self, amount: float = 1):
+        """Buffer an increment of the counter."""
+        if not self._is_series:
+            # report the error from the metric
+            return self._metric.inc(amount)
+        if amount < 0:
+            raise ValueError(
+                "Counters can only be incremented by non-negative amounts."
+            )
+        self._updates.increments[self._key] += amount
+
+
+class BufferedObserver(BufferedMetric):
+    """Proxy to a summary or histogram, buffering observations."""
+
+    def observe(self, amount: float):
+        """Buffer an observation for the metric."""
+        if not self._is_series:
+            # report the error from the metric
+            return self._metric.observe(amount)
+        self._updates.observations[self._key].append(float(amount))
+
+
+def buffer_metrics(metrics: Dict[str, Metric], buffer: MetricsBuffer) -> Dict[str, Any]:
+    """Return metrics, wrapping those whose updates can be buffered."""
+    wrapped: Dict[str, Any] = {}
+    for name, metric in metrics.items():
+        metric_type = getattr(metric, "_type", None)
+        if metric_type == "counter":
+            wrapped[name] = BufferedCounter(metric, buffer)
+        elif metric_type in ("summary", "histogram"):
+            wrapped[name] = BufferedObserver(metric, buffer)
+        else:
+            wrapped[name] = metric
+    return wrapped
+
+
+def _series(metric: Any, labelvalues: Tuple[str, ...]) -> Any:
+    """Return the series of a metric for label values."""
+    return metric.labels(*labelvalues) if labelvalues else metric
+
+
+def _observe_histogram(series: Any, amounts: List[float]):
+    """Add observations to a histogram series, at once for each bucket."""
+    bounds = series._upper_bounds
+    counts: DefaultDict[int, int] = defaultdict(int)
+    for amount in amounts:
+        # the first bucket with a bound not lower than the amount
+        index = bisect_left(bounds, amount)
+        if index < len(bounds) and amount <= bounds[index]:
+            counts[index] += 1
+    series._sum.inc(sum(amounts))
+    for index, count in counts.items():
+        series._buckets[index].inc(count)
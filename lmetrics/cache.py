@@ -0,0 +1,125 @@
+"""Cached exposition of metrics."""
+
+import gzip
+import time
+from typing import (
+    Awaitable,
+    Callable,
+    Optional,
+)
+
+from aiohttp.web import (
+    middleware,
+    Request,
+    Response,
+)
+from prometheus_client import CONTENT_TYPE_LATEST
+
+# Compression level for gzipped output, trading some size for speed
+GZIP_LEVEL = 6
+
+# Default maximum age in seconds of cached output, when metrics are not marked
+# as changed
+DEFAULT_MAX_AGE = 60.0
+
+
+class MetricsCache:
+    """Cache the rendered exposition of metrics.
+
+    Metrics are rendered by calling ``render``.  The output is reused for
+    ``min_age`` seconds, after which it's rendered again only if metrics have
+    been marked as changed with :meth:`invalidate`, or if it's older than
+    ``max_age`` seconds, to include values that are not tracked (e.g. process
+    stats).  If ``min_age`` is zero, output is rendered every time.
+
+    Output compressed with gzip is cached as well.
+
+    """
+
+    _output: Optional[bytes] = None
+    _compressed: Optional[bytes] = None
+
+    def __init__(
+        self,
+        render: Callable[[], bytes],
+        min_age: float = 0.0,
+        max_age: float = DEFAULT_MAX_AGE,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self._render = render
+        self._min_age = min_age
+        self._max_age = max_age
+        self._clock = clock
+        self._rendered_at = 0.0
+        self._changed = True
+
+    def invalidate(self):
+        """Mark metrics as changed."""
+        self._changed = True
+
+    def get(self, compressed: bool = False) -> bytes:
+        """Return the output for metrics, gzipped if ``compressed`` is True."""
+        if self._expired():
+            # reset before rendering, so that changes meanwhile are not lost
+            self._changed = False
+            self._rendered_at = self._clock()
+            self._output = self._render()
+            self._compressed = None
+        output: bytes = self._output  # type: ignore
+        if not compressed:
+            return output
+        if self._compressed is None:
+            self._compressed = gzip.compress(output, compresslevel=GZIP_LEVEL)
+        return self._compressed
+
+    def _expired(self) -> bool:
+        if self._output is None or self._min_age <= 0:
+            return True
+        age = self._clock() - self._rendered_at
+        if age < self._min_age:
+            return False
+        return self._changed or age >= self._max_age
+
+
+def cached_metrics_middleware(
+    cache: MetricsCache, path: str = "/metrics"
+) -> Callable[[Request, Callable[[Request], Awaitable]], Awaitable]:
+    """Return an aiohttp middleware serving metrics from a cache.
+
+    Output is gzipped for clients accepting it.
+
+    """
+
+    @middleware
+    async def serve_metrics(
+        request: Request, handler: Callable[[Request], Awaitable]
+    ) -> Response:
+        if request.method != "GET" or request.path != path:
+            response: Response = await handler(request)
+            return response
+        compressed = accepts_gzip(request.headers.get("Accept-Encoding", ""))
+        response = Response(body=cache.get(compressed=compressed))
+        response.content_type = CONTENT_TYPE_LATEST
+        response.headers["Vary"] = "Accept-Encoding"
+        if compressed:
+            response.headers["Content-Encoding"] = "gzip"
+        return response
+
+    return serve_metrics
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """Return whether an Accept-Encoding header value allows gzip."""
+    for entry in accept_encoding.split(","):
+        coding, *params = (part.strip() for part in entry.split(";"))
+        if coding.lower() not in ("gzip", "*"):
+            continue
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
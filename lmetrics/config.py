@@ -1,29 +1,137 @@
 """Confiuration file handling."""
 
+import codecs
+import re
 from typing import (
+    Any,
     Dict,
     IO,
     List,
     NamedTuple,
+    Optional,
 )
 
 from prometheus_aioexporter import MetricConfig
 import yaml
 
+# Lua runtime used for rules by default, the one lupa is built with
+DEFAULT_LUA_RUNTIME = "default"
+
+# Lua runtimes for rules.  Besides the default one, these are provided by
+# lupa modules, with "luajit" using the most recent LuaJIT available
+LUA_RUNTIMES = frozenset(
+    [
+        DEFAULT_LUA_RUNTIME,
+        "luajit",
+        "luajit20",
+        "luajit21",
+        "lua51",
+        "lua52",
+        "lua53",
+        "lua54",
+    ]
+)
+
+
+# Defaults for limits and timeout of multiline records
+DEFAULT_MULTILINE_MAX_LINES = 500
+DEFAULT_MULTILINE_MAX_LENGTH = 65536
+DEFAULT_MULTILINE_TIMEOUT = 1.0
+
+
+class InvalidFileConfig(Exception):
+    """Raised when the configuration for a file is invalid."""
+
+    def __init__(self, path: str, message: str):
+        self.path = path
+        super().__init__(f"Invalid configuration for {path}: {message}")
+
+
+class InvalidMetricConfig(Exception):
+    """Raised when the configuration for a metric is invalid."""
+
+    def __init__(self, name: str, message: str):
+        self.name = name
+        super().__init__(f"Invalid configuration for metric {name}: {message}")
+
+
+class SeriesLimit(NamedTuple):
+    """Limits on the number of series for a metric with labels."""
+
+    # maximum number of series
+    max_series: Optional[int] = None
+    # seconds after which series not updated are removed
+    ttl: Optional[float] = None
+    # whether new series over the maximum are merged in a single overflow
+    # series, instead of evicting the least recently updated one
+    overflow: bool = False
+
+
+class MultilineConfig(NamedTuple):
+    """Configuration for assembling records spanning multiple lines."""
+
+    # regexp matching lines that start a record
+    start: str
+    # maximum number of lines in a record
+    max_lines: int = DEFAULT_MULTILINE_MAX_LINES
+    # maximum length of a record
+    max_length: int = DEFAULT_MULTILINE_MAX_LENGTH
+    # seconds after which a record is complete if no more lines are read
+    timeout: float = DEFAULT_MULTILINE_TIMEOUT
+
+
+class LookbackConfig(NamedTuple):
+    """Configuration for reading only recent lines at startup."""
+
+    # regexp matching the timestamp of lines, in the first group if any
+    timestamp: str
+    # seconds before the current time from which lines are read
+    window: float
+    # strptime format of timestamps, ISO 8601 if not set
+    format: Optional[str] = None
+
+
+class FileConfig(NamedTuple):
+    """Configuration for a log file."""
+
+    rules: str
+    # whether lines are matched as bytes, decoding only matched values
+    binary: bool = False
+    encoding: str = "utf-8"
+    # error handling scheme for decoding content
+    encoding_errors: str = "strict"
+    # Lua runtime for rules
+    lua_runtime: str = DEFAULT_LUA_RUNTIME
+    # maximum length of lines, 0 for no limit
+    max_line_length: int = 0
+    # what to do with longer lines, "truncate" or "drop"
+    long_lines: str = "truncate"
+    # assembly of multiline records, if enabled
+    multiline: Optional[MultilineConfig] = None
+    # reading of recent lines only at startup, if enabled
+    lookback: Optional[LookbackConfig] = None
+
 
 class Config(NamedTuple):
     """Top-level configuration."""
 
     metrics: List[MetricConfig]
-    files: Dict[str, Dict]
+    files: Dict[str, FileConfig]
+    # limits for metrics that have them
+    limits: Dict[str, SeriesLimit] = {}
 
 
 def load_config(config_fd: IO) -> Config:
     """Load YAML config from file."""
     config = yaml.load(config_fd)
-    metrics = _get_metrics(config.get("metrics", {}))
-    files = config.get("files", {})
-    return Config(metrics, files)
+    metrics_config = config.get("metrics", {})
+    limits = _get_limits(metrics_config)
+    metrics = _get_metrics(metrics_config)
+    lua_runtime = config.get("lua_runtime", DEFAULT_LUA_RUNTIME)
+    if lua_runtime not in LUA_RUNTIMES:
+        raise InvalidFileConfig("files", f"unknown Lua runtime: {lua_runtime}")
+    files = _get_files(config.get("files", {}), lua_runtime=lua_runtime)
+    return Config(metrics, files, limits)
 
 
 def _get_metrics(metrics: Dict[str, Dict]) -> List[MetricConfig]:
@@ -35,3 +143,141 @@ def _get_metrics(metrics: Dict[str, Dict]) -> List[MetricConfig]:
         configs.append(MetricConfig(name, description, metric_type, config))
 
     return configs
+
+
+def _get_limits(metrics: Dict[str, Dict]) -> Dict[str, SeriesLimit]:
+    """Return limits for series of metrics, removing them from the config.
+
+    Limits are set with the ``max_series``, ``series_ttl`` and ``on_limit``
+    options.
+
+    """
+    limits = {}
+    for name, config in metrics.items():
+        max_series = config.pop("max_series", None)
+        ttl = config.pop("series_ttl", None)
+        on_limit = config.pop("on_limit", "evict")
+        if max_series is None and ttl is None:
+            continue
+        if not config.get("labels"):
+            raise InvalidMetricConfig(name, "series limits require labels")
+        if max_series is not None and not _is_positive(max_series, int):
+            raise InvalidMetricConfig(name, "max_series must be a positive integer")
+        if ttl is not None and not _is_positive(ttl, (int, float)):
+            raise InvalidMetricConfig(name, "series_ttl must be a positive number")
+        if on_limit not in ("evict", "overflow"):
+            raise InvalidMetricConfig(name, 'on_limit must be "evict" or "overflow"')
+        limits[name] = SeriesLimit(
+            max_series=max_series, ttl=ttl, overflow=on_limit == "overflow"
+        )
+    return limits
+
+
+def _is_positive(value: Any, types: Any) -> bool:
+    """Return whether a value is a positive number of the given types."""
+    return isinstance(value, types) and not isinstance(value, bool) and value > 0
+
+
+def _get_files(
+    files: Dict[str, Any], lua_runtime: str = DEFAULT_LUA_RUNTIME
+) -> Dict[str, FileConfig]:
+    """Return files configuration.
+
+    Files can be mapped either to the rules file name, or to a dict with
+    options.  The ``lua_runtime`` is used for files not specifying one.
+
+    """
+    return {
+        path: _get_file_config(path, config, lua_runtime=lua_runtime)
+        for path, config in files.items()
+    }
+
+
+def _get_file_config(
+    path: str, config: Any, lua_runtime: str = DEFAULT_LUA_RUNTIME
+) -> FileConfig:
+    """Return configuration for a file."""
+    if isinstance(config, str):
+        return FileConfig(config, lua_runtime=lua_runtime)
+    if not isinstance(config, dict):
+        raise InvalidFileConfig(path, "must be a rules file or a mapping")
+
+    unknown = set(config) - set(FileConfig._fields)
+    if unknown:
+        raise InvalidFileConfig(path, f"unknown options: {', '.join(sorted(unknown))}")
+    if "rules" not in config:
+        raise InvalidFileConfig(path, "missing rules")
+    if "multiline" in config:
+        config = {**config, "multiline": _get_multiline(path, config["multiline"])}
+    if "lookback" in config:
+        config = {**config, "lookback": _get_lookback(path, config["lookback"])}
+    file_config = FileConfig(**{"lua_runtime": lua_runtime, **config})
+    if file_config.lua_runtime not in LUA_RUNTIMES:
+        raise InvalidFileConfig(path, f"unknown Lua runtime: {file_config.lua_runtime}")
+    max_line_length = file_config.max_line_length
+    if max_line_length != 0 and not _is_positive(max_line_length, int):
+        raise InvalidFileConfig(path, "max_line_length must be a non-negative integer")
+    if file_config.long_lines not in ("truncate", "drop"):
+        raise InvalidFileConfig(path, 'long_lines must be "truncate" or "drop"')
+    try:
+        codecs.lookup(file_config.encoding)
+    except LookupError:
+        raise InvalidFileConfig(path, f"unknown encoding: {file_config.encoding}")
+    try:
+        codecs.lookup_error(file_config.encoding_errors)
+    except LookupError:
+        raise InvalidFileConfig(
+            path, f"unknown encoding errors: {file_config.encoding_errors}"
+        )
+    return file_config
+
+
+def _get_multiline(path: str, config: Any) -> MultilineConfig:
+    """Return configuration for multiline records of a file."""
+    if not isinstance(config, dict):
+        raise InvalidFileConfig(path, "multiline must be a mapping")
+    unknown = set(config) - set(MultilineConfig._fields)
+    if unknown:
+        raise InvalidFileConfig(
+            path, f"unknown multiline options: {', '.join(sorted(unknown))}"
+        )
+    if "start" not in config:
+        raise InvalidFileConfig(path, "missing multiline start")
+    multiline = MultilineConfig(**config)
+    try:
+        re.compile(multiline.start)
+    except (TypeError, re.error) as error:
+        raise InvalidFileConfig(path, f"invalid multiline start: {error}")
+    if not _is_positive(multiline.max_lines, int):
+        raise InvalidFileConfig(path, "multiline max_lines must be a positive integer")
+    if not _is_positive(multiline.max_length, int):
+        raise InvalidFileConfig(path, "multiline max_length must be a positive integer")
+    if not _is_positive(multiline.timeout, (int, float)):
+        raise InvalidFileConfig(path, "multiline timeout must be a positive number")
+    return multiline
+
+
+def _get_lookback(path: str, config: Any) -> LookbackConfig:
+    """Return configuration for reading recent lines of a file at startup."""
+    if not isinstance(config, dict):
+        raise InvalidFileConfig(path, "lookback must be a mapping")
+    unknown = set(config) - set(LookbackConfig._fields)
+    if unknown:
+        raise InvalidFileConfig(
+            path, f"unknown lookback options: {', '.join(sorted(unknown))}"
+        )
+    missing = {"timestamp", "window"} - set(config)
+    if missing:
+        raise InvalidFileConfig(
+            path, f"missing lookback options: {', '.join(sorted(missing))}"
+        )
+    lookback = LookbackConfig(**config)
+    try:
+        re.compile(lookback.timestamp)
+    except (TypeError, re.error) as error:
+        raise InvalidFileConfig(path, f"invalid lookback timestamp: {error}")
+    if not _is_positive(lookback.window, (int, float)):
+        raise InvalidFileConfig(path, "lookback window must be a positive number")
+    if lookback.format is not None and not isinstance(lookback.format, str):
+        raise InvalidFileConfig(path, "lookback format must be a string")
+    return lookback
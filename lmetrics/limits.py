@@ -0,0 +1,122 @@
+"""Limits on the number of series for metrics."""
+
+from collections import OrderedDict
+import threading
+import time
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Optional,
+    Tuple,
+)
+
+from prometheus_client import Metric
+
+from .config import SeriesLimit
+from .stats import Stats
+
+# Label value for the series where updates over the limit are merged
+OVERFLOW_LABEL_VALUE = "__overflow__"
+
+
+class LimitedMetric:
+    """Proxy to a metric with labels, limiting the number of its series.
+
+    Series are tracked by the time they were last updated.  Those not updated
+    for longer than the limit TTL are removed when new series are created.
+    When the maximum number of series is reached, either the least recently
+    updated series is removed, or the update goes to the overflow series,
+    which has all labels set to :data:`OVERFLOW_LABEL_VALUE`.
+
+    Other attributes are proxied to the metric.
+
+    """
+
+    def __init__(
+        self,
+        name: str,
+        metric: Metric,
+        limit: SeriesLimit,
+        stats: Optional[Stats] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.name = name
+        self._metric = metric
+        self._limit = limit
+        self._stats = stats
+        self._clock = clock
+        self._labelnames: Tuple[str, ...] = metric._labelnames
+        self._overflow_values = (OVERFLOW_LABEL_VALUE,) * len(self._labelnames)
+        # label values for series, in order of last update
+        self._series: "OrderedDict[Tuple[str, ...], float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def labels(self, *labelvalues: Any, **labelkwargs: Any) -> Any:
+        """Return the child metric for labels, applying limits."""
+        # invalid labels are reported by the metric
+        if labelkwargs:
+            if labelvalues or set(labelkwargs) != set(self._labelnames):
+                return self._metric.labels(*labelvalues, **labelkwargs)
+            labelvalues = tuple(labelkwargs[name] for name in self._labelnames)
+        elif len(labelvalues) != len(self._labelnames):
+            return self._metric.labels(*labelvalues)
+
+        values = tuple(str(value) for value in labelvalues)
+        with self._lock:
+            values = self._track(values)
+        return self._metric.labels(*values)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._metric, name)
+
+    def _track(self, values: Tuple[str, ...]) -> Tuple[str, ...]:
+        """Track a series, returning label values to use for it."""
+        now = self._clock()
+        if values in self._series:
+            self._series.move_to_end(values)
+            self._series[values] = now
+            return values
+
+        self._expire(now)
+        max_series = self._limit.max_series
+        if max_series is not None and len(self._series) >= max_series:
+            if self._limit.overflow:
+                if self._stats is not None:
+                    self._stats.series_overflows.labels(self.name).inc()
+                return self._overflow_values
+            oldest, _ = self._series.popitem(last=False)
+            self._remove(oldest, "lru")
+        self._series[values] = now
+        return values
+
+    def _expire(self, now: float):
+        """Remove series not updated within the TTL."""
+        ttl = self._limit.ttl
+        if ttl is None:
+            return
+        while self._series:
+            values, updated = next(iter(self._series.items()))
+            if now - updated < ttl:
+                return
+            del self._series[values]
+            self._remove(values, "ttl")
+
+    def _remove(self, values: Tuple[str, ...], reason: str):
+        self._metric.remove(*values)
+        if self._stats is not None:
+            self._stats.series_evictions.labels(self.name, reason).inc()
+
+
+def limit_metrics(
+    metrics: Dict[str, Metric],
+    limits: Dict[str, SeriesLimit],
+    stats: Optional[Stats] = None,
+) -> Dict[str, Any]:
+    """Return metrics, wrapping those with limits in a LimitedMetric."""
+    return {
+        name: LimitedMetric(name, metric, limits[name], stats=stats)
+        if name in limits
+        else metric
+        for name, metric in metrics.items()
+    }
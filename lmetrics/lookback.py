@@ -0,0 +1,185 @@
+"""Search of log files for lines within a time window."""
+
+from datetime import (
+    datetime,
+    timedelta,
+    timezone,
+)
+import os
+import re
+import time
+from typing import (
+    Callable,
+    IO,
+    Optional,
+    Pattern,
+    Tuple,
+)
+
+# Size of blocks read backwards when looking for the end of the last line
+BLOCK_SIZE = 4096
+
+# ISO 8601 date and time, with optional fraction of seconds and timezone
+ISO_TIMESTAMP = re.compile(
+    r"(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2})(?::(\d{2})(?:[.,](\d+))?)?"
+    r"(?:(Z)|([+-])(\d{2}):?(\d{2}))?$"
+)
+
+
+class TimestampParser:
+    """Parse timestamps from log lines.
+
+    The timestamp is the first group matched by ``regexp`` in a line (or the
+    whole match, if it has no groups), parsed with ``datetime.strptime`` if a
+    ``format`` is passed, as ISO 8601 otherwise.  Timestamps without a
+    timezone are in local time.
+
+    Lines are bytes, decoded with the ``encoding``.
+
+    """
+
+    def __init__(
+        self, regexp: Pattern, format: Optional[str] = None, encoding: str = "utf-8"
+    ):
+        self._regexp = regexp
+        self._format = format
+        self._encoding = encoding
+
+    def __call__(self, line: bytes) -> Optional[float]:
+        """Return the timestamp for a line, or None if it has none."""
+        match = self._regexp.search(line.decode(self._encoding, errors="replace"))
+        if match is None:
+            return None
+        value = match.group(1) if self._regexp.groups else match.group(0)
+        try:
+            if self._format is None:
+                parsed = _parse_iso(value)
+            else:
+                parsed = datetime.strptime(value, self._format)
+        except (TypeError, ValueError):
+            return None
+        return parsed.timestamp()
+
+
+class Lookback:
+    """Find where lines within a time window start in a log file.
+
+    Lines are expected in timestamp order.  The file is binary-searched for
+    the first line with a timestamp not older than ``window`` seconds, so
+    only a few lines around each probed offset are read.  Lines without a
+    timestamp (e.g. continuation lines) are skipped when probing.
+
+    """
+
+    def __init__(
+        self,
+        parse: Callable[[bytes], Optional[float]],
+        window: float,
+        clock: Callable[[], float] = time.time,
+    ):
+        self._parse = parse
+        self._window = window
+        self._clock = clock
+
+    def find_start(self, fd: IO) -> Optional[int]:
+        """Return the offset of the first line within the window.
+
+        If no full line is within the window, the offset after the last full
+        line is returned.  If no line has a timestamp (e.g. because the
+        timestamp format doesn't match), None is returned.
+
+        """
+        cutoff = self._clock() - self._window
+        low, high = 0, _last_line_end(fd)
+        start = high
+        found = False
+        while low < high:
+            middle = (low + high) // 2
+            probe = self._probe(fd, middle, high)
+            if probe is None:
+                # no timestamps in the second half
+                high = middle
+                continue
+            found = True
+            line_start, line_end, timestamp = probe
+            if timestamp >= cutoff:
+                start = line_start
+                high = middle
+            else:
+                low = line_end
+        if start and not found:
+            return None
+        return start
+
+    def _probe(
+        self, fd: IO, offset: int, limit: int
+    ) -> Optional[Tuple[int, int, float]]:
+        """Return the first line with a timestamp, starting from an offset.
+
+        The line start and end offsets are returned with its timestamp, if
+        one is found in lines starting before ``limit``.
+
+        """
+        if offset == 0:
+            fd.seek(0)
+        else:
+            # skip to the start of the next line
+            fd.seek(offset - 1)
+            fd.readline()
+        while True:
+            line_start = fd.tell()
+            if line_start >= limit:
+                return None
+            timestamp = self._parse(fd.readline())
+            if timestamp is not None:
+                return line_start, fd.tell(), timestamp
+
+
+def _last_line_end(fd: IO) -> int:
+    """Return the offset after the last newline in a file."""
+    end = os.fstat(fd.fileno()).st_size
+    while end > 0:
+        start = max(end - BLOCK_SIZE, 0)
+        fd.seek(start)
+        data: bytes = fd.read(end - start)
+        index = data.rfind(b"\n")
+        if index != -1:
+            return start + index + 1
+        end = start
+    return 0
+
+
+def _parse_iso(value: str) -> datetime:
+    """Parse an ISO 8601 timestamp, raising ValueError if it's invalid."""
+    match = ISO_TIMESTAMP.match(value)
+    if match is None:
+        raise ValueError(f"invalid ISO 8601 timestamp: {value}")
+    (
+        year,
+        month,
+        day,
+        hour,
+        minute,
+        second,
+        fraction,
+        utc,
+        sign,
+        offset_hours,
+        offset_minutes,
+    ) = match.groups()
+    tzinfo = None
+    if utc:
+        tzinfo = timezone.utc
+    elif sign:
+        offset = timedelta(hours=int(offset_hours), minutes=int(offset_minutes))
+        tzinfo = timezone(-offset if sign == "-" else offset)
+    return datetime(
+        int(year),
+        int(month),
+        int(day),
+        int(hour),
+        int(minute),
+        int(second or 0),
+        int((fraction or "0")[:6].ljust(6, "0")),
+        tzinfo=tzinfo,
+    )
@@ -1,55 +1,374 @@
 """Script main."""
 
 import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from multiprocessing.connection import Connection
+from pathlib import Path
+import signal
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
 
 from prometheus_aioexporter import PrometheusExporterScript
-from prometheus_aioexporter.metric import InvalidMetricType
+from prometheus_aioexporter.metric import (
+    InvalidMetricType,
+    MetricsRegistry,
+)
+from prometheus_aioexporter.web import PrometheusExporter
+from prometheus_client import CollectorRegistry
+from toolrack.aio import PeriodicCall
 from toolrack.script import ErrorExitMessage
 
-from .config import load_config
+from .backfill import (
+    Backfill,
+    DEFAULT_MIN_SIZE,
+)
+from .cache import (
+    cached_metrics_middleware,
+    MetricsCache,
+)
+from .config import (
+    Config,
+    InvalidFileConfig,
+    InvalidMetricConfig,
+    load_config,
+)
+from .limits import limit_metrics
 from .rule import (
-    create_file_analyzers,
+    FileAnalyzer,
+    RuleRegistry,
     RuleSyntaxError,
 )
-from .watch import create_watchers
+from .state import FilePositions
+from .stats import Stats
+from .watch import (
+    ChangeWatcher,
+    create_watchers,
+    DEFAULT_CHUNK_SIZE,
+    InotifyDispatcher,
+    parse_chunk_size,
+)
+from .workers import (
+    MergedCollector,
+    run_worker,
+    split_files,
+    WorkerProcess,
+)
 
 
 class LMetricsScript(PrometheusExporterScript):
     """Parse and expose metrics from log files to Prometheus."""
 
+    positions: Optional[FilePositions] = None
+    executor: Optional[ThreadPoolExecutor] = None
+    workers: List[WorkerProcess] = []
+    stats: Optional[Stats] = None
+    rule_registry: Optional[RuleRegistry] = None
+    rule_watchers: List[ChangeWatcher] = []
+    metrics_cache: Optional[MetricsCache] = None
+    _save_positions: Optional[PeriodicCall] = None
+
     def configure_argument_parser(self, parser):
         parser.add_argument(
             "config", type=argparse.FileType("r"), help="configuration file"
         )
+        parser.add_argument(
+            "--read-chunk-size",
+            type=parse_chunk_size,
+            default=DEFAULT_CHUNK_SIZE,
+            help="maximum size in bytes of data read from log files at once",
+        )
+        parser.add_argument(
+            "--state-file",
+            type=Path,
+            help="file to save read positions in log files to, so that they're "
+            "not read again on restart",
+        )
+        parser.add_argument(
+            "--state-save-interval",
+            type=float,
+            default=10.0,
+            help="interval in seconds between saves of the state file",
+        )
+        parser.add_argument(
+            "--analysis-threads",
+            type=int,
+            default=0,
+            help="number of threads to analyze lines in, instead of doing it "
+            "in the main loop",
+        )
+        parser.add_argument(
+            "--coalesce-interval",
+            type=float,
+            default=0.0,
+            help="interval in seconds to wait for further changes to log files "
+            "before reading them",
+        )
+        parser.add_argument(
+            "--backfill-processes",
+            type=int,
+            default=0,
+            help="number of processes to analyze existing content of large log "
+            "files in at startup (0 to read it normally)",
+        )
+        parser.add_argument(
+            "--backfill-min-size",
+            type=int,
+            default=DEFAULT_MIN_SIZE,
+            help="minimum size in bytes of existing content in log files for "
+            "them to be backfilled",
+        )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=1,
+            help="number of processes to split analysis of log files across",
+        )
+        parser.add_argument(
+            "--watch-rules",
+            action="store_true",
+            help="reload rule files when they change (they're always reloaded "
+            "on SIGHUP)",
+        )
+        parser.add_argument(
+            "--metrics-cache-interval",
+            type=float,
+            default=0.0,
+            help="minimum interval in seconds between renderings of metrics, "
+            "reusing the output in between (0 to render on every request)",
+        )
+        parser.add_argument(
+            "--buffer-metrics",
+            action="store_true",
+            help="buffer metric updates from Lua rules, applying them once for "
+            "each batch of lines",
+        )
+        parser.add_argument(
+            "--rule-timing",
+            action="store_true",
+            help="record time spent matching and running each rule (this slows "
+            "down analysis)",
+        )
 
     def configure(self, args):
         config = self._load_config(args.config)
-        metrics = self.create_metrics(config.metrics)
-        analyzers = self._create_file_analyzers(config.files, metrics)
-        self.watchers = create_watchers(analyzers, self.loop)
+        self.metrics_cache = MetricsCache(
+            self.registry.generate_metrics, min_age=args.metrics_cache_interval
+        )
+        if args.processes > 1:
+            self._configure_workers(config, args)
+        else:
+            self._configure_watchers(config, args)
 
     async def on_application_startup(self, application):
         for watcher in self.watchers:
             watcher.watch()
+        for worker in self.workers:
+            worker.start()
+        for rule_watcher in self.rule_watchers:
+            rule_watcher.watch()
+        self.loop.add_signal_handler(signal.SIGHUP, self._reload_rules)
+        if self._save_positions:
+            self._save_positions.start(self._save_positions_interval, now=False)
 
     async def on_application_shutdown(self, application):
+        self.loop.remove_signal_handler(signal.SIGHUP)
+        for rule_watcher in self.rule_watchers:
+            await rule_watcher.stop()
         for watcher in self.watchers:
             await watcher.stop()
+        for worker in self.workers:
+            await worker.stop()
+        if self.executor:
+            self.executor.shutdown()
+        if self._save_positions and self._save_positions.running:
+            await self._save_positions.stop()
+            self.positions.save()
+
+    def _configure_watchers(self, config: Config, args: argparse.Namespace):
+        """Configure watchers to analyze log files in this process."""
+        self.stats = Stats(self.registry.registry, rule_timing=args.rule_timing)
+        collector = None
+        if args.backfill_processes > 0:
+            # metrics are merged with those from backfill processes
+            metrics_registry = MetricsRegistry()
+            created_metrics = metrics_registry.create_metrics(config.metrics)
+            collector = MergedCollector(
+                on_update=self._metrics_changed, local=metrics_registry.registry
+            )
+            self.registry.register_additional_collector(collector)
+        else:
+            created_metrics = self.create_metrics(config.metrics)
+        metrics = limit_metrics(created_metrics, config.limits, stats=self.stats)
+        self.rule_registry = RuleRegistry(
+            metrics, stats=self.stats, buffer_updates=args.buffer_metrics
+        )
+        analyzers = self._create_file_analyzers(self.rule_registry, config.files)
+        if args.watch_rules:
+            dispatcher = InotifyDispatcher(loop=self.loop)
+            self.rule_watchers = [
+                ChangeWatcher(
+                    path, self._reload_rules, dispatcher=dispatcher, loop=self.loop
+                )
+                for path in self.rule_registry.rule_paths
+            ]
+        if args.state_file:
+            self.positions = FilePositions(args.state_file)
+            self.positions.load()
+            self.positions.prune()
+            self._save_positions = PeriodicCall(self.loop, self.positions.save)
+            self._save_positions_interval = args.state_save_interval
+        if args.analysis_threads > 0:
+            self.executor = ThreadPoolExecutor(
+                max_workers=args.analysis_threads,
+                thread_name_prefix="lmetrics-analysis",
+            )
+        self.watchers = create_watchers(
+            analyzers,
+            self.loop,
+            chunk_size=args.read_chunk_size,
+            positions=self.positions,
+            executor=self.executor,
+            coalesce_interval=args.coalesce_interval,
+            stats=self.stats,
+            on_analyzed=self._metrics_changed,
+            backfills=self._create_backfills(config, args, analyzers, collector),
+        )
+
+    def _create_backfills(
+        self,
+        config: Config,
+        args: argparse.Namespace,
+        analyzers: List[FileAnalyzer],
+        collector: Optional[MergedCollector],
+    ) -> Dict[FileAnalyzer, Backfill]:
+        """Return Backfills for analyzers, if enabled."""
+        if collector is None:
+            return {}
+        return {
+            analyzer: Backfill(
+                partial(self._create_backfill_analyzer, config, args, path),
+                collector,
+                processes=args.backfill_processes,
+                min_size=args.backfill_min_size,
+                chunk_size=args.read_chunk_size,
+                loop=self.loop,
+            )
+            for path, analyzer in zip(config.files, analyzers)
+            # records spanning multiple lines could be split across ranges
+            if analyzer.multiline is None
+        }
+
+    def _create_backfill_analyzer(
+        self, config: Config, args: argparse.Namespace, path: str
+    ) -> Tuple[FileAnalyzer, CollectorRegistry]:
+        """Return an analyzer for a file in a backfill process.
+
+        The analyzer updates its own metrics, returned with their registry.
+
+        """
+        registry = MetricsRegistry()
+        metrics = limit_metrics(registry.create_metrics(config.metrics), config.limits)
+        rule_registry = RuleRegistry(metrics, buffer_updates=args.buffer_metrics)
+        [analyzer] = rule_registry.get_file_analyzers({Path(path): config.files[path]})
+        return analyzer, registry.registry
+
+    def _configure_workers(self, config: Config, args: argparse.Namespace):
+        """Configure worker processes to analyze log files.
+
+        Each worker analyzes a subset of the configured files, and sends
+        metrics updates back, which are merged and exported.
+
+        """
+        # check rules before starting workers, so that errors are reported
+        self._create_file_analyzers(
+            RuleRegistry(MetricsRegistry().create_metrics(config.metrics)),
+            config.files,
+        )
+        collector = MergedCollector(on_update=self._metrics_changed)
+        self.registry.register_additional_collector(collector)
+        self.watchers = []
+        self.workers = [
+            WorkerProcess(
+                index,
+                partial(self._run_worker, index, config._replace(files=files), args),
+                collector,
+                self.loop,
+            )
+            for index, files in enumerate(split_files(config.files, args.processes))
+        ]
+
+    def _run_worker(
+        self,
+        index: int,
+        config: Config,
+        args: argparse.Namespace,
+        conn: Connection,
+    ):
+        """Analyze log files in a worker process."""
+        self.loop = asyncio.new_event_loop()
+        self.registry = MetricsRegistry()
+        self.workers = []
+        # worker processes are daemonic, so they can't start other processes
+        args.backfill_processes = 0
+        if args.state_file:
+            # each worker tracks positions for its own files
+            state_file = args.state_file
+            args.state_file = state_file.with_name(f"{state_file.name}.{index}")
+        self._configure_watchers(config, args)
+        run_worker(
+            conn,
+            self.loop,
+            self.registry.registry,
+            partial(self.on_application_startup, None),
+            partial(self.on_application_shutdown, None),
+        )
+
+    def _get_exporter(self, args: argparse.Namespace) -> PrometheusExporter:
+        exporter = super()._get_exporter(args)
+        if self.metrics_cache:
+            # the path is only configurable in recent exporter versions
+            path = getattr(exporter, "metrics_path", "/metrics")
+            exporter.app.middlewares.append(
+                cached_metrics_middleware(self.metrics_cache, path=path)
+            )
+        return exporter
+
+    def _metrics_changed(self):
+        """Mark metrics as changed, so that they're rendered again."""
+        if self.metrics_cache:
+            self.metrics_cache.invalidate()
+
+    def _reload_rules(self):
+        """Reload changed rule files, also in worker processes.
+
+        Positions in log files and metrics are kept.
+
+        """
+        for worker in self.workers:
+            worker.send_signal(signal.SIGHUP)
+        if self.rule_registry:
+            self.rule_registry.reload_rules()
 
     def _load_config(self, config_file):
         """Load the application configuration."""
         try:
             config = load_config(config_file)
-        except InvalidMetricType as error:
+        except (InvalidMetricType, InvalidMetricConfig, InvalidFileConfig) as error:
             raise ErrorExitMessage(str(error))
         finally:
             config_file.close()
         return config
 
-    def _create_file_analyzers(self, files, metrics):
+    def _create_file_analyzers(self, registry, files):
         """Create FileAnalyzers."""
         try:
-            return create_file_analyzers(files, metrics)
+            return registry.get_file_analyzers(files)
         except FileNotFoundError as error:
             raise ErrorExitMessage(f"Rule file not found: {error.filename}")
         except RuleSyntaxError as error:
@@ -0,0 +1,132 @@
+"""Match lines against multiple rules in a single pass."""
+
+import re
+import sys
+from typing import (
+    Any,
+    List,
+    Optional,
+    Pattern,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+if sys.version_info >= (3, 11):  # pragma: no cover
+    # the sre_* modules are deprecated since Python 3.11
+    from re import (
+        _constants as sre_constants,
+        _parser as sre_parse,
+    )
+else:  # pragma: no cover
+    import sre_constants
+    import sre_parse
+
+# Tokens of a regexp which need care when rewriting it: escapes, character
+# classes and named group definitions.
+_TOKENS = re.compile(r"\\.|\[\^?\]?(?:\\.|[^\]])*\]|(?P<group>\(\?P<\w+>)", re.DOTALL)
+# Constructs referencing groups, which can't be combined with other regexps
+_GROUP_REFERENCE = re.compile(r"\(\?P=|\(\?\(|\\[1-9]")
+
+Text = Union[str, bytes]
+
+
+class RuleMatcher:
+    """Select rules that can match a line, scanning it only once.
+
+    Regexps for all rules are joined in an alternation, so that lines not
+    matching any rule are rejected with a single search.  For lines that pass,
+    rules are further filtered by checking whether the literal string each
+    regexp requires is contained in the line.
+
+    Rules must provide a compiled ``regexp`` attribute.  Regexps can be
+    either all text or all bytes patterns.
+
+    """
+
+    def __init__(self, rules: Sequence[Any]):
+        self.rules = list(rules)
+        self._literals: List[Tuple[Any, Any]] = []
+        # rules that can't be combined must always be checked
+        self._always: List[Any] = []
+        patterns = []
+        for rule in self.rules:
+            pattern = combinable_pattern(rule.regexp)
+            if pattern is None:
+                self._always.append(rule)
+            else:
+                patterns.append(pattern)
+            self._literals.append((rule, required_literal(rule.regexp)))
+        self._combined = combine_patterns(patterns)
+
+    def candidates(self, line: Text) -> List[Any]:
+        """Return rules whose regexp can match the line."""
+        if self._combined is not None and not self._combined.search(line):
+            return self._always
+        return [rule for rule, literal in self._literals if literal in line]
+
+
+def required_literal(regexp: Pattern) -> Text:
+    """Return the longest literal string the regexp requires to match.
+
+    An empty string is returned if no literal is required.  For bytes
+    patterns, the literal is bytes too.
+
+    """
+    if regexp.flags & re.IGNORECASE:
+        return b"" if isinstance(regexp.pattern, bytes) else ""
+
+    runs: List[List[Any]] = [[]]
+    for op, value in sre_parse.parse(regexp.pattern, regexp.flags).data:
+        if op is sre_constants.LITERAL:
+            runs[-1].append(value)
+        elif runs[-1]:
+            runs.append([])
+    literal = max(runs, key=len)
+    if isinstance(regexp.pattern, bytes):
+        return bytes(literal)
+    return "".join(chr(char) for char in literal)
+
+
+def combinable_pattern(regexp: Pattern) -> Optional[Text]:
+    """Return a version of the regexp pattern which can be combined.
+
+    Named groups are turned into non-capturing ones.  If the pattern can't be
+    combined with others (e.g. because it uses global flags or references
+    groups), None is returned.
+
+    """
+    pattern = regexp.pattern
+    if isinstance(pattern, bytes):
+        # bytes map one to one to characters with latin-1
+        combinable = _combinable_text(pattern.decode("latin-1"), regexp.flags, 0)
+        return None if combinable is None else combinable.encode("latin-1")
+    return _combinable_text(pattern, regexp.flags, re.UNICODE)
+
+
+def _combinable_text(pattern: str, flags: int, default_flags: int) -> Optional[str]:
+    if flags != default_flags or _GROUP_REFERENCE.search(pattern):
+        return None
+
+    def replace(match):
+        return "(?:" if match.group("group") else match.group()
+
+    return _TOKENS.sub(replace, pattern)
+
+
+def combine_patterns(patterns: Sequence[Text]) -> Optional[Pattern]:
+    """Return a regexp matching if any of the patterns matches."""
+    if not patterns:
+        return None
+
+    texts = [
+        pattern.decode("latin-1") if isinstance(pattern, bytes) else pattern
+        for pattern in patterns
+    ]
+    combined = "|".join(f"(?:{text})" for text in texts)
+    try:
+        if isinstance(patterns[0], bytes):
+            return re.compile(combined.encode("latin-1"))
+        return re.compile(combined)
+    except re.error:
+        return None
@@ -0,0 +1,67 @@
+"""Assembly of multiline records from log lines."""
+
+from typing import (
+    Any,
+    List,
+    Pattern,
+)
+
+
+class MultilineAssembler:
+    """Group lines in records spanning multiple lines.
+
+    A record starts with a line matching the ``start`` regexp, and includes
+    all following lines until the next start line.  Lines in a record are
+    joined with newlines.  Lines can be text or bytes, matching the type of
+    the regexp.
+
+    Records are bounded to ``max_lines`` lines and ``max_length`` characters
+    (or bytes), further lines are discarded until the next record starts.
+
+    """
+
+    def __init__(self, start: Pattern, max_lines: int, max_length: int):
+        self._start = start
+        self._max_lines = max_lines
+        self._max_length = max_length
+        self._newline = "\n" if isinstance(start.pattern, str) else b"\n"
+        self._lines: List[Any] = []
+        self._length = 0
+        # whether the record reached a limit
+        self._full = False
+
+    def feed(self, lines: List[Any]) -> List[Any]:
+        """Process lines, returning completed records."""
+        records = []
+        search = self._start.search
+        for line in lines:
+            if self._lines and search(line):
+                records.append(self._record())
+            self._append(line)
+        return records
+
+    def flush(self) -> List[Any]:
+        """Return the pending record, if any."""
+        return [self._record()] if self._lines else []
+
+    def _append(self, line: Any):
+        if not self._lines:
+            # the first line is always kept
+            self._lines.append(line)
+            self._length = len(line)
+            return
+        if self._full:
+            return
+        length = self._length + len(line) + 1
+        if len(self._lines) >= self._max_lines or length > self._max_length:
+            self._full = True
+            return
+        self._lines.append(line)
+        self._length = length
+
+    def _record(self) -> Any:
+        record = self._newline.join(self._lines)
+        self._lines = []
+        self._length = 0
+        self._full = False
+        return record
@@ -0,0 +1,204 @@
+"""Replay log files through rules, without watching them."""
+
+import argparse
+from fnmatch import fnmatch
+from pathlib import Path
+import time
+from typing import (
+    Any,
+    List,
+    Optional,
+    Union,
+)
+
+from prometheus_aioexporter.metric import (
+    InvalidMetricType,
+    MetricsRegistry,
+)
+from prometheus_client import CollectorRegistry
+from toolrack.script import (
+    ErrorExitMessage,
+    Script,
+)
+
+from .config import (
+    Config,
+    FileConfig,
+    InvalidFileConfig,
+    InvalidMetricConfig,
+    load_config,
+)
+from .limits import limit_metrics
+from .rule import (
+    create_file_analyzers,
+    FileAnalyzer,
+    RuleSyntaxError,
+)
+from .stats import Stats
+from .watch import (
+    BytesLineStream,
+    COMPRESSED_OPENERS,
+    DEFAULT_CHUNK_SIZE,
+    LineStream,
+    parse_chunk_size,
+)
+
+
+class ReplayScript(Script):
+    """Analyze log files from start to end, printing resulting metrics.
+
+    Files are read as fast as possible, using rules from the entry of the
+    configuration matching each file.  Metrics are printed to standard
+    output in the Prometheus text format, and throughput stats to standard
+    error.
+
+    """
+
+    def get_parser(self) -> argparse.ArgumentParser:
+        parser = argparse.ArgumentParser(
+            description="Analyze log files from start to end, printing metrics."
+        )
+        parser.add_argument(
+            "config", type=argparse.FileType("r"), help="configuration file"
+        )
+        parser.add_argument("files", nargs="+", type=Path, help="log files to analyze")
+        parser.add_argument(
+            "--read-chunk-size",
+            type=parse_chunk_size,
+            default=DEFAULT_CHUNK_SIZE,
+            help="maximum size in bytes of data read from log files at once",
+        )
+        parser.add_argument(
+            "--entry",
+            metavar="PATTERN",
+            help="path pattern of the entry in the configuration to analyze all "
+            "files with, instead of the one matching each file",
+        )
+        return parser
+
+    def main(self, args: argparse.Namespace):
+        try:
+            config = load_config(args.config)
+        except (InvalidMetricType, InvalidMetricConfig, InvalidFileConfig) as error:
+            raise ErrorExitMessage(str(error))
+        finally:
+            args.config.close()
+
+        registry = MetricsRegistry()
+        stats_registry = CollectorRegistry()
+        stats = Stats(stats_registry, rule_timing=True)
+        metrics = limit_metrics(
+            registry.create_metrics(config.metrics), config.limits, stats=stats
+        )
+        files = {
+            path: self._file_config(config, path, entry=args.entry)
+            for path in args.files
+        }
+        try:
+            analyzers = create_file_analyzers(files, metrics, stats=stats)
+        except FileNotFoundError as error:
+            raise ErrorExitMessage(f"Rule file not found: {error.filename}")
+        except RuleSyntaxError as error:
+            raise ErrorExitMessage(str(error))
+
+        total_lines = 0
+        start = time.perf_counter()
+        for analyzer in analyzers:
+            file_start = time.perf_counter()
+            lines = replay_file(analyzer, args.read_chunk_size)
+            total_lines += lines
+            self._report(str(analyzer.path), lines, time.perf_counter() - file_start)
+        self._report("total", total_lines, time.perf_counter() - start)
+        self._report_rules(stats_registry)
+        self._stdout.write(registry.generate_metrics().decode())
+
+    def _file_config(
+        self, config: Config, path: Path, entry: Optional[str] = None
+    ) -> FileConfig:
+        """Return the configuration for the entry matching a file.
+
+        If an ``entry`` pattern is passed, its configuration is returned
+        instead.
+
+        """
+        if entry is not None:
+            try:
+                return config.files[entry]
+            except KeyError:
+                raise ErrorExitMessage(f"No configuration entry: {entry}")
+
+        absolute = path.absolute()
+        for pattern, file_config in config.files.items():
+            pattern_path = Path(pattern).absolute()
+            if pattern_path.parent == absolute.parent and fnmatch(
+                absolute.name, pattern_path.name
+            ):
+                return file_config
+        raise ErrorExitMessage(
+            f"No configuration for file (use --entry to select one): {path}"
+        )
+
+    def _report(self, name: str, lines: int, seconds: float):
+        rate = lines / seconds if seconds else 0.0
+        self._stderr.write(
+            f"{name}: {lines} lines in {seconds:.3f}s ({rate:.0f} lines/s)\n"
+        )
+
+    def _report_rules(self, registry: CollectorRegistry):
+        for metric in registry.collect():
+            if metric.name != "lmetrics_rule_matches":
+                continue
+            for sample in metric.samples:
+                if sample.name != "lmetrics_rule_matches_total":
+                    continue
+                labels = sample.labels
+
+                def value(name: str) -> float:
+                    return float(
+                        registry.get_sample_value(f"lmetrics_rule_{name}", labels)
+                    )
+
+                self._stderr.write(
+                    f'rule "{labels["rule"]}" ({labels["rules"]}): '
+                    f"{sample.value:.0f} matches, "
+                    f'{value("regexp_seconds_total"):.3f}s in regexp, '
+                    f'{value("action_seconds_total"):.3f}s in action, '
+                    f'{value("action_errors_total"):.0f} errors\n'
+                )
+
+
+def replay_file(analyzer: FileAnalyzer, chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+    """Analyze all content of the file for an analyzer.
+
+    Compressed files are decompressed while reading.  The number of lines
+    read is returned.
+
+    """
+    stream: Union[LineStream, BytesLineStream]
+    if analyzer.binary:
+        stream = BytesLineStream(
+            max_line_length=analyzer.max_line_length,
+            drop_long_lines=analyzer.drop_long_lines,
+        )
+    else:
+        stream = LineStream(
+            encoding=analyzer.encoding,
+            errors=analyzer.encoding_errors,
+            max_line_length=analyzer.max_line_length,
+            drop_long_lines=analyzer.drop_long_lines,
+        )
+    count = 0
+    opener = COMPRESSED_OPENERS.get(analyzer.path.suffix, open)
+    with opener(analyzer.path, "rb") as fd:
+        while True:
+            data = fd.read(chunk_size)
+            lines: List[Any] = stream.feed(data) if data else stream.flush()
+            if lines:
+                analyzer.analyze_lines(lines)
+                count += len(lines)
+            if not data:
+                analyzer.flush()
+                return count
+
+
+script = ReplayScript()
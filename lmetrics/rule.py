@@ -1,60 +1,226 @@
+from collections import defaultdict
+import importlib
 import logging
 from pathlib import Path
 import re
+import time
+from types import ModuleType
 from typing import (
+    Any,
     Callable,
+    DefaultDict,
     Dict,
     List,
+    Match,
     NamedTuple,
+    Optional,
+    Pattern,
+    Tuple,
     Union,
 )
 
 import lupa
 from prometheus_client import Metric
 from toolrack.log import Loggable
+import yaml
+
+from .buffer import (
+    buffer_metrics,
+    MetricsBuffer,
+)
+from .config import (
+    DEFAULT_LUA_RUNTIME,
+    FileConfig,
+    LookbackConfig,
+    MultilineConfig,
+)
+from .match import RuleMatcher
+from .multiline import MultilineAssembler
+from .sampling import (
+    Sampler,
+    SampleWeight,
+    scale_counters,
+    weighted_action,
+)
+from .stats import (
+    RuleStats,
+    Stats,
+)
 
 
 class RuleSyntaxError(Exception):
     """Raised if the rule code contains errors."""
 
     def __init__(self, path: Path, message: str):
-        error = message.replace('error loading code: [string "<python>"]', "")
+        error = message.replace("error loading code: ", "").replace(
+            '[string "<python>"]', ""
+        )
         super().__init__(f"in {path}{error}")
 
 
 ActionMatch = Dict[str, Union[str, float]]
 
+# Lines are bytes for files analyzed in binary mode
+Line = Union[str, bytes]
+
+# File suffixes for declarative rule files
+DECLARATIVE_SUFFIXES = frozenset([".yaml", ".yml"])
+
+# Metric methods which can be called by declarative rules
+DECLARATIVE_OPERATIONS = frozenset(["inc", "dec", "set", "observe"])
+
+# lupa modules providing Lua runtimes, in order of preference, for names that
+# don't match a single module
+LUA_RUNTIME_MODULES = {"luajit": ("luajit21", "luajit20")}
+
+# Converters for types of match groups that Lua rules can declare
+GROUP_TYPES: Dict[str, Callable[[str], Union[str, float]]] = {
+    "float": float,
+    "int": int,
+    "str": str,
+}
+
 
 class LuaRule:
     """Base class for rules parsed from Lua files."""
 
     regexp: str = ""
-
-    def __init__(self, regexp: str = ""):
+    types: Optional[Dict[str, str]] = None
+    # run the action for one in this many matches
+    sample: Any = 1
+    # whether matches are sampled at random, instead of at regular intervals
+    random_sample: bool = False
+
+    def __init__(
+        self,
+        regexp: str = "",
+        types: Optional[Any] = None,
+        sample: Any = 1,
+        random_sample: bool = False,
+    ):
         self.regexp = regexp
+        if types is not None:
+            # tables from runtimes in other lupa modules aren't recognized by
+            # lupa.lua_type(), so check for the table interface instead
+            if not callable(getattr(types, "items", None)):
+                raise ValueError(f"group types must be a table: {types}")
+            self.types = dict(types.items())
+        self.sample = sample
+        self.random_sample = random_sample
 
     def action(self, match: ActionMatch):
         """Called for each matched line with match values.
 
-        Rules in Lua code should define this method.
+        Rules in Lua code should define this method, unless they define
+        ``batch_action``.
 
         """
 
+    # Rules in Lua code can define a batch_action(matches) method instead of
+    # action(). It's called once for each batch of lines read from a file,
+    # with an array of match values for all matching lines.
+    batch_action: Optional[Callable[[Any], None]] = None
 
-class LuaFileRule:
-    """A rule for parsing log lines from a Lua file."""
 
-    def __init__(self, name: str, lua_rule: LuaRule):
+class LuaFileRule:
+    """A rule for parsing log lines from a Lua file.
+
+    If the rule defines a ``batch_action``, matches are collected and passed
+    to it with :meth:`batch_action`, converting the list of matches with
+    ``table_from``.
+
+    If the rule declares ``types`` for match groups, only those groups are
+    converted.  Otherwise, all groups are converted to float where possible.
+
+    If an ``encoding`` is passed, the rule matches bytes lines, and only
+    values for matched groups are decoded.
+
+    If the rule sets a ``sample`` rate N, only one in N matches is returned,
+    selected at regular intervals, or at random if ``random_sample`` is set.
+    Other matches are counted in ``sampled_out``, if passed.  If a
+    :class:`SampleWeight` is passed, it's set to N while actions run, so that
+    counters from :func:`scale_counters` are incremented accordingly.
+
+    If actions update metrics through a :class:`MetricsBuffer`, it must be
+    passed as ``buffer``, so that analyzers flush it.
+
+    A ValueError is raised if declared types or the sample rate are invalid.
+
+    """
+
+    def __init__(
+        self,
+        name: str,
+        lua_rule: LuaRule,
+        table_from: Callable[[List[ActionMatch]], Any] = list,
+        encoding: Optional[str] = None,
+        encoding_errors: str = "strict",
+        weight: Optional[SampleWeight] = None,
+        sampled_out: Optional[Any] = None,
+        buffer: Optional[MetricsBuffer] = None,
+    ):
         self.name = name
-        self._regexp = re.compile(lua_rule.regexp)
-        self._action = lua_rule.action
-
-    def analyze_line(self, line: str):
+        self.buffer = buffer
+        self.regexp = compile_regexp(lua_rule.regexp, encoding)
+        self._encoding = encoding
+        self._encoding_errors = encoding_errors
+        self._converters = _group_converters(self.regexp, lua_rule.types)
+        self.action: Callable[[ActionMatch], Any] = lua_rule.action
+        self._batch_action: Optional[Callable[[Any], None]] = lua_rule.batch_action
+        self.batched = self._batch_action is not None
+        self._table_from = table_from
+        self.sample_rate = _sample_rate(lua_rule.sample)
+        self._sampler: Optional[Sampler] = None
+        self._sampled_out = sampled_out
+        if self.sample_rate > 1:
+            self._sampler = Sampler(self.sample_rate, bool(lua_rule.random_sample))
+            if weight is not None:
+                self.action = weighted_action(self.action, weight, self.sample_rate)
+                if self._batch_action is not None:
+                    self._batch_action = weighted_action(
+                        self._batch_action, weight, self.sample_rate
+                    )
+
+    def analyze_line(self, line: Line):
         """Parse a line of input and call the action on match."""
-        match = self._regexp.search(line)
-        if match:
-            values = self._convert_values(match.groupdict())
-            self._action(values)
+        values = self.match(line)
+        if values is None:
+            return
+        if self.batched:
+            self.batch_action([values])
+        else:
+            self.action(values)
+
+    def match(self, line: Line) -> Optional[ActionMatch]:
+        """Return match values if the line matches, None otherwise."""
+        match = self.regexp.search(line)
+        if not match:
+            return None
+        if self._sampler is not None and not self._sampler.select():
+            if self._sampled_out is not None:
+                self._sampled_out.inc()
+            return None
+        if not self.regexp.groupindex:
+            return {}
+        groups = match_groups(match, self._encoding, self._encoding_errors)
+        if self._converters is None:
+            return self._convert_values(groups)
+
+        values: ActionMatch = groups
+        for group, convert in self._converters:
+            value = values[group]
+            if value is not None:
+                try:
+                    values[group] = convert(value)  # type: ignore
+                except ValueError:
+                    pass  # keep the value as a string
+        return values
+
+    def batch_action(self, matches: List[ActionMatch]):
+        """Call the batch action with a list of matches."""
+        if self._batch_action is None:
+            raise TypeError(f'rule "{self.name}" has no batch action')
+        self._batch_action(self._table_from(matches))
 
     def _convert_values(self, match_dict: Dict[str, str]) -> ActionMatch:
         values: ActionMatch = {}
@@ -66,69 +232,681 @@ class LuaFileRule:
         return values
 
 
-class FileAnalyzer(NamedTuple):
-    """An analyzer for a file."""
-
-    path: Path
-    rules: List[LuaFileRule]
+def _group_converters(
+    regexp: Pattern, types: Optional[Dict[str, str]]
+) -> Optional[List[Tuple[str, Callable[[str], Union[str, float]]]]]:
+    """Return a list of (group, converter) for declared group types.
+
+    None is returned if no types are declared.
+
+    """
+    if types is None:
+        return None
+
+    converters = []
+    for group, type_name in types.items():
+        if group not in regexp.groupindex:
+            raise ValueError(f"unknown group: {group}")
+        try:
+            convert = GROUP_TYPES[type_name]
+        except (KeyError, TypeError):
+            raise ValueError(f'unknown type for group "{group}": {type_name}')
+        # conversion to str is a no-op
+        if convert is not str:
+            converters.append((group, convert))
+    return converters
+
+
+def _sample_rate(sample: Any) -> int:
+    """Return the sample rate for a rule, as a positive integer."""
+    if (
+        isinstance(sample, (int, float))
+        and not isinstance(sample, bool)
+        and sample >= 1
+        and sample == int(sample)
+    ):
+        return int(sample)
+    raise ValueError(f"invalid sample rate: {sample}")
+
+
+class DeclarativeRule:
+    """A rule calling a metric method directly, defined in a YAML file.
+
+    Lines are matched by the ``regexp``, and the ``action`` is a Python
+    function, so no Lua code is involved.
+
+    If an ``encoding`` is passed, the regexp must be a bytes pattern, and
+    values for matched groups are decoded.
+
+    """
+
+    batched = False
+    # metrics are updated directly
+    buffer: Optional[MetricsBuffer] = None
+
+    def __init__(
+        self,
+        name: str,
+        regexp: Pattern,
+        action: Callable[[Dict], None],
+        encoding: Optional[str] = None,
+        encoding_errors: str = "strict",
+    ):
+        self.name = name
+        self.regexp = regexp
+        self.action = action
+        self._encoding = encoding
+        self._encoding_errors = encoding_errors
+
+    def match(self, line: Line) -> Optional[Dict[str, str]]:
+        """Return match groups if the line matches, None otherwise."""
+        match = self.regexp.search(line)
+        if not match:
+            return None
+        return match_groups(match, self._encoding, self._encoding_errors)
+
+    def batch_action(self, matches: List[ActionMatch]):
+        """Declarative rules are not batched, so this always fails."""
+        raise TypeError(f'rule "{self.name}" has no batch action')
+
+
+def compile_regexp(regexp: str, encoding: Optional[str] = None) -> Pattern:
+    """Compile a regexp, as a bytes pattern if an encoding is passed."""
+    if encoding is None:
+        return re.compile(regexp)
+    return re.compile(regexp.encode(encoding))
+
+
+def match_groups(
+    match: Match, encoding: Optional[str] = None, encoding_errors: str = "strict"
+) -> Dict[str, Any]:
+    """Return named groups from a match, decoding them if an encoding is passed."""
+    groups = match.groupdict()
+    if encoding is None:
+        return groups
+    return {
+        name: value if value is None else value.decode(encoding, encoding_errors)
+        for name, value in groups.items()
+    }
+
+
+FileRule = Union[LuaFileRule, DeclarativeRule]
+
+
+class AnalyzerRules(NamedTuple):
+    """Rules used by a FileAnalyzer, with their matcher and stats."""
+
+    rules: List[FileRule]
+    matcher: RuleMatcher
+    stats: Optional[Dict[FileRule, RuleStats]] = None
+    # buffers of metric updates from rules, flushed after each batch of lines
+    buffers: Tuple[MetricsBuffer, ...] = ()
+    # whether time spent by rules is recorded in stats
+    timed: bool = False
+
+
+class FileAnalyzer(Loggable):
+    """An analyzer for a file.
+
+    Rules are matched through a :class:`RuleMatcher`, so that only those that
+    can match a line have their regexp checked.
+
+    If ``binary`` is True, lines are bytes, decoded with the ``encoding`` only
+    for values matched by rules.  Otherwise, it's used for decoding lines
+    read from the file.
+
+    Lines longer than ``max_line_length`` (if set) are truncated when read
+    from the file, or dropped if ``drop_long_lines`` is True.
+
+    If a :class:`MultilineConfig` is passed, lines are grouped in records
+    spanning multiple lines before matching rules.  The last record is only
+    matched once the next one starts, or when :meth:`flush` is called.
+
+    The :class:`LookbackConfig`, if passed, is used by watchers to start
+    reading existing content from lines within a time window.
+
+    Errors in rule actions are logged, and don't stop analysis.  In binary
+    mode, matches with values that can't be decoded are logged and skipped.
+    If :class:`Stats` are passed, matches and errors are recorded for each
+    rule, labeled with ``rules_path``, as well as time spent if stats have
+    rule timing enabled.
+
+    Rules can be replaced with :meth:`set_rules` while lines are analyzed.
+
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        rules: List[FileRule],
+        binary: bool = False,
+        encoding: str = "utf-8",
+        encoding_errors: str = "strict",
+        max_line_length: int = 0,
+        drop_long_lines: bool = False,
+        multiline: Optional[MultilineConfig] = None,
+        lookback: Optional[LookbackConfig] = None,
+        rules_path: str = "",
+        stats: Optional[Stats] = None,
+    ):
+        self.path = path
+        self.name = str(path)  # for the logger
+        self.binary = binary
+        self.encoding = encoding
+        self.encoding_errors = encoding_errors
+        self.max_line_length = max_line_length
+        self.drop_long_lines = drop_long_lines
+        self.multiline = multiline
+        self.lookback = lookback
+        self.rules_path = rules_path
+        self._stats = stats
+        self._assembler: Optional[MultilineAssembler] = None
+        if multiline is not None:
+            self._assembler = MultilineAssembler(
+                compile_regexp(multiline.start, encoding if binary else None),
+                multiline.max_lines,
+                multiline.max_length,
+            )
+        self.set_rules(rules)
+
+    @property
+    def rules(self) -> List[FileRule]:
+        """Rules used to analyze lines."""
+        return self._rules.rules
+
+    def set_rules(self, rules: List[FileRule]):
+        """Replace rules used to analyze lines.
+
+        Rules are swapped at once, so a batch of lines being analyzed is
+        entirely processed by either the old or the new rules.
 
-    def analyze_line(self, line: str):
+        """
+        rule_stats = None
+        timed = False
+        if self._stats is not None:
+            rule_stats = {
+                rule: self._stats.rule(self.rules_path, rule.name) for rule in rules
+            }
+            timed = self._stats.rule_timing
+        buffers = tuple(
+            dict.fromkeys(rule.buffer for rule in rules if rule.buffer is not None)
+        )
+        self._rules = AnalyzerRules(
+            rules, RuleMatcher(rules), rule_stats, buffers, timed
+        )
+
+    def analyze_line(self, line: Line):
         """Analyze a line from the file."""
-        for rule in self.rules:
-            rule.analyze_line(line)
+        self.analyze_lines([line])
+
+    def analyze_lines(self, lines: List[Line]):
+        """Analyze a batch of lines from the file.
+
+        Actions for rules are called for each matching line, except for rules
+        with a batch action, which is called once with all matches.
+
+        """
+        if self._assembler is not None:
+            lines = self._assembler.feed(lines)
+        self._match_lines(lines)
+
+    def flush(self):
+        """Analyze the pending multiline record, if any."""
+        if self._assembler is not None:
+            self._match_lines(self._assembler.flush())
+
+    def _match_lines(self, lines: List[Line]):
+        """Match lines against rules, calling actions.
+
+        Buffered metric updates from actions are applied at the end.
+
+        """
+        _, matcher, rule_stats, buffers, timed = self._rules
+        if rule_stats is None:
+            self._analyze_lines(lines, matcher)
+        elif timed:
+            self._analyze_lines_with_timing(lines, matcher, rule_stats)
+        else:
+            self._analyze_lines_with_stats(lines, matcher, rule_stats)
+        for buffer in buffers:
+            buffer.flush()
+
+    def _analyze_lines(self, lines: List[Line], matcher: RuleMatcher):
+        """Match lines against rules, calling actions."""
+        candidates = matcher.candidates
+        batches: Dict[FileRule, List[ActionMatch]] = {}
+        for line in lines:
+            for rule in candidates(line):
+                try:
+                    values = rule.match(line)
+                except UnicodeDecodeError as error:
+                    self._decode_failed(rule, error)
+                    continue
+                if values is None:
+                    continue
+                if rule.batched:
+                    batches.setdefault(rule, []).append(values)
+                else:
+                    try:
+                        rule.action(values)
+                    except Exception as error:
+                        self._action_failed(rule, error)
+
+        for rule, matches in batches.items():
+            try:
+                rule.batch_action(matches)
+            except Exception as error:
+                self._action_failed(rule, error)
+
+    def _analyze_lines_with_stats(
+        self,
+        lines: List[Line],
+        matcher: RuleMatcher,
+        rule_stats: Dict[FileRule, RuleStats],
+    ):
+        """Analyze lines like _analyze_lines, counting matches and errors."""
+        matches: DefaultDict[FileRule, int] = defaultdict(int)
+        candidates = matcher.candidates
+        batches: Dict[FileRule, List[ActionMatch]] = {}
+        for line in lines:
+            for rule in candidates(line):
+                try:
+                    values = rule.match(line)
+                except UnicodeDecodeError as error:
+                    self._decode_failed(rule, error)
+                    continue
+                if values is None:
+                    continue
+                matches[rule] += 1
+                if rule.batched:
+                    batches.setdefault(rule, []).append(values)
+                else:
+                    try:
+                        rule.action(values)
+                    except Exception as error:
+                        self._action_failed(rule, error)
+                        rule_stats[rule].action_errors.inc()
+
+        for rule, batch in batches.items():
+            try:
+                rule.batch_action(batch)
+            except Exception as error:
+                self._action_failed(rule, error)
+                rule_stats[rule].action_errors.inc()
+
+        for rule, count in matches.items():
+            rule_stats[rule].matches.inc(count)
+
+    def _analyze_lines_with_timing(
+        self,
+        lines: List[Line],
+        matcher: RuleMatcher,
+        rule_stats: Dict[FileRule, RuleStats],
+    ):
+        """Analyze lines like _analyze_lines, recording stats and time spent."""
+        timer = time.perf_counter
+        regexp_seconds: DefaultDict[FileRule, float] = defaultdict(float)
+        action_seconds: DefaultDict[FileRule, float] = defaultdict(float)
+        matches: DefaultDict[FileRule, int] = defaultdict(int)
+        errors: DefaultDict[FileRule, int] = defaultdict(int)
+
+        def call_action(rule: FileRule, action: Callable, values: Any):
+            start = timer()
+            try:
+                action(values)
+            except Exception as error:
+                self._action_failed(rule, error)
+                errors[rule] += 1
+            action_seconds[rule] += timer() - start
+
+        candidates = matcher.candidates
+        batches: Dict[FileRule, List[ActionMatch]] = {}
+        for line in lines:
+            for rule in candidates(line):
+                start = timer()
+                try:
+                    values = rule.match(line)
+                except UnicodeDecodeError as error:
+                    self._decode_failed(rule, error)
+                    values = None
+                regexp_seconds[rule] += timer() - start
+                if values is None:
+                    continue
+                matches[rule] += 1
+                if rule.batched:
+                    batches.setdefault(rule, []).append(values)
+                else:
+                    call_action(rule, rule.action, values)
+
+        for rule, batch in batches.items():
+            call_action(rule, rule.batch_action, batch)
+
+        for rule, seconds in regexp_seconds.items():
+            stats = rule_stats[rule]
+            stats.regexp_seconds.inc(seconds)
+            stats.matches.inc(matches[rule])
+            stats.action_seconds.inc(action_seconds[rule])
+            stats.action_errors.inc(errors[rule])
+
+    def _action_failed(self, rule: FileRule, error: Exception):
+        self.logger.warning(f'action for rule "{rule.name}" failed: {error}')
+
+    def _decode_failed(self, rule: FileRule, error: UnicodeDecodeError):
+        self.logger.warning(
+            f'invalid match for rule "{rule.name}", not decoded: {error}'
+        )
+
+
+# Key for rules loaded from a file, with decoding for binary mode and the Lua
+# runtime
+RulesKey = Tuple[Path, Optional[str], str, str]
 
 
 class RuleRegistry(Loggable):
-    """A registry for rules to match log files content."""
+    """A registry for rules to match log files content.
+
+    If :class:`Stats` are passed, analyzers record stats for rules.
+
+    Lua rules are run in the runtime with the specified name.  If it's not
+    available, a warning is logged and the default runtime is used.
+
+    Rule files can be reloaded with :meth:`reload_rules`, which replaces rules
+    in analyzers returned by the registry.
+
+    If ``buffer_updates`` is True, counter increments and observations from
+    Lua rules are buffered, and applied once for each batch of lines.
 
-    def __init__(self, metrics: Dict[str, Metric]):
+    """
+
+    def __init__(
+        self,
+        metrics: Dict[str, Metric],
+        stats: Optional[Stats] = None,
+        buffer_updates: bool = False,
+    ):
         self._metrics = metrics
-        self._rules_by_file: Dict[Path, List[LuaFileRule]] = {}
+        self._stats = stats
+        self._buffer_updates = buffer_updates
+        # rules are cached by file, decoding for binary mode and Lua runtime
+        self._rules_by_file: Dict[RulesKey, List[FileRule]] = {}
+        # status of rule files when they were loaded, to detect changes
+        self._file_status: Dict[Path, Tuple[int, int, int]] = {}
+        self._analyzers: List[Tuple[RulesKey, FileAnalyzer]] = []
+        # lupa modules providing Lua runtimes, by name
+        self._lua_runtimes: Dict[str, ModuleType] = {}
+
+    @property
+    def rule_paths(self) -> List[Path]:
+        """Paths of loaded rule files."""
+        return sorted(self._file_status)
+
+    def get_file_analyzer(
+        self,
+        path: Path,
+        rule_path: str,
+        binary: bool = False,
+        encoding: str = "utf-8",
+        encoding_errors: str = "strict",
+        lua_runtime: str = DEFAULT_LUA_RUNTIME,
+        max_line_length: int = 0,
+        drop_long_lines: bool = False,
+        multiline: Optional[MultilineConfig] = None,
+        lookback: Optional[LookbackConfig] = None,
+    ) -> FileAnalyzer:
+        """Return a FileAnalyzer.
+
+        If ``binary`` is True, rules match bytes lines.
 
-    def get_file_analyzer(self, path: Path, rule_path: str) -> FileAnalyzer:
-        """Return a FileAnalyzer."""
-        rules = self._load_rules_from_file(Path(rule_path))
-        return FileAnalyzer(Path(path), rules)
+        """
+        key = (
+            Path(rule_path),
+            encoding if binary else None,
+            encoding_errors,
+            lua_runtime,
+        )
+        rules = self._load_rules_from_file(*key)
+        analyzer = FileAnalyzer(
+            Path(path),
+            rules,
+            binary=binary,
+            encoding=encoding,
+            encoding_errors=encoding_errors,
+            max_line_length=max_line_length,
+            drop_long_lines=drop_long_lines,
+            multiline=multiline,
+            lookback=lookback,
+            rules_path=str(rule_path),
+            stats=self._stats,
+        )
+        self._analyzers.append((key, analyzer))
+        return analyzer
+
+    def get_file_analyzers(self, files: Dict[Path, FileConfig]) -> List[FileAnalyzer]:
+        """Return FileAnalyzers for the specified file/config map."""
+        return [
+            self.get_file_analyzer(
+                path,
+                config.rules,
+                binary=config.binary,
+                encoding=config.encoding,
+                encoding_errors=config.encoding_errors,
+                lua_runtime=config.lua_runtime,
+                max_line_length=config.max_line_length,
+                drop_long_lines=config.long_lines == "drop",
+                multiline=config.multiline,
+                lookback=config.lookback,
+            )
+            for path, config in files.items()
+        ]
+
+    def reload_rules(self) -> List[Path]:
+        """Reload rule files changed since they were loaded.
+
+        Analyzers using rules from a changed file are switched to the new
+        rules, keeping metrics untouched.  If a file can't be loaded, the error
+        is logged and its current rules are kept.
+
+        Paths for reloaded files are returned.
 
-    def _load_rules_from_file(self, path: Path) -> List[LuaFileRule]:
+        """
+        reloaded = []
+        for path in self.rule_paths:
+            try:
+                status = _file_status(path)
+                if status == self._file_status[path]:
+                    continue
+                self._reload_file(path, status)
+            except Exception as error:
+                # besides syntax errors, running Lua code or defining rules
+                # can fail in any way
+                self.logger.error(f"failed reloading rules from {path}: {error}")
+                continue
+            reloaded.append(path)
+        return reloaded
+
+    def _reload_file(self, path: Path, status: Tuple[int, int, int]):
+        """Reload rules from a file, replacing them in analyzers."""
+        # all variants are loaded before replacing any, so that a failure
+        # doesn't leave analyzers with rules from different versions
+        new_rules = {
+            key: self._get_rules_from_file(path, self._metrics, *key[1:])
+            for key in self._rules_by_file
+            if key[0] == path
+        }
+        self._rules_by_file.update(new_rules)
+        self._file_status[path] = status
+        for key, analyzer in self._analyzers:
+            rules = new_rules.get(key)
+            if rules is not None:
+                analyzer.set_rules(rules)
+        rules_count = len(next(iter(new_rules.values())))
+        self.logger.info(f"reloaded {rules_count} rule(s) from {path}")
+
+    def _load_rules_from_file(
+        self,
+        path: Path,
+        encoding: Optional[str] = None,
+        encoding_errors="strict",
+        lua_runtime: str = DEFAULT_LUA_RUNTIME,
+    ) -> List[FileRule]:
         """Parse a rule files and return a list of Rules."""
-        rules = self._rules_by_file.get(path)
+        key = (path, encoding, encoding_errors, lua_runtime)
+        rules = self._rules_by_file.get(key)
 
         if not rules:
-            lua_rules = self._get_rules_from_file(path, self._metrics)
-            self.logger.info(f"loaded {len(lua_rules)} rule(s) from {path}")
-            rules = [
-                LuaFileRule(name, lua_rule) for name, lua_rule in lua_rules.items()
-            ]
-            self._rules_by_file[path] = rules
+            # status is taken before reading, so that later changes are caught
+            status = _file_status(path)
+            rules = self._get_rules_from_file(
+                path, self._metrics, encoding, encoding_errors, lua_runtime
+            )
+            self.logger.info(f"loaded {len(rules)} rule(s) from {path}")
+            self._rules_by_file[key] = rules
+            self._file_status.setdefault(path, status)
 
         return rules
 
     def _get_rules_from_file(
-        self, path: Path, metrics: Dict[str, Metric]
-    ) -> Dict[str, LuaRule]:
-        """Return rules from a file."""
-        lua = lupa.LuaRuntime(unpack_returned_tuples=True, register_builtins=False)
+        self,
+        path: Path,
+        metrics: Dict[str, Metric],
+        encoding: Optional[str] = None,
+        encoding_errors: str = "strict",
+        lua_runtime: str = DEFAULT_LUA_RUNTIME,
+    ) -> List[FileRule]:
+        """Return rules from a file.
+
+        If an encoding is passed, rules match bytes lines.
+
+        """
+        if path.suffix in DECLARATIVE_SUFFIXES:
+            return list(
+                self._get_declarative_rules(path, metrics, encoding, encoding_errors)
+            )
+        return list(
+            self._get_lua_rules(path, metrics, encoding, encoding_errors, lua_runtime)
+        )
+
+    def _get_lua_rules(
+        self,
+        path: Path,
+        metrics: Dict[str, Metric],
+        encoding: Optional[str],
+        encoding_errors: str,
+        lua_runtime: str = DEFAULT_LUA_RUNTIME,
+    ) -> List[LuaFileRule]:
+        """Return rules from a Lua file."""
+        lua_module = self._get_lua_module(lua_runtime)
+        lua = lua_module.LuaRuntime(
+            unpack_returned_tuples=True, register_builtins=False
+        )
         g = lua.globals()
         # fill in globals
         g.print = self._lua_print(path)
+        buffer = None
+        if self._buffer_updates:
+            buffer = MetricsBuffer()
+            metrics = buffer_metrics(metrics, buffer)
         g.Rule = LuaRule
-        g.metrics = metrics
+        # whether rules are sampled is only known after the file runs, and
+        # code can keep references to metrics while it runs, so metrics with
+        # scaled counters are installed first
+        weight = SampleWeight()
+        g.metrics = scale_counters(metrics, weight)
         g.rules = {}  # to hold exported rules
         with path.open() as fd:
             try:
                 lua.execute(fd.read())
-            except lupa.LuaSyntaxError as error:
+            except lua_module.LuaError as error:
+                # each lupa module has its own exceptions, and syntax errors
+                # are a subclass of LuaError
                 raise RuleSyntaxError(path, str(error))
+            except ValueError as error:
+                # raised when creating rules with invalid arguments
+                raise RuleSyntaxError(path, f": {error}")
 
-        rules = {}
+        rules = []
         for name, rule in g.rules.items():
             if not rule.regexp:
                 self.logger.warning(f'skipped rule "{name}" with empty regexp')
-            else:
-                rules[name] = rule
+                continue
+            try:
+                rules.append(
+                    LuaFileRule(
+                        name,
+                        rule,
+                        table_from=lua.table_from,
+                        encoding=encoding,
+                        encoding_errors=encoding_errors,
+                        weight=weight,
+                        sampled_out=self._sampled_out_counter(path, name),
+                        buffer=buffer,
+                    )
+                )
+            except ValueError as error:
+                raise RuleSyntaxError(path, f': rule "{name}": {error}')
+        if not any(rule.sample_rate > 1 for rule in rules):
+            # actions looking up metrics when called can skip scaling
+            g.metrics = metrics
+        return rules
+
+    def _sampled_out_counter(self, path: Path, name: str) -> Optional[Any]:
+        """Return the counter for matches of a rule skipped by sampling."""
+        if self._stats is None:
+            return None
+        return self._stats.rule_sampled_out.labels(str(path), name)
+
+    def _get_declarative_rules(
+        self,
+        path: Path,
+        metrics: Dict[str, Metric],
+        encoding: Optional[str],
+        encoding_errors: str,
+    ) -> List[DeclarativeRule]:
+        """Return rules from a YAML file."""
+        with path.open() as fd:
+            try:
+                content = yaml.safe_load(fd)
+            except yaml.YAMLError as error:
+                raise RuleSyntaxError(path, f": {error}")
+
+        if not isinstance(content, dict) or not isinstance(content.get("rules"), dict):
+            raise RuleSyntaxError(path, ': a "rules" mapping is required')
+
+        rules = []
+        for name, config in content["rules"].items():
+            try:
+                rules.append(
+                    _declarative_rule(name, config, metrics, encoding, encoding_errors)
+                )
+            except ValueError as error:
+                raise RuleSyntaxError(path, f': rule "{name}": {error}')
         return rules
 
+    def _get_lua_module(self, name: str) -> ModuleType:
+        """Return the lupa module for a Lua runtime, falling back to the default.
+
+        The module provides the ``LuaRuntime`` class and exceptions for it.
+
+        """
+        lua_module = self._lua_runtimes.get(name)
+        if lua_module is not None:
+            return lua_module
+
+        lua_module = lupa
+        if name != DEFAULT_LUA_RUNTIME:
+            for module_name in LUA_RUNTIME_MODULES.get(name, (name,)):
+                try:
+                    lua_module = importlib.import_module(f"lupa.{module_name}")
+                except ImportError:
+                    continue
+                break
+            else:
+                self.logger.warning(
+                    f'Lua runtime "{name}" not available, using the default one'
+                )
+        self._lua_runtimes[name] = lua_module
+        return lua_module
+
     def _lua_print(self, path: Path) -> Callable:
         """Substitute for lua print which logs instead."""
         logger = logging.getLogger(f"lmetrics.rule[{path}]")
@@ -136,11 +914,93 @@ class RuleRegistry(Loggable):
 
 
 def create_file_analyzers(
-    file_rules_names_map: Dict[Path, str], metrics: Dict[str, Metric]
+    files: Dict[Path, FileConfig],
+    metrics: Dict[str, Metric],
+    stats: Optional[Stats] = None,
 ) -> List[FileAnalyzer]:
-    """Return FileAnalyzers for the specified file/rule map."""
-    registry = RuleRegistry(metrics)
-    return [
-        registry.get_file_analyzer(path, rule_filename)
-        for path, rule_filename in file_rules_names_map.items()
-    ]
+    """Return FileAnalyzers for the specified file/config map."""
+    return RuleRegistry(metrics, stats=stats).get_file_analyzers(files)
+
+
+def _file_status(path: Path) -> Tuple[int, int, int]:
+    """Return file details changing when its content does."""
+    stat = path.stat()
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def _declarative_rule(
+    name: str,
+    config: Dict[str, Any],
+    metrics: Dict[str, Metric],
+    encoding: Optional[str] = None,
+    encoding_errors: str = "strict",
+) -> DeclarativeRule:
+    """Return a DeclarativeRule from its config.
+
+    A ValueError is raised if the config is invalid.
+
+    """
+    if not isinstance(config, dict):
+        raise ValueError("must be a mapping")
+    try:
+        regexp = compile_regexp(config["regexp"], encoding)
+    except KeyError:
+        raise ValueError("missing regexp")
+    except (AttributeError, TypeError, re.error) as error:
+        raise ValueError(f"invalid regexp: {error}")
+    try:
+        metric = metrics[config["metric"]]
+    except KeyError:
+        raise ValueError(f"unknown metric: {config.get('metric')}")
+
+    operation = config.get("operation", "inc")
+    if operation not in DECLARATIVE_OPERATIONS or not hasattr(metric, operation):
+        raise ValueError(f"unsupported operation: {operation}")
+    value = config.get("value")
+    if value is None and operation in ("set", "observe"):
+        raise ValueError(f'a value is required for "{operation}"')
+    labels = config.get("labels", {})
+    if not isinstance(labels, dict):
+        raise ValueError("labels must be a mapping")
+    for group in [value, *labels.values()]:
+        if group is not None and group not in regexp.groupindex:
+            raise ValueError(f"unknown group: {group}")
+
+    return DeclarativeRule(
+        name,
+        regexp,
+        _declarative_action(metric, operation, value, labels),
+        encoding=encoding,
+        encoding_errors=encoding_errors,
+    )
+
+
+def _declarative_action(
+    metric: Metric, operation: str, value: Optional[str], labels: Dict[str, str]
+) -> Callable[[Dict], None]:
+    """Return a function calling the metric operation for match groups."""
+    if labels:
+
+        def call(match: Dict[str, str], *args: float):
+            label_values = {
+                label: match[group] or "" for label, group in labels.items()
+            }
+            getattr(metric.labels(**label_values), operation)(*args)
+
+    else:
+        method = getattr(metric, operation)
+
+        def call(match: Dict[str, str], *args: float):
+            method(*args)
+
+    if value is None:
+        return call
+
+    def action(match: Dict[str, str]):
+        try:
+            amount = float(match[value])
+        except (TypeError, ValueError):
+            return  # lines with non-numeric values are ignored
+        call(match, amount)
+
+    return action
@@ -0,0 +1,95 @@
+"""Sampling of rule matches, with scaling of counter increments."""
+
+import random
+import threading
+from typing import (
+    Any,
+    Callable,
+    Dict,
+)
+
+from prometheus_client import Metric
+
+
+class SampleWeight(threading.local):
+    """Weight of the match an action is currently run for.
+
+    While the action of a sampled rule runs, the weight is the sample rate,
+    so that each sampled match stands for that many.
+
+    """
+
+    value = 1
+
+
+class Sampler:
+    """Select one in ``rate`` matches.
+
+    Matches are selected deterministically, every ``rate`` matches, or at
+    random with a 1/``rate`` probability if ``random_sample`` is True.
+
+    """
+
+    def __init__(self, rate: int, random_sample: bool = False):
+        self.rate = rate
+        self._random_sample = random_sample
+        self._probability = 1 / rate
+        self._count = 0
+
+    def select(self) -> bool:
+        """Return whether the next match is selected."""
+        if self._random_sample:
+            return random.random() < self._probability
+        selected = self._count == 0
+        self._count = (self._count + 1) % self.rate
+        return selected
+
+
+class ScaledCounter:
+    """Proxy to a counter, scaling increments by the current sample weight.
+
+    Other attributes are proxied to the counter.
+
+    """
+
+    def __init__(self, metric: Any, weight: SampleWeight):
+        self._metric = metric
+        self._weight = weight
+
+    def inc(self, amount: float = 1):
+        """Increment the counter by the scaled amount."""
+        self._metric.inc(amount * self._weight.value)
+
+    def labels(self, *labelvalues: Any, **labelkwargs: Any) -> "ScaledCounter":
+        """Return the child counter for labels, scaling its increments."""
+        return ScaledCounter(
+            self._metric.labels(*labelvalues, **labelkwargs), self._weight
+        )
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._metric, name)
+
+
+def scale_counters(metrics: Dict[str, Metric], weight: SampleWeight) -> Dict[str, Any]:
+    """Return metrics, wrapping counters in a ScaledCounter."""
+    return {
+        name: ScaledCounter(metric, weight)
+        if getattr(metric, "_type", None) == "counter"
+        else metric
+        for name, metric in metrics.items()
+    }
+
+
+def weighted_action(
+    action: Callable[[Any], Any], weight: SampleWeight, value: int
+) -> Callable[[Any], Any]:
+    """Return a function calling an action with the sample weight set."""
+
+    def call(arg: Any):
+        weight.value = value
+        try:
+            action(arg)
+        finally:
+            weight.value = 1
+
+    return call
@@ -0,0 +1,129 @@
+"""Persistent state for watched files."""
+
+import json
+import os
+from pathlib import Path
+from typing import (
+    Dict,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from toolrack.log import Loggable
+
+
+class FilePosition(NamedTuple):
+    """Read position in a file."""
+
+    device: int
+    inode: int
+    offset: int
+    # whether the file has been read completely, for compressed files which
+    # are not expected to change
+    complete: bool = False
+
+
+class FilePositions(Loggable):
+    """Track read positions in files, saving them to a state file.
+
+    Positions are kept in memory and written to the state file only by
+    :meth:`save`, if they changed since the last time.  The file is replaced
+    atomically.
+
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._positions: Dict[str, FilePosition] = {}
+        self._changed = False
+
+    def load(self):
+        """Load positions from the state file, if it exists."""
+        try:
+            content = self.path.read_text()
+        except FileNotFoundError:
+            return
+
+        try:
+            self._positions = {
+                path: FilePosition(**position)
+                for path, position in json.loads(content).items()
+            }
+        except (ValueError, TypeError, AttributeError):
+            self.logger.warning(f"invalid state file {self.path}, ignoring")
+            return
+        self.logger.debug(f"loaded {len(self._positions)} position(s)")
+
+    def save(self):
+        """Save positions to the state file if they changed."""
+        if not self._changed:
+            return
+
+        data = {path: position._asdict() for path, position in self._positions.items()}
+        tmp_path = self.path.with_name(f".{self.path.name}.tmp")
+        try:
+            with tmp_path.open("w") as fd:
+                json.dump(data, fd)
+                fd.flush()
+                os.fsync(fd.fileno())
+            os.replace(tmp_path, self.path)
+        except OSError as error:
+            self.logger.error(f"failed saving state file: {error}")
+            return
+        self._changed = False
+
+    def get(self, path: Path) -> Optional[FilePosition]:
+        """Return the position for a file, if known."""
+        return self._positions.get(str(path))
+
+    def find(self, device: int, inode: int) -> Optional[Tuple[Path, FilePosition]]:
+        """Return the path and position for a file by its identity, if known."""
+        for path, position in self._positions.items():
+            if (position.device, position.inode) == (device, inode):
+                return Path(path), position
+        return None
+
+    def set(self, path: Path, position: FilePosition):
+        """Set the position for a file."""
+        key = str(path)
+        if self._positions.get(key) != position:
+            self._positions[key] = position
+            self._changed = True
+
+    def remove(self, path: Path):
+        """Remove the position for a file."""
+        if self._positions.pop(str(path), None) is not None:
+            self._changed = True
+
+    def prune(self):
+        """Remove positions for files that no longer exist.
+
+        Positions are kept for files renamed within the same directory, such
+        as by log rotation, so that they can be found by identity.
+
+        """
+        # identities of files in directories, scanned once
+        identities: Dict[str, Set[Tuple[int, int]]] = {}
+        for path, position in list(self._positions.items()):
+            if os.path.exists(path):
+                continue
+            directory = os.path.dirname(path)
+            if directory not in identities:
+                identities[directory] = _file_identities(directory)
+            if (position.device, position.inode) in identities[directory]:
+                continue
+            self.logger.debug(f"file not found, forgetting position: {path}")
+            del self._positions[path]
+            self._changed = True
+
+
+def _file_identities(directory: str) -> Set[Tuple[int, int]]:
+    """Return device and inode for files in a directory."""
+    try:
+        device = os.stat(directory).st_dev
+        with os.scandir(directory) as entries:
+            return {(device, entry.inode()) for entry in entries}
+    except OSError:
+        return set()
@@ -0,0 +1,140 @@
+"""Internal metrics about log files analysis."""
+
+from contextlib import suppress
+from pathlib import Path
+from typing import (
+    Any,
+    NamedTuple,
+)
+
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+)
+
+
+class RuleStats(NamedTuple):
+    """Metrics for a rule."""
+
+    matches: Any
+    action_errors: Any
+    # only set if rules are timed
+    regexp_seconds: Any = None
+    action_seconds: Any = None
+
+
+class Stats:
+    """Metrics about reading and analyzing log files.
+
+    Time spent matching regexps and running actions for each rule is only
+    recorded if ``rule_timing`` is True, since timing each rule adds
+    significant overhead to analysis.
+
+    """
+
+    def __init__(self, registry: CollectorRegistry, rule_timing: bool = False):
+        self.rule_timing = rule_timing
+        self.lines_read = Counter(
+            "lmetrics_lines_read",
+            "Lines read from log files",
+            ["file"],
+            registry=registry,
+        )
+        self.bytes_read = Counter(
+            "lmetrics_bytes_read",
+            "Bytes read from log files",
+            ["file"],
+            registry=registry,
+        )
+        self.read_lag = Gauge(
+            "lmetrics_read_lag_bytes",
+            "Bytes in log files not yet read",
+            ["file"],
+            registry=registry,
+        )
+        self.long_lines = Counter(
+            "lmetrics_long_lines",
+            "Lines from log files longer than the maximum, truncated or dropped",
+            ["file"],
+            registry=registry,
+        )
+        self.inotify_events = Counter(
+            "lmetrics_inotify_events",
+            "Inotify events handled",
+            registry=registry,
+        )
+        self.rule_matches = Counter(
+            "lmetrics_rule_matches",
+            "Lines matched by rules",
+            ["rules", "rule"],
+            registry=registry,
+        )
+        self.rule_action_errors = Counter(
+            "lmetrics_rule_action_errors",
+            "Errors running rule actions",
+            ["rules", "rule"],
+            registry=registry,
+        )
+        if rule_timing:
+            self.rule_regexp_seconds = Counter(
+                "lmetrics_rule_regexp_seconds",
+                "Time spent matching lines against rule regexps",
+                ["rules", "rule"],
+                registry=registry,
+            )
+            self.rule_action_seconds = Counter(
+                "lmetrics_rule_action_seconds",
+                "Time spent running rule actions",
+                ["rules", "rule"],
+                registry=registry,
+            )
+        self.rule_sampled_out = Counter(
+            "lmetrics_rule_sampled_out",
+            "Lines matched by rules, skipped by sampling",
+            ["rules", "rule"],
+            registry=registry,
+        )
+
+        self.series_evictions = Counter(
+            "lmetrics_series_evictions",
+            "Series removed from metrics because of limits",
+            ["metric", "reason"],
+            registry=registry,
+        )
+        self.series_overflows = Counter(
+            "lmetrics_series_overflows",
+            "Updates to series merged in the overflow series because of limits",
+            ["metric"],
+            registry=registry,
+        )
+
+    def file_read(self, path: Path, size: int, lines: int, long_lines: int = 0):
+        """Record data read from a file."""
+        self.bytes_read.labels(str(path)).inc(size)
+        self.lines_read.labels(str(path)).inc(lines)
+        if long_lines:
+            self.long_lines.labels(str(path)).inc(long_lines)
+
+    def file_lag(self, path: Path, lag: int):
+        """Record the size of content not yet read from a file."""
+        self.read_lag.labels(str(path)).set(lag)
+
+    def forget_file(self, path: Path):
+        """Stop reporting the read lag for a file which is no longer read."""
+        with suppress(KeyError):
+            self.read_lag.remove(str(path))
+
+    def rule(self, rules_path: str, name: str) -> RuleStats:
+        """Return metrics for a rule."""
+        labels = (rules_path, name)
+        stats = RuleStats(
+            self.rule_matches.labels(*labels),
+            self.rule_action_errors.labels(*labels),
+        )
+        if not self.rule_timing:
+            return stats
+        return stats._replace(
+            regexp_seconds=self.rule_regexp_seconds.labels(*labels),
+            action_seconds=self.rule_action_seconds.labels(*labels),
+        )
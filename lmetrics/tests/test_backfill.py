@@ -0,0 +1,167 @@
+import logging
+import multiprocessing
+from pathlib import Path
+import signal
+
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+)
+import pytest
+
+from ..backfill import (
+    Backfill,
+    BackfillResult,
+    line_ranges,
+)
+from ..watch import LineStream
+from ..workers import MergedCollector
+
+
+class CountingAnalyzer:
+    """Count lines in a counter, and set a gauge to the last line number."""
+
+    def __init__(self):
+        self.registry = CollectorRegistry()
+        self.counter = Counter("lines", "Lines", registry=self.registry)
+        self.gauge = Gauge("last", "Last line", registry=self.registry)
+
+    def analyze_lines(self, lines):
+        self.counter.inc(len(lines))
+        if lines:
+            self.gauge.set(int(lines[-1].split()[-1]))
+
+
+def create_analyzer():
+    analyzer = CountingAnalyzer()
+    return analyzer, analyzer.registry
+
+
+def failing_analyzer():
+    raise RuntimeError("boom")
+
+
+def samples(collector):
+    return {
+        sample.name: sample.value
+        for family in collector.collect()
+        for sample in family.samples
+        if not sample.name.endswith("_created")
+    }
+
+
+@pytest.fixture
+def log_file(tmpdir):
+    path = Path(tmpdir / "file.log")
+    path.write_text("".join(f"line {number}\n" for number in range(100)), "utf-8")
+    yield path
+
+
+@pytest.fixture
+def collector():
+    yield MergedCollector()
+
+
+class TestLineRanges:
+    def test_ranges(self):
+        """Data is split in ranges ending after newlines."""
+        data = b"line1\nline2\nline3\nline4\n"
+        assert line_ranges(data, 0, len(data), 2) == [(0, 12), (12, 24)]
+
+    def test_ranges_start_offset(self):
+        """Ranges start at the specified offset."""
+        data = b"line1\nline2\nline3\nline4\n"
+        assert line_ranges(data, 6, len(data), 2) == [(6, 18), (18, 24)]
+
+    def test_ranges_long_lines(self):
+        """Ranges are never split within a line, so fewer can be returned."""
+        data = b"a very long line\nline\n"
+        assert line_ranges(data, 0, len(data), 4) == [(0, 17), (17, 22)]
+
+    def test_ranges_more_than_bytes(self):
+        """If more ranges than bytes are requested, one per line is returned."""
+        data = b"a\nb\n"
+        assert line_ranges(data, 0, len(data), 10) == [(0, 2), (2, 4)]
+
+
+@pytest.mark.asyncio
+class TestBackfill:
+    async def test_run(self, event_loop, log_file, collector):
+        """Ranges are analyzed in processes, and metrics merged."""
+        backfill = Backfill(
+            create_analyzer, collector, processes=3, min_size=10, loop=event_loop
+        )
+        result = await backfill.run(log_file, 0, LineStream)
+        assert result == BackfillResult(log_file.stat().st_size, 100)
+        assert samples(collector) == {"lines_total": 100.0, "last": 99.0}
+
+    async def test_run_from_offset(self, event_loop, log_file, collector):
+        """Content is analyzed from the specified offset."""
+        backfill = Backfill(
+            create_analyzer, collector, processes=2, min_size=10, loop=event_loop
+        )
+        result = await backfill.run(log_file, 70, LineStream)
+        assert result == BackfillResult(log_file.stat().st_size, 90)
+        assert samples(collector)["lines_total"] == 90.0
+
+    async def test_run_partial_line(self, event_loop, log_file, collector):
+        """A partial line at the end of the file is not analyzed."""
+        with log_file.open("a") as fd:
+            fd.write("partial")
+        backfill = Backfill(
+            create_analyzer, collector, processes=2, min_size=10, loop=event_loop
+        )
+        result = await backfill.run(log_file, 0, LineStream)
+        assert result == BackfillResult(log_file.stat().st_size - len("partial"), 100)
+
+    async def test_run_long_lines(self, event_loop, tmpdir, collector):
+        """Long lines are counted."""
+        path = Path(tmpdir / "file.log")
+        path.write_text("line 1\na much longer line 2\n", "utf-8")
+        backfill = Backfill(
+            create_analyzer, collector, processes=1, min_size=10, loop=event_loop
+        )
+        result = await backfill.run(
+            path, 0, lambda: LineStream(max_line_length=10, drop_long_lines=True)
+        )
+        assert result == BackfillResult(path.stat().st_size, 1, 1)
+
+    @pytest.mark.parametrize("start", [0, 2000])
+    async def test_run_too_small(self, event_loop, log_file, collector, start):
+        """Files with less content to read than the minimum are skipped."""
+        backfill = Backfill(create_analyzer, collector, min_size=2000, loop=event_loop)
+        assert await backfill.run(log_file, start, LineStream) is None
+        assert list(collector.collect()) == []
+
+    async def test_run_no_full_line(self, event_loop, tmpdir, collector):
+        """Files without full lines to read are skipped."""
+        path = Path(tmpdir / "file.log")
+        path.write_text("line 1\npartial", "utf-8")
+        backfill = Backfill(create_analyzer, collector, min_size=0, loop=event_loop)
+        assert await backfill.run(path, 7, LineStream) is None
+
+    async def test_run_failed(self, caplog, event_loop, log_file, collector):
+        """If analysis of a range fails, no metric is updated."""
+        caplog.set_level(logging.ERROR)
+        backfill = Backfill(
+            failing_analyzer, collector, processes=2, min_size=10, loop=event_loop
+        )
+        assert await backfill.run(log_file, 0, LineStream) is None
+        assert list(collector.collect()) == []
+        assert (
+            f"backfill failed, reading content instead: {log_file}" in caplog.messages
+        )
+
+    async def test_analyze_range(self, monkeypatch, event_loop, log_file, collector):
+        """Lines in a range are analyzed, and results sent back."""
+        handlers = {}
+        monkeypatch.setattr(signal, "signal", handlers.__setitem__)
+        backfill = Backfill(create_analyzer, collector, chunk_size=16, loop=event_loop)
+        conn, child_conn = multiprocessing.Pipe(duplex=False)
+        backfill.analyze_range(log_file, 0, 70, LineStream, child_conn)
+        lines, long_lines, families = conn.recv()
+        assert (lines, long_lines) == (10, 0)
+        collector.update(0, families)
+        assert samples(collector) == {"lines_total": 10.0, "last": 9.0}
+        assert handlers == {signal.SIGINT: signal.SIG_IGN}
@@ -0,0 +1,181 @@
+import threading
+
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    Summary,
+)
+import pytest
+
+from ..buffer import (
+    buffer_metrics,
+    BufferedCounter,
+    BufferedObserver,
+    MetricsBuffer,
+)
+
+
+@pytest.fixture
+def registry():
+    yield CollectorRegistry()
+
+
+@pytest.fixture
+def buffer():
+    yield MetricsBuffer()
+
+
+class TestBufferedCounter:
+    def test_inc(self, registry, buffer):
+        """Increments are applied on flush."""
+        counter = Counter("counter", "A counter", registry=registry)
+        buffered = BufferedCounter(counter, buffer)
+        buffered.inc()
+        buffered.inc(2)
+        assert counter._value.get() == 0
+        buffer.flush()
+        assert counter._value.get() == 3
+        buffer.flush()
+        assert counter._value.get() == 3
+
+    def test_inc_labels(self, registry, buffer):
+        """Increments are summed for each series."""
+        counter = Counter("counter", "A counter", ["label"], registry=registry)
+        buffered = BufferedCounter(counter, buffer)
+        buffered.labels("foo").inc()
+        buffered.labels(label="foo").inc(2)
+        buffered.labels(1.0).inc()
+        buffer.flush()
+        assert counter.labels("foo")._value.get() == 3
+        assert counter.labels("1.0")._value.get() == 1
+
+    def test_labels_reused(self, registry, buffer):
+        """Proxies for series are reused."""
+        counter = Counter("counter", "A counter", ["label"], registry=registry)
+        buffered = BufferedCounter(counter, buffer)
+        assert buffered.labels("foo") is buffered.labels("foo")
+
+    def test_labels_cache_bounded(self, monkeypatch, registry, buffer):
+        """The number of reused series proxies is bounded."""
+        monkeypatch.setattr("lmetrics.buffer.MAX_CACHED_SERIES", 2)
+        counter = Counter("counter", "A counter", ["label"], registry=registry)
+        buffered = BufferedCounter(counter, buffer)
+        buffered.labels("foo")
+        buffered.labels("bar")
+        buffered.labels("baz")
+        assert list(buffered._series) == [("baz",)]
+
+    @pytest.mark.parametrize(
+        "args,kwargs",
+        [
+            (("foo", "bar"), {}),
+            ((), {"other": "foo"}),
+            (("foo",), {"label": "foo"}),
+        ],
+    )
+    def test_labels_invalid(self, registry, buffer, args, kwargs):
+        """Errors for invalid labels are raised by the metric."""
+        counter = Counter("counter", "A counter", ["label"], registry=registry)
+        with pytest.raises(ValueError):
+            BufferedCounter(counter, buffer).labels(*args, **kwargs)
+
+    def test_labels_no_labelnames(self, registry, buffer):
+        """Labels can't be set for metrics without labels."""
+        counter = Counter("counter", "A counter", registry=registry)
+        with pytest.raises(ValueError):
+            BufferedCounter(counter, buffer).labels()
+
+    def test_labels_chained(self, registry, buffer):
+        """Labels can't be set for a series."""
+        counter = Counter("counter", "A counter", ["label"], registry=registry)
+        with pytest.raises(ValueError):
+            BufferedCounter(counter, buffer).labels("foo").labels("bar")
+
+    def test_inc_missing_labels(self, registry, buffer):
+        """Errors for updates without labels are raised by the metric."""
+        counter = Counter("counter", "A counter", ["label"], registry=registry)
+        with pytest.raises(AttributeError):
+            BufferedCounter(counter, buffer).inc()
+
+    def test_inc_negative(self, registry, buffer):
+        """Counters can't be decremented."""
+        counter = Counter("counter", "A counter", registry=registry)
+        with pytest.raises(ValueError):
+            BufferedCounter(counter, buffer).inc(-1)
+
+    def test_proxy_attributes(self, registry, buffer):
+        """Other attributes are proxied to the metric."""
+        counter = Counter("counter", "A counter", registry=registry)
+        assert BufferedCounter(counter, buffer).describe() == counter.describe()
+
+
+class TestBufferedObserver:
+    def test_observe_summary(self, registry, buffer):
+        """Observations for summaries are applied on flush."""
+        summary = Summary("summary", "A summary", ["label"], registry=registry)
+        buffered = BufferedObserver(summary, buffer)
+        buffered.labels("foo").observe(1)
+        buffered.labels("foo").observe(2.5)
+        assert summary.labels("foo")._count.get() == 0
+        buffer.flush()
+        assert summary.labels("foo")._count.get() == 2
+        assert summary.labels("foo")._sum.get() == 3.5
+
+    def test_observe_histogram(self, registry, buffer):
+        """Observations for histograms are added to buckets on flush."""
+        histogram = Histogram(
+            "histogram", "A histogram", buckets=[1, 5], registry=registry
+        )
+        buffered = BufferedObserver(histogram, buffer)
+        for amount in (0.5, 1, 3, 5, 10, float("nan")):
+            buffered.observe(amount)
+        buffer.flush()
+        expected = Histogram(
+            "expected", "A histogram", buckets=[1, 5], registry=CollectorRegistry()
+        )
+        for amount in (0.5, 1, 3, 5, 10, float("nan")):
+            expected.observe(amount)
+        assert [bucket.get() for bucket in histogram._buckets] == [
+            bucket.get() for bucket in expected._buckets
+        ]
+        assert [bucket.get() for bucket in histogram._buckets] == [2, 2, 1]
+
+    def test_observe_missing_labels(self, registry, buffer):
+        """Errors for updates without labels are raised by the metric."""
+        summary = Summary("summary", "A summary", ["label"], registry=registry)
+        with pytest.raises(AttributeError):
+            BufferedObserver(summary, buffer).observe(1)
+
+
+class TestMetricsBuffer:
+    def test_flush_per_thread(self, registry, buffer):
+        """Updates are flushed by the thread that made them."""
+        counter = Counter("counter", "A counter", registry=registry)
+        buffered = BufferedCounter(counter, buffer)
+        buffered.inc()
+        thread = threading.Thread(target=lambda: (buffered.inc(5), buffer.flush()))
+        thread.start()
+        thread.join()
+        assert counter._value.get() == 5
+        buffer.flush()
+        assert counter._value.get() == 6
+
+
+class TestBufferMetrics:
+    def test_buffer_metrics(self, registry, buffer):
+        """Counters, summaries and histograms are wrapped."""
+        metrics = buffer_metrics(
+            {
+                "counter": Counter("counter", "A counter", registry=registry),
+                "summary": Summary("summary", "A summary", registry=registry),
+                "histogram": Histogram("histogram", "A histogram", registry=registry),
+                "gauge": Gauge("gauge", "A gauge", registry=registry),
+            },
+            buffer,
+        )
+        assert isinstance(metrics["counter"], BufferedCounter)
+        assert isinstance(metrics["summary"], BufferedObserver)
+        assert isinstance(metrics["histogram"], BufferedObserver)
+        assert not isinstance(metrics["gauge"], (BufferedCounter, BufferedObserver))
@@ -0,0 +1,142 @@
+import gzip
+
+from aiohttp.web import (
+    Application,
+    Response,
+)
+import pytest
+
+from ..cache import (
+    accepts_gzip,
+    cached_metrics_middleware,
+    MetricsCache,
+)
+
+
+class FakeClock:
+
+    now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeRender:
+
+    calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return f"metrics {self.calls}\n".encode()
+
+
+@pytest.fixture
+def clock():
+    yield FakeClock()
+
+
+@pytest.fixture
+def render():
+    yield FakeRender()
+
+
+class TestMetricsCache:
+    def test_get_no_cache(self, render):
+        """Without a minimum age, output is rendered every time."""
+        cache = MetricsCache(render)
+        assert cache.get() == b"metrics 1\n"
+        assert cache.get() == b"metrics 2\n"
+
+    def test_get_cached(self, render, clock):
+        """Output is reused until the minimum age is reached."""
+        cache = MetricsCache(render, min_age=10, clock=clock)
+        assert cache.get() == b"metrics 1\n"
+        clock.now = 5
+        cache.invalidate()
+        assert cache.get() == b"metrics 1\n"
+        clock.now = 10
+        assert cache.get() == b"metrics 2\n"
+
+    def test_get_unchanged(self, render, clock):
+        """Output is not rendered again if metrics are unchanged."""
+        cache = MetricsCache(render, min_age=10, clock=clock)
+        cache.get()
+        clock.now = 20
+        assert cache.get() == b"metrics 1\n"
+        cache.invalidate()
+        assert cache.get() == b"metrics 2\n"
+
+    def test_get_max_age(self, render, clock):
+        """Output is rendered again once older than the maximum age."""
+        cache = MetricsCache(render, min_age=10, max_age=30, clock=clock)
+        cache.get()
+        clock.now = 29
+        assert cache.get() == b"metrics 1\n"
+        clock.now = 30
+        assert cache.get() == b"metrics 2\n"
+
+    def test_get_compressed(self, render, clock):
+        """Compressed output is cached too."""
+        cache = MetricsCache(render, min_age=10, clock=clock)
+        compressed = cache.get(compressed=True)
+        assert gzip.decompress(compressed) == b"metrics 1\n"
+        assert cache.get(compressed=True) is compressed
+        assert render.calls == 1
+
+
+class TestAcceptsGzip:
+    @pytest.mark.parametrize(
+        "header,accepted",
+        [
+            ("", False),
+            ("gzip", True),
+            ("deflate, gzip;q=1.0, br", True),
+            ("GZIP", True),
+            ("*", True),
+            ("gzip;q=0", False),
+            ("gzip; q=0.5", True),
+            ("gzip;q=foo", False),
+            ("identity", False),
+        ],
+    )
+    def test_accepts_gzip(self, header, accepted):
+        """Gzip is accepted if listed and not with zero quality."""
+        assert accepts_gzip(header) == accepted
+
+
+@pytest.fixture
+def app(render):
+    cache = MetricsCache(render)
+    app = Application(middlewares=[cached_metrics_middleware(cache)])
+
+    async def handle(request):
+        return Response(text="other")
+
+    app.router.add_get("/", handle)
+    app.router.add_get("/metrics", handle)
+    yield app
+
+
+class TestCachedMetricsMiddleware:
+    async def test_metrics(self, aiohttp_client, app):
+        """Metrics are served from the cache."""
+        client = await aiohttp_client(app)
+        response = await client.get("/metrics", headers={"Accept-Encoding": "identity"})
+        assert response.headers["Content-Type"].startswith("text/plain")
+        assert response.headers["Vary"] == "Accept-Encoding"
+        assert "Content-Encoding" not in response.headers
+        assert await response.text() == "metrics 1\n"
+
+    async def test_metrics_gzip(self, aiohttp_client, app):
+        """Metrics are gzipped if the client accepts it."""
+        client = await aiohttp_client(app)
+        response = await client.get("/metrics", headers={"Accept-Encoding": "gzip"})
+        assert response.headers["Content-Encoding"] == "gzip"
+        # the client decompresses the content
+        assert await response.text() == "metrics 1\n"
+
+    async def test_other_paths(self, aiohttp_client, app):
+        """Other requests are passed to handlers."""
+        client = await aiohttp_client(app)
+        response = await client.get("/")
+        assert await response.text() == "other"
@@ -5,7 +5,15 @@ from prometheus_aioexporter.metric import InvalidMetricType
 import pytest
 import yaml
 
-from ..config import load_config
+from ..config import (
+    FileConfig,
+    InvalidFileConfig,
+    InvalidMetricConfig,
+    load_config,
+    LookbackConfig,
+    MultilineConfig,
+    SeriesLimit,
+)
 
 
 @pytest.fixture
@@ -20,7 +28,165 @@ class TestLoadConfig:
         config_file.write_text(yaml.dump(config))
         with config_file.open() as fd:
             result = load_config(fd)
-        assert result.files == {"file1": "rule1", "file2": "rule2"}
+        assert result.files == {
+            "file1": FileConfig("rule1"),
+            "file2": FileConfig("rule2"),
+        }
+
+    def test_load_files_options(self, config_file):
+        """Options for files can be specified."""
+        config = {
+            "files": {
+                "file1": {"rules": "rule1"},
+                "file2": {
+                    "rules": "rule2",
+                    "binary": True,
+                    "encoding": "latin-1",
+                    "encoding_errors": "replace",
+                    "max_line_length": 1000,
+                    "long_lines": "drop",
+                    "multiline": {"start": "^\\d", "max_lines": 10, "timeout": 0.5},
+                    "lookback": {
+                        "timestamp": "^(\\S+)",
+                        "format": "%Y-%m-%dT%H:%M:%S",
+                        "window": 600,
+                    },
+                },
+            }
+        }
+        config_file.write_text(yaml.dump(config))
+        with config_file.open() as fd:
+            result = load_config(fd)
+        assert result.files == {
+            "file1": FileConfig("rule1"),
+            "file2": FileConfig(
+                "rule2",
+                binary=True,
+                encoding="latin-1",
+                encoding_errors="replace",
+                max_line_length=1000,
+                long_lines="drop",
+                multiline=MultilineConfig("^\\d", max_lines=10, timeout=0.5),
+                lookback=LookbackConfig("^(\\S+)", 600, format="%Y-%m-%dT%H:%M:%S"),
+            ),
+        }
+
+    @pytest.mark.parametrize(
+        "file_config,message",
+        [
+            (["rule"], "must be a rules file or a mapping"),
+            ({"binary": True}, "missing rules"),
+            ({"rules": "rule", "foo": 1, "bar": 2}, "unknown options: bar, foo"),
+            ({"rules": "rule", "encoding": "foo"}, "unknown encoding: foo"),
+            (
+                {"rules": "rule", "encoding_errors": "foo"},
+                "unknown encoding errors: foo",
+            ),
+            ({"rules": "rule", "lua_runtime": "foo"}, "unknown Lua runtime: foo"),
+            (
+                {"rules": "rule", "max_line_length": -1},
+                "max_line_length must be a non-negative integer",
+            ),
+            (
+                {"rules": "rule", "max_line_length": True},
+                "max_line_length must be a non-negative integer",
+            ),
+            (
+                {"rules": "rule", "long_lines": "foo"},
+                'long_lines must be "truncate" or "drop"',
+            ),
+            ({"rules": "rule", "multiline": "^a"}, "multiline must be a mapping"),
+            (
+                {"rules": "rule", "multiline": {"start": "^a", "foo": 1}},
+                "unknown multiline options: foo",
+            ),
+            ({"rules": "rule", "multiline": {}}, "missing multiline start"),
+            (
+                {"rules": "rule", "multiline": {"start": "("}},
+                "invalid multiline start: missing ), unterminated subpattern "
+                "at position 0",
+            ),
+            (
+                {"rules": "rule", "multiline": {"start": "a", "max_lines": 0}},
+                "multiline max_lines must be a positive integer",
+            ),
+            (
+                {"rules": "rule", "multiline": {"start": "a", "max_length": 1.5}},
+                "multiline max_length must be a positive integer",
+            ),
+            (
+                {"rules": "rule", "multiline": {"start": "a", "timeout": "1"}},
+                "multiline timeout must be a positive number",
+            ),
+            ({"rules": "rule", "lookback": "^a"}, "lookback must be a mapping"),
+            (
+                {"rules": "rule", "lookback": {"timestamp": "^a", "foo": 1}},
+                "unknown lookback options: foo",
+            ),
+            (
+                {"rules": "rule", "lookback": {}},
+                "missing lookback options: timestamp, window",
+            ),
+            (
+                {"rules": "rule", "lookback": {"timestamp": "(", "window": 1}},
+                "invalid lookback timestamp: missing ), unterminated subpattern "
+                "at position 0",
+            ),
+            (
+                {"rules": "rule", "lookback": {"timestamp": "a", "window": 0}},
+                "lookback window must be a positive number",
+            ),
+            (
+                {
+                    "rules": "rule",
+                    "lookback": {"timestamp": "a", "window": 1, "format": 1},
+                },
+                "lookback format must be a string",
+            ),
+        ],
+    )
+    def test_load_files_invalid(self, config_file, file_config, message):
+        """An error is raised if the configuration for a file is invalid."""
+        config = {"files": {"file": file_config}}
+        config_file.write_text(yaml.dump(config))
+        with pytest.raises(InvalidFileConfig) as err, config_file.open() as fd:
+            load_config(fd)
+        assert str(err.value) == f"Invalid configuration for file: {message}"
+
+    def test_load_files_lua_runtime(self, config_file):
+        """The Lua runtime can be set globally, and overridden for files."""
+        config = {
+            "lua_runtime": "luajit",
+            "files": {
+                "file1": "rule1",
+                "file2": {"rules": "rule2", "lua_runtime": "lua54"},
+            },
+        }
+        config_file.write_text(yaml.dump(config))
+        with config_file.open() as fd:
+            result = load_config(fd)
+        assert result.files == {
+            "file1": FileConfig("rule1", lua_runtime="luajit"),
+            "file2": FileConfig("rule2", lua_runtime="lua54"),
+        }
+
+    def test_load_files_default_lua_runtime(self, config_file):
+        """The default Lua runtime is used if not specified."""
+        config = {"files": {"file1": "rule1"}}
+        config_file.write_text(yaml.dump(config))
+        with config_file.open() as fd:
+            result = load_config(fd)
+        assert result.files["file1"].lua_runtime == "default"
+
+    def test_load_invalid_lua_runtime(self, config_file):
+        """An error is raised if the global Lua runtime is unknown."""
+        config = {"lua_runtime": "foo", "files": {"file1": "rule1"}}
+        config_file.write_text(yaml.dump(config))
+        with pytest.raises(InvalidFileConfig) as err, config_file.open() as fd:
+            load_config(fd)
+        assert str(err.value) == (
+            "Invalid configuration for files: unknown Lua runtime: foo"
+        )
 
     def test_load_metrics_section(self, config_file):
         """The 'metrics' section is loaded from the config file."""
@@ -45,6 +211,61 @@ class TestLoadConfig:
         assert metric2.description == "metric two"
         assert metric2.config == {"buckets": [10, 100, 1000]}
 
+    def test_load_metrics_limits(self, config_file):
+        """Limits on series can be specified for metrics with labels."""
+        config = {
+            "metrics": {
+                "metric1": {"type": "counter", "labels": ["l"], "max_series": 10},
+                "metric2": {
+                    "type": "gauge",
+                    "labels": ["l"],
+                    "max_series": 10,
+                    "series_ttl": 60,
+                    "on_limit": "overflow",
+                },
+                "metric3": {"type": "gauge", "labels": ["l"]},
+            }
+        }
+        config_file.write_text(yaml.dump(config))
+        with config_file.open() as fd:
+            result = load_config(fd)
+        assert result.limits == {
+            "metric1": SeriesLimit(max_series=10),
+            "metric2": SeriesLimit(max_series=10, ttl=60, overflow=True),
+        }
+        # options are not passed to metrics
+        assert [metric.config for metric in result.metrics] == [{"labels": ["l"]}] * 3
+
+    @pytest.mark.parametrize(
+        "metric_config,message",
+        [
+            ({"max_series": 10}, "series limits require labels"),
+            (
+                {"labels": ["l"], "max_series": 0},
+                "max_series must be a positive integer",
+            ),
+            (
+                {"labels": ["l"], "max_series": True},
+                "max_series must be a positive integer",
+            ),
+            (
+                {"labels": ["l"], "series_ttl": "foo"},
+                "series_ttl must be a positive number",
+            ),
+            (
+                {"labels": ["l"], "max_series": 10, "on_limit": "foo"},
+                'on_limit must be "evict" or "overflow"',
+            ),
+        ],
+    )
+    def test_load_metrics_invalid_limits(self, config_file, metric_config, message):
+        """An error is raised if limits for a metric are invalid."""
+        config = {"metrics": {"metric": {"type": "counter", **metric_config}}}
+        config_file.write_text(yaml.dump(config))
+        with pytest.raises(InvalidMetricConfig) as err, config_file.open() as fd:
+            load_config(fd)
+        assert str(err.value) == f"Invalid configuration for metric metric: {message}"
+
     def test_load_metrics_invalid_type(self, config_file):
         """An error is raised if a metric type is invalid."""
         config = {"metrics": {"metric": {"type": "unknown"}}}
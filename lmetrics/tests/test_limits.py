@@ -0,0 +1,212 @@
+from pathlib import Path
+
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+)
+import pytest
+
+from ..config import SeriesLimit
+from ..limits import (
+    limit_metrics,
+    LimitedMetric,
+    OVERFLOW_LABEL_VALUE,
+)
+from ..rule import RuleRegistry
+from ..stats import Stats
+
+
+class FakeClock:
+
+    now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def registry():
+    yield CollectorRegistry()
+
+
+@pytest.fixture
+def stats():
+    yield Stats(CollectorRegistry())
+
+
+@pytest.fixture
+def counter(registry):
+    yield Counter("requests", "Requests", ["path", "method"], registry=registry)
+
+
+@pytest.fixture
+def clock():
+    yield FakeClock()
+
+
+def series(metric):
+    """Return label values for series of a metric."""
+    [family] = metric.collect()
+    return sorted(
+        (sample.labels["path"], sample.labels["method"])
+        for sample in family.samples
+        if sample.name.endswith("_total")
+    )
+
+
+class TestLimitedMetric:
+    def test_labels(self, counter):
+        """Series are created with labels, by position or name."""
+        metric = LimitedMetric("requests", counter, SeriesLimit(max_series=10))
+        metric.labels("/a", "GET").inc()
+        metric.labels(path="/b", method="POST").inc(2)
+        assert series(counter) == [("/a", "GET"), ("/b", "POST")]
+        assert counter.labels("/b", "POST")._value.get() == 2
+
+    def test_labels_converted_to_string(self, counter):
+        """Label values are converted to strings."""
+        metric = LimitedMetric("requests", counter, SeriesLimit(max_series=1))
+        metric.labels("/a", 200.0).inc()
+        metric.labels("/a", "200.0").inc()
+        assert series(counter) == [("/a", "200.0")]
+
+    @pytest.mark.parametrize(
+        "args,kwargs",
+        [
+            (("/a",), {}),
+            ((), {"path": "/a"}),
+            (("/a",), {"method": "GET"}),
+        ],
+    )
+    def test_labels_invalid(self, counter, args, kwargs):
+        """Errors for invalid labels are raised by the metric."""
+        metric = LimitedMetric("requests", counter, SeriesLimit(max_series=1))
+        with pytest.raises(ValueError):
+            metric.labels(*args, **kwargs)
+
+    def test_evict_least_recently_updated(self, counter, clock, stats):
+        """Over the maximum, the least recently updated series is removed."""
+        metric = LimitedMetric(
+            "requests", counter, SeriesLimit(max_series=2), stats=stats, clock=clock
+        )
+        metric.labels("/a", "GET").inc()
+        metric.labels("/b", "GET").inc()
+        metric.labels("/a", "GET").inc()
+        metric.labels("/c", "GET").inc()
+        assert series(counter) == [("/a", "GET"), ("/c", "GET")]
+        assert stats.series_evictions.labels("requests", "lru")._value.get() == 1
+
+    def test_overflow(self, counter, stats):
+        """Over the maximum, updates can go to the overflow series."""
+        metric = LimitedMetric(
+            "requests",
+            counter,
+            SeriesLimit(max_series=1, overflow=True),
+            stats=stats,
+        )
+        metric.labels("/a", "GET").inc()
+        metric.labels("/b", "GET").inc()
+        metric.labels("/c", "GET").inc()
+        metric.labels("/a", "GET").inc()
+        overflow = (OVERFLOW_LABEL_VALUE, OVERFLOW_LABEL_VALUE)
+        assert series(counter) == [("/a", "GET"), overflow]
+        assert counter.labels(*overflow)._value.get() == 2
+        assert stats.series_overflows.labels("requests")._value.get() == 2
+
+    def test_ttl(self, counter, clock, stats):
+        """Series not updated within the TTL are removed."""
+        metric = LimitedMetric(
+            "requests", counter, SeriesLimit(ttl=10), stats=stats, clock=clock
+        )
+        metric.labels("/a", "GET").inc()
+        clock.now = 5
+        metric.labels("/b", "GET").inc()
+        clock.now = 12
+        metric.labels("/c", "GET").inc()
+        assert series(counter) == [("/b", "GET"), ("/c", "GET")]
+        assert stats.series_evictions.labels("requests", "ttl")._value.get() == 1
+
+    def test_ttl_refreshed_on_update(self, counter, clock):
+        """Updating a series resets its TTL."""
+        metric = LimitedMetric("requests", counter, SeriesLimit(ttl=10), clock=clock)
+        metric.labels("/a", "GET").inc()
+        clock.now = 8
+        metric.labels("/a", "GET").inc()
+        clock.now = 15
+        metric.labels("/b", "GET").inc()
+        assert series(counter) == [("/a", "GET"), ("/b", "GET")]
+
+    def test_ttl_before_max(self, counter, clock):
+        """Expired series are removed before checking the maximum."""
+        metric = LimitedMetric(
+            "requests",
+            counter,
+            SeriesLimit(max_series=1, ttl=10, overflow=True),
+            clock=clock,
+        )
+        metric.labels("/a", "GET").inc()
+        clock.now = 10
+        metric.labels("/b", "GET").inc()
+        assert series(counter) == [("/b", "GET")]
+
+    def test_proxy_attributes(self, registry):
+        """Other attributes are proxied to the metric."""
+        gauge = Gauge("gauge", "A gauge", ["label"], registry=registry)
+        metric = LimitedMetric("gauge", gauge, SeriesLimit(max_series=1))
+        assert metric.describe() == gauge.describe()
+
+
+class TestLimitMetrics:
+    def test_limit_metrics(self, counter, registry):
+        """Only metrics with limits are wrapped."""
+        gauge = Gauge("gauge", "A gauge", registry=registry)
+        metrics = limit_metrics(
+            {"requests": counter, "gauge": gauge},
+            {"requests": SeriesLimit(max_series=1)},
+        )
+        assert isinstance(metrics["requests"], LimitedMetric)
+        assert metrics["gauge"] is gauge
+
+
+class TestLimitedMetricRules:
+    def test_lua_rule(self, tmpdir, counter):
+        """Lua rules use limited metrics."""
+        rule_file = Path(tmpdir / "rules.lua")
+        rule_file.write_text(
+            """
+            rules.rule = Rule([[(?P<method>\\w+) (?P<path>\\S+)]])
+            function rules.rule.action(match)
+              metrics.requests.labels(match.path, match.method).inc()
+            end
+            """
+        )
+        metrics = limit_metrics(
+            {"requests": counter}, {"requests": SeriesLimit(max_series=1)}
+        )
+        analyzer = RuleRegistry(metrics).get_file_analyzer("file.log", rule_file)
+        analyzer.analyze_lines(["GET /a", "GET /b"])
+        assert series(counter) == [("/b", "GET")]
+
+    def test_declarative_rule(self, tmpdir, counter):
+        """Declarative rules use limited metrics."""
+        rule_file = Path(tmpdir / "rules.yaml")
+        rule_file.write_text(
+            """
+            rules:
+              requests:
+                regexp: '(?P<method>\\w+) (?P<path>\\S+)'
+                metric: requests
+                labels:
+                  method: method
+                  path: path
+            """
+        )
+        metrics = limit_metrics(
+            {"requests": counter},
+            {"requests": SeriesLimit(max_series=1, overflow=True)},
+        )
+        analyzer = RuleRegistry(metrics).get_file_analyzer("file.log", rule_file)
+        analyzer.analyze_lines(["GET /a", "GET /b"])
+        overflow = (OVERFLOW_LABEL_VALUE, OVERFLOW_LABEL_VALUE)
+        assert series(counter) == [("/a", "GET"), overflow]
@@ -0,0 +1,198 @@
+from datetime import (
+    datetime,
+    timezone,
+)
+import re
+
+import pytest
+
+from ..lookback import (
+    Lookback,
+    TimestampParser,
+)
+
+# 2020-01-01 00:00:00 UTC
+START = datetime(2020, 1, 1, tzinfo=timezone.utc).timestamp()
+
+
+@pytest.fixture
+def parse():
+    yield TimestampParser(re.compile(r"^\S+"))
+
+
+@pytest.fixture
+def log_file(tmpdir):
+    path = tmpdir / "file.log"
+    path.write_text(
+        "".join(
+            f"2020-01-01T00:{minute:02}:00+00:00 line {minute}\n"
+            for minute in range(60)
+        ),
+        "utf-8",
+    )
+    yield path
+
+
+def lookback_at(parse, now, window):
+    return Lookback(parse, window, clock=lambda: START + now)
+
+
+def line_at(path, offset):
+    with path.open("rb") as fd:
+        fd.seek(offset)
+        return fd.readline()
+
+
+class TestTimestampParser:
+    def test_iso(self, parse):
+        """Timestamps are parsed as ISO 8601 by default."""
+        assert parse(b"2020-01-01T00:01:00+00:00 foo") == START + 60
+
+    def test_format(self):
+        """Timestamps can be parsed with a format, from the first group."""
+        parse = TimestampParser(
+            re.compile(r"\[([^]]+)\]"), format="%d/%b/%Y:%H:%M:%S %z"
+        )
+        assert parse(b"host [01/Jan/2020:00:00:10 +0000] GET /") == START + 10
+
+    def test_local_time(self):
+        """Timestamps without a timezone are in local time."""
+        parse = TimestampParser(re.compile(r"^\S+"))
+        assert parse(b"2020-01-01T00:00:00 foo") == datetime(2020, 1, 1).timestamp()
+
+    def test_encoding(self):
+        """Lines are decoded with the encoding."""
+        parse = TimestampParser(
+            re.compile(r"^(\S+) é"), encoding="latin-1", format="%Y-%m-%dT%H:%M:%S%z"
+        )
+        assert parse("2020-01-01T00:00:00+0000 é".encode("latin-1")) == START
+
+    @pytest.mark.parametrize(
+        "line,timestamp",
+        [
+            (b"2020-01-01T00:01:00Z", START + 60),
+            (b"2020-01-01 00:01:00+0000", START + 60),
+            (b"2020-01-01T02:01:00+02:00", START + 60),
+            (b"2019-12-31T23:31:00-00:30", START + 60),
+            (b"2020-01-01T00:01Z", START + 60),
+            (b"2020-01-01T00:00:01.5Z", START + 1.5),
+            (b"2020-01-01T00:00:01,123456789Z", START + 1.123456),
+        ],
+    )
+    def test_iso_variants(self, line, timestamp):
+        """ISO 8601 timestamps can have different precisions and timezones."""
+        parse = TimestampParser(re.compile(r"^.+"))
+        assert parse(line) == pytest.approx(timestamp, abs=1e-6)
+
+    @pytest.mark.parametrize(
+        "line",
+        [
+            b"foo bar",
+            b"",
+            b"  at foo",
+            b"2020-13-01T00:00:00Z",
+            b"2020-01-01T00:00:00+1",
+            b"2020-01-01",
+        ],
+    )
+    def test_no_timestamp(self, parse, line):
+        """None is returned for lines without a valid timestamp."""
+        assert parse(line) is None
+
+
+class TestLookback:
+    def test_find_start(self, parse, log_file):
+        """The offset of the first line within the window is returned."""
+        lookback = lookback_at(parse, 3600, 600)
+        with log_file.open("rb") as fd:
+            offset = lookback.find_start(fd)
+        assert line_at(log_file, offset) == b"2020-01-01T00:50:00+00:00 line 50\n"
+
+    @pytest.mark.parametrize("now,minute", [(59 * 60 + 30, 59), (120, 1), (3000, 49)])
+    def test_find_start_boundaries(self, parse, log_file, now, minute):
+        """Lines at the start of the window are included."""
+        lookback = lookback_at(parse, now, 60)
+        with log_file.open("rb") as fd:
+            offset = lookback.find_start(fd)
+        expected = f"2020-01-01T00:{minute:02}:00+00:00 line {minute}\n"
+        assert line_at(log_file, offset) == expected.encode()
+
+    def test_find_start_all_lines(self, parse, log_file):
+        """If all lines are within the window, the file is read from the start."""
+        lookback = lookback_at(parse, 3600, 7200)
+        with log_file.open("rb") as fd:
+            assert lookback.find_start(fd) == 0
+
+    def test_find_start_no_lines(self, parse, log_file):
+        """If no line is within the window, the end of the file is returned."""
+        lookback = lookback_at(parse, 7200, 60)
+        with log_file.open("rb") as fd:
+            assert lookback.find_start(fd) == log_file.size()
+
+    def test_find_start_empty_file(self, parse, tmpdir):
+        """For an empty file, the start is returned."""
+        path = tmpdir / "file.log"
+        path.write_text("", "utf-8")
+        with path.open("rb") as fd:
+            assert lookback_at(parse, 0, 60).find_start(fd) == 0
+
+    def test_find_start_partial_line(self, parse, tmpdir):
+        """The last line is not used if it's not complete."""
+        path = tmpdir / "file.log"
+        path.write_text(
+            "2020-01-01T00:00:00+00:00 old\n2020-01-01T00:10:00+00:00 new",
+            "utf-8",
+        )
+        with path.open("rb") as fd:
+            assert lookback_at(parse, 600, 60).find_start(fd) == 30
+
+    def test_find_start_long_partial_line(self, parse, tmpdir, monkeypatch):
+        """The end of the last line is found even if it's far from the end."""
+        monkeypatch.setattr("lmetrics.lookback.BLOCK_SIZE", 8)
+        path = tmpdir / "file.log"
+        path.write_text(
+            "2020-01-01T00:00:00+00:00 old\n" + "x" * 50,
+            "utf-8",
+        )
+        with path.open("rb") as fd:
+            assert lookback_at(parse, 600, 60).find_start(fd) == 30
+
+    def test_find_start_no_newline(self, parse, tmpdir):
+        """If the file has no full line, the start is returned."""
+        path = tmpdir / "file.log"
+        path.write_text("2020-01-01T00:10:00+00:00 partial", "utf-8")
+        with path.open("rb") as fd:
+            assert lookback_at(parse, 600, 60).find_start(fd) == 0
+
+    def test_find_start_lines_without_timestamp(self, parse, tmpdir):
+        """Lines without a timestamp are skipped, and kept with their record."""
+        path = tmpdir / "file.log"
+        content = "".join(
+            f"2020-01-01T00:{minute:02}:00+00:00 error\n  at foo\n  at bar\n"
+            for minute in range(30)
+        )
+        path.write_text(content, "utf-8")
+        with path.open("rb") as fd:
+            offset = lookback_at(parse, 1800, 300).find_start(fd)
+        assert line_at(path, offset) == b"2020-01-01T00:25:00+00:00 error\n"
+        assert content[offset:].count("error") == 5
+
+    def test_find_start_no_timestamps(self, log_file):
+        """If no timestamp can be parsed, None is returned."""
+        parse = TimestampParser(re.compile(r"^\S+"), format="%d/%m/%Y")
+        with log_file.open("rb") as fd:
+            assert lookback_at(parse, 3600, 1e9).find_start(fd) is None
+
+    def test_find_start_reads_few_lines(self, log_file):
+        """Only a few lines are parsed to find the start."""
+        parsed = []
+        parse = TimestampParser(re.compile(r"^\S+"))
+
+        def tracking_parse(line):
+            parsed.append(line)
+            return parse(line)
+
+        lookback = lookback_at(tracking_parse, 3600, 600)
+        with log_file.open("rb") as fd:
+            lookback.find_start(fd)
+        assert len(parsed) <= 8
@@ -1,11 +1,18 @@
+import asyncio
 from io import StringIO
+import json
+import os
 from pathlib import Path
+import signal
 
+from prometheus_aioexporter.web import PrometheusExporter
 import pytest
 from toolrack.script import ErrorExitMessage
 import yaml
 
+from .. import main
 from ..main import LMetricsScript
+from ..state import FilePosition
 
 
 @pytest.fixture
@@ -57,6 +64,276 @@ class TestLMetricsScript:
         assert len(script.watchers) == 1
         assert script.watchers[0].name.endswith("file1")
 
+    def test_configure_stats(self, script, config_file):
+        """Internal metrics are registered and passed to watchers."""
+        args = script.get_parser().parse_args([str(config_file)])
+        script.configure(args)
+        assert script.watchers[0]._stats is script.stats
+        text = script.registry.generate_metrics().decode()
+        assert "lmetrics_inotify_events_total" in text
+
+    def test_configure_read_chunk_size(self, script, config_file):
+        """The read chunk size for watchers can be specified."""
+        args = script.get_parser().parse_args(
+            [str(config_file), "--read-chunk-size", "1024"]
+        )
+        script.configure(args)
+        assert script.watchers[0]._chunk_size == 1024
+
+    @pytest.mark.parametrize("size", ["0", "-1"])
+    def test_configure_invalid_read_chunk_size(self, capsys, script, config_file, size):
+        """The read chunk size must be a positive integer."""
+        with pytest.raises(SystemExit):
+            script.get_parser().parse_args(
+                [str(config_file), "--read-chunk-size", size]
+            )
+        assert f"invalid chunk size: {size}" in capsys.readouterr().err
+
+    def test_configure_state_file(self, tmpdir, script, config_file):
+        """If a state file is specified, positions are loaded from it."""
+        log_file = Path(tmpdir / "file.txt")
+        log_file.write_text("")
+        state_file = Path(tmpdir / "state.json")
+        position = {"device": 1, "inode": 2, "offset": 3}
+        state_file.write_text(
+            json.dumps({str(log_file): position, "/not/found.txt": position})
+        )
+        args = script.get_parser().parse_args(
+            [str(config_file), "--state-file", str(state_file)]
+        )
+        script.configure(args)
+        assert script.positions.get(log_file).offset == 3
+        # positions for files that don't exist are dropped
+        assert script.positions.get(Path("/not/found.txt")) is None
+        assert script.watchers[0]._positions is script.positions
+
+    def test_configure_analysis_threads(self, script, config_file):
+        """If analysis threads are requested, an executor is used."""
+        args = script.get_parser().parse_args(
+            [str(config_file), "--analysis-threads", "2"]
+        )
+        script.configure(args)
+        assert script.executor._max_workers == 2
+        assert script.watchers[0]._executor is script.executor
+        script.executor.shutdown()
+
+    def test_configure_coalesce_interval(self, script, config_file):
+        """The interval for coalescing file changes can be specified."""
+        args = script.get_parser().parse_args(
+            [str(config_file), "--coalesce-interval", "0.5"]
+        )
+        script.configure(args)
+        assert script.watchers[0]._coalesce_interval == 0.5
+
+    def test_configure_no_analysis_threads(self, script, config_file):
+        """By default, lines are analyzed in the main loop."""
+        args = script.get_parser().parse_args([str(config_file)])
+        script.configure(args)
+        assert script.executor is None
+        assert script.watchers[0]._executor is None
+
+    def test_configure_processes(self, script, rule_file, config_file):
+        """With multiple processes, workers are configured for files."""
+        config = {
+            "metrics": {"metric1": {"type": "gauge"}},
+            "files": {name: str(rule_file) for name in ("file1", "file2", "file3")},
+        }
+        config_file.write_text(yaml.dump(config))
+        args = script.get_parser().parse_args([str(config_file), "--processes", "2"])
+        script.configure(args)
+        assert script.watchers == []
+        assert [worker.index for worker in script.workers] == [0, 1]
+        # metrics are not created in the main process
+        assert script.registry.get_metrics() == {}
+
+    def test_run_worker(self, monkeypatch, tmpdir, script, config_file):
+        """Workers analyze their files with their own loop and state file."""
+        calls = []
+        monkeypatch.setattr(main, "run_worker", lambda *args: calls.append(args))
+        state_file = Path(tmpdir / "state.json")
+        args = script.get_parser().parse_args(
+            [
+                str(config_file),
+                "--processes",
+                "2",
+                "--state-file",
+                str(state_file),
+                "--backfill-processes",
+                "2",
+            ]
+        )
+        with config_file.open() as fd:
+            config = script._load_config(fd)
+        script._run_worker(1, config, args, "conn")
+        [(conn, loop, registry, start, stop)] = calls
+        try:
+            assert conn == "conn"
+            assert loop is script.loop
+            assert registry is script.registry.registry
+            assert [watcher.name for watcher in script.watchers] == [
+                str(Path("file1").absolute())
+            ]
+            assert script.positions.path == Path(tmpdir / "state.json.1")
+            # workers can't start backfill processes
+            assert script.watchers[0]._backfill is None
+        finally:
+            loop.close()
+
+    def test_configure_backfill(self, script, config_file):
+        """Backfill processes can be used for files."""
+        args = script.get_parser().parse_args(
+            [
+                str(config_file),
+                "--backfill-processes",
+                "2",
+                "--backfill-min-size",
+                "100",
+            ]
+        )
+        script.configure(args)
+        backfill = script.watchers[0]._backfill
+        assert backfill._processes == 2
+        assert backfill._min_size == 100
+        # metrics are merged with those from backfill processes
+        assert script.registry.get_metrics() == {}
+        text = script.registry.generate_metrics().decode()
+        assert "metric1_count" in text
+
+    def test_configure_no_backfill(self, script, config_file):
+        """By default, files are not backfilled."""
+        args = script.get_parser().parse_args([str(config_file)])
+        script.configure(args)
+        assert script.watchers[0]._backfill is None
+        assert "metric1" in script.registry.get_metrics()
+
+    def test_configure_backfill_multiline(self, script, config_file, rule_file):
+        """Files with multiline records are not backfilled."""
+        config = {
+            "metrics": {"metric": {"type": "counter"}},
+            "files": {"file1": {"rules": str(rule_file), "multiline": {"start": "^a"}}},
+        }
+        config_file.write_text(yaml.dump(config))
+        args = script.get_parser().parse_args(
+            [str(config_file), "--backfill-processes", "2"]
+        )
+        script.configure(args)
+        assert script.watchers[0]._backfill is None
+
+    def test_create_backfill_analyzer(self, script, config_file, rule_file):
+        """Analyzers for backfill processes update their own metrics."""
+        rule_file.write_text(
+            """
+            rules.rule = Rule('line')
+            function rules.rule.action(match)
+              metrics.metric.inc()
+            end
+            """
+        )
+        config = {
+            "metrics": {"metric": {"type": "counter"}},
+            "files": {"file1": str(rule_file)},
+        }
+        config_file.write_text(yaml.dump(config))
+        args = script.get_parser().parse_args(
+            [str(config_file), "--backfill-processes", "2"]
+        )
+        script.configure(args)
+        config = script._load_config(config_file.open())
+        analyzer, registry = script._create_backfill_analyzer(config, args, "file1")
+        analyzer.analyze_lines(["line1", "line2"])
+        assert registry.get_sample_value("metric_total") == 2
+        text = script.registry.generate_metrics().decode()
+        assert "metric_total 0.0" in text
+
+    def test_configure_processes_invalid_rule(self, script, config_file, rule_file):
+        """Rule errors are reported before starting workers."""
+        rule_file.write_text("invalid")
+        args = script.get_parser().parse_args([str(config_file), "--processes", "2"])
+        with pytest.raises(ErrorExitMessage):
+            script.configure(args)
+
+    def test_configure_watch_rules(self, script, config_file, rule_file):
+        """If requested, rule files are watched for changes."""
+        args = script.get_parser().parse_args([str(config_file), "--watch-rules"])
+        script.configure(args)
+        [rule_watcher] = script.rule_watchers
+        assert rule_watcher.path == rule_file.absolute()
+        assert rule_watcher._callback == script._reload_rules
+
+    def test_configure_no_watch_rules(self, script, config_file):
+        """By default, rule files are not watched."""
+        args = script.get_parser().parse_args([str(config_file)])
+        script.configure(args)
+        assert script.rule_watchers == []
+
+    def test_reload_rules(self, script, config_file, rule_file):
+        """Changed rule files are reloaded for analyzers."""
+        args = script.get_parser().parse_args([str(config_file)])
+        script.configure(args)
+        [(_, analyzer)] = script.rule_registry._analyzers
+        rule_file.write_text("rules.rule = Rule('line')")
+        script._reload_rules()
+        assert [rule.name for rule in analyzer.rules] == ["rule"]
+
+    def test_reload_rules_workers(self, script):
+        """Reloading rules is signaled to workers."""
+        worker = FakeWorker()
+        script.workers = [worker]
+        script._reload_rules()
+        assert worker.signals == [signal.SIGHUP]
+
+    def test_configure_metrics_cache_interval(self, script, config_file):
+        """The minimum interval for rendering metrics can be specified."""
+        args = script.get_parser().parse_args(
+            [str(config_file), "--metrics-cache-interval", "5"]
+        )
+        script.configure(args)
+        assert script.metrics_cache._min_age == 5
+        exporter = script._get_exporter(args)
+        assert len(exporter.app.middlewares) == 1
+
+    def test_configure_metrics_changed(self, script, config_file):
+        """Metrics are marked as changed when lines are analyzed."""
+        args = script.get_parser().parse_args(
+            [str(config_file), "--metrics-cache-interval", "5"]
+        )
+        script.configure(args)
+        script.metrics_cache.get()
+        assert not script.metrics_cache._changed
+        script.watchers[0]._callback(["line"])
+        assert script.metrics_cache._changed
+
+    def test_configure_buffer_metrics(self, script, config_file):
+        """Buffering of metric updates from rules can be enabled."""
+        args = script.get_parser().parse_args([str(config_file), "--buffer-metrics"])
+        script.configure(args)
+        assert script.rule_registry._buffer_updates
+
+    def test_configure_no_buffer_metrics(self, script, config_file):
+        """By default, metric updates from rules are not buffered."""
+        args = script.get_parser().parse_args([str(config_file)])
+        script.configure(args)
+        assert not script.rule_registry._buffer_updates
+
+    def test_configure_rule_timing(self, script, config_file):
+        """Timing of rules can be enabled."""
+        args = script.get_parser().parse_args([str(config_file), "--rule-timing"])
+        script.configure(args)
+        assert script.stats.rule_timing
+
+    def test_configure_no_rule_timing(self, script, config_file):
+        """By default, rules are not timed."""
+        args = script.get_parser().parse_args([str(config_file)])
+        script.configure(args)
+        assert not script.stats.rule_timing
+
+    def test_configure_no_state_file(self, script, config_file):
+        """If no state file is specified, positions are not tracked."""
+        args = script.get_parser().parse_args([str(config_file)])
+        script.configure(args)
+        assert script.positions is None
+        assert script.watchers[0]._positions is None
+
     def test_configure_rule_file_not_found(self, script, config_file):
         """An error is raised if a rule file is not found."""
         config = {
@@ -89,6 +366,53 @@ class TestLMetricsScript:
             "histogram, info, summary"
         )
 
+    def test_configure_metric_limits(self, script, config_file, rule_file):
+        """Limits on series apply to metrics updated by rules."""
+        rule_file.write_text(
+            """
+            rules.rule = Rule([[(?P<value>\\w+)]])
+            function rules.rule.action(match)
+              metrics.metric.labels(match.value).inc()
+            end
+            """
+        )
+        config = {
+            "metrics": {
+                "metric": {"type": "counter", "labels": ["l"], "max_series": 1}
+            },
+            "files": {"file1": str(rule_file)},
+        }
+        config_file.write_text(yaml.dump(config))
+        args = script.get_parser().parse_args([str(config_file)])
+        script.configure(args)
+        script.watchers[0]._callback(["a", "b"])
+        text = script.registry.generate_metrics().decode()
+        assert 'metric_total{l="a"}' not in text
+        assert 'metric_total{l="b"} 1.0' in text
+        assert (
+            'lmetrics_series_evictions_total{metric="metric",reason="lru"} 1.0' in text
+        )
+
+    def test_configure_invalid_metric_config(self, script, config_file):
+        """An error is raised if the configuration for a metric is invalid."""
+        config = {"metrics": {"metric": {"type": "counter", "max_series": 1}}}
+        config_file.write_text(yaml.dump(config))
+        args = script.get_parser().parse_args([str(config_file)])
+        with pytest.raises(ErrorExitMessage) as err:
+            script.configure(args)
+        assert str(err.value) == (
+            "Invalid configuration for metric metric: series limits require labels"
+        )
+
+    def test_configure_invalid_file_config(self, script, config_file):
+        """An error is raised if the configuration for a file is invalid."""
+        config = {"files": {"file1": {"binary": True}}}
+        config_file.write_text(yaml.dump(config))
+        args = script.get_parser().parse_args([str(config_file)])
+        with pytest.raises(ErrorExitMessage) as err:
+            script.configure(args)
+        assert str(err.value) == "Invalid configuration for file1: missing rules"
+
 
 class FakeWatcher:
 
@@ -102,6 +426,14 @@ class FakeWatcher:
         self.stop_called = True
 
 
+class FakeWorker:
+    def __init__(self):
+        self.signals = []
+
+    def send_signal(self, signum):
+        self.signals.append(signum)
+
+
 @pytest.fixture
 def watcher():
     yield FakeWatcher()
@@ -119,6 +451,23 @@ async def app(event_loop, watcher, config_file):
     yield exporter.app
 
 
+class TestLMetricsScriptMetricsCache:
+    async def test_metrics_path(self, monkeypatch, loop, aiohttp_client, config_file):
+        """Cached metrics are served from the exporter metrics path."""
+        monkeypatch.setattr(PrometheusExporter, "metrics_path", "/other", raising=False)
+        config = {"metrics": {"metric": {"type": "gauge"}}}
+        config_file.write_text(yaml.dump(config))
+        script = LMetricsScript(loop=loop)
+        args = script.get_parser().parse_args(
+            [str(config_file), "--metrics-cache-interval", "5"]
+        )
+        script.configure(args)
+        client = await aiohttp_client(script._get_exporter(args).app)
+        response = await client.get("/other", headers={"Accept-Encoding": "gzip"})
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert "metric" in await response.text()
+
+
 @pytest.mark.asyncio
 class TestLMetricsScriptApplication:
     async def test_watchers_start(self, test_client, app, watcher):
@@ -131,3 +480,161 @@ class TestLMetricsScriptApplication:
         await test_client(app)
         await app.shutdown()
         assert watcher.stop_called
+
+    async def test_executor_shutdown(
+        self, event_loop, test_client, watcher, config_file
+    ):
+        """The executor is shut down when the app is shut down."""
+        config = {"metrics": {"metric": {"type": "gauge"}}}
+        config_file.write_text(yaml.dump(config))
+        script = LMetricsScript(loop=event_loop)
+        args = script.get_parser().parse_args(
+            [str(config_file), "--analysis-threads", "1"]
+        )
+        script.configure(args)
+        script.watchers = [watcher]
+        app = script._get_exporter(args).app
+        await test_client(app)
+        await app.shutdown()
+        with pytest.raises(RuntimeError):
+            script.executor.submit(print)
+
+    async def test_processes(self, tmpdir, event_loop, config_file):
+        """Metrics from worker processes are merged and exported."""
+        rule_file = Path(tmpdir / "rule.lua")
+        rule_file.write_text(
+            """
+            rules.rule = Rule('line')
+            function rules.rule.action(match)
+              metrics.lines.inc()
+            end
+            """
+        )
+        log_file1 = Path(tmpdir / "log1")
+        log_file1.write_text("line1\nline2\n")
+        log_file2 = Path(tmpdir / "log2")
+        log_file2.write_text("line1\nline2\nline3\n")
+        config = {
+            "metrics": {"lines": {"type": "counter", "description": "lines"}},
+            "files": {str(log_file1): str(rule_file), str(log_file2): str(rule_file)},
+        }
+        config_file.write_text(yaml.dump(config))
+        state_file = Path(tmpdir / "state.json")
+        script = LMetricsScript(loop=event_loop)
+        args = script.get_parser().parse_args(
+            [str(config_file), "--processes", "2", "--state-file", str(state_file)]
+        )
+        script.configure(args)
+        await script.on_application_startup(None)
+        for _ in range(50):
+            await asyncio.sleep(0.1)
+            text = script.registry.generate_metrics().decode()
+            if "lines_total 5.0" in text:
+                break
+        await script.on_application_shutdown(None)
+        assert "lines_total 5.0" in text
+        # each worker saves its own state file
+        assert Path(tmpdir / "state.json.0").exists()
+        assert Path(tmpdir / "state.json.1").exists()
+
+    async def test_backfill(self, tmpdir, event_loop, config_file):
+        """Metrics from backfill processes are merged and exported."""
+        rule_file = Path(tmpdir / "rule.lua")
+        rule_file.write_text(
+            """
+            rules.rule = Rule('line')
+            function rules.rule.action(match)
+              metrics.lines.inc()
+            end
+            """
+        )
+        log_file = Path(tmpdir / "log")
+        log_file.write_text("".join(f"line{number}\n" for number in range(100)))
+        config = {
+            "metrics": {"lines": {"type": "counter", "description": "lines"}},
+            "files": {str(log_file): str(rule_file)},
+        }
+        config_file.write_text(yaml.dump(config))
+        script = LMetricsScript(loop=event_loop)
+        args = script.get_parser().parse_args(
+            [
+                str(config_file),
+                "--backfill-processes",
+                "2",
+                "--backfill-min-size",
+                "100",
+            ]
+        )
+        script.configure(args)
+        await script.on_application_startup(None)
+        for _ in range(50):
+            await asyncio.sleep(0.1)
+            text = script.registry.generate_metrics().decode()
+            if "lines_total 100.0" in text:
+                break
+        assert "lines_total 100.0" in text
+        # following lines are analyzed in the main process
+        with log_file.open("a") as fd:
+            fd.write("line100\n")
+        await asyncio.sleep(0.1)
+        await script.on_application_shutdown(None)
+        text = script.registry.generate_metrics().decode()
+        assert "lines_total 101.0" in text
+
+    async def test_state_file_saved(
+        self, tmpdir, event_loop, test_client, watcher, config_file
+    ):
+        """The state file is saved periodically and on shutdown."""
+        state_file = Path(tmpdir / "state.json")
+        config = {"metrics": {"metric": {"type": "gauge"}}}
+        config_file.write_text(yaml.dump(config))
+        script = LMetricsScript(loop=event_loop)
+        args = script.get_parser().parse_args(
+            [
+                str(config_file),
+                "--state-file",
+                str(state_file),
+                "--state-save-interval",
+                "0.05",
+            ]
+        )
+        script.configure(args)
+        script.watchers = [watcher]
+        app = script._get_exporter(args).app
+        await test_client(app)
+        script.positions.set(Path("/file1.txt"), FilePosition(1, 2, 3))
+        await asyncio.sleep(0.1)
+        assert "file1.txt" in state_file.read_text()
+        script.positions.set(Path("/file2.txt"), FilePosition(1, 2, 3))
+        await app.shutdown()
+        assert "file2.txt" in state_file.read_text()
+
+    async def test_rule_watchers(self, test_client, event_loop, config_file, watcher):
+        """Rule watchers are started and stopped with the app."""
+        script = LMetricsScript(loop=event_loop)
+        script.watchers = []
+        script.rule_watchers = [watcher]
+        args = script.get_parser().parse_args([str(config_file)])
+        args.config.close()
+        app = script._get_exporter(args).app
+        await test_client(app)
+        assert watcher.watch_called
+        await app.shutdown()
+        assert watcher.stop_called
+
+    async def test_reload_rules_on_sighup(
+        self, test_client, event_loop, config_file, rule_file, watcher
+    ):
+        """Rules are reloaded on SIGHUP."""
+        script = LMetricsScript(loop=event_loop)
+        args = script.get_parser().parse_args([str(config_file)])
+        script.configure(args)
+        [(_, analyzer)] = script.rule_registry._analyzers
+        script.watchers = [watcher]
+        app = script._get_exporter(args).app
+        await test_client(app)
+        rule_file.write_text("rules.rule = Rule('line')")
+        os.kill(os.getpid(), signal.SIGHUP)
+        await asyncio.sleep(0.1)
+        await app.shutdown()
+        assert [rule.name for rule in analyzer.rules] == ["rule"]
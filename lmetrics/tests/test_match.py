@@ -0,0 +1,156 @@
+import re
+
+import pytest
+
+from ..match import (
+    combinable_pattern,
+    combine_patterns,
+    required_literal,
+    RuleMatcher,
+)
+
+
+class FakeRule:
+    def __init__(self, regexp):
+        self.regexp = re.compile(regexp)
+
+
+class TestRuleMatcher:
+    def test_candidates(self):
+        """Only rules that can match the line are returned."""
+        rule1 = FakeRule(r"foo (?P<val>\d+)")
+        rule2 = FakeRule(r"bar (?P<val>\d+)")
+        matcher = RuleMatcher([rule1, rule2])
+        assert matcher.candidates("foo 10") == [rule1]
+        assert matcher.candidates("bar 10") == [rule2]
+        assert matcher.candidates("foo bar 10") == [rule1, rule2]
+
+    def test_candidates_no_match(self):
+        """If no rule matches, no candidate is returned."""
+        matcher = RuleMatcher([FakeRule("foo"), FakeRule("bar")])
+        assert matcher.candidates("baz") == []
+
+    def test_candidates_literal_prefilter_only(self):
+        """Rules are returned if their literal is contained in the line.
+
+        The rule regexp is not required to match for the rule to be a
+        candidate, as long as another rule matches.
+
+        """
+        rule1 = FakeRule(r"foo \d+")
+        rule2 = FakeRule(r"bar \d+")
+        matcher = RuleMatcher([rule1, rule2])
+        assert matcher.candidates("foo 10 bar baz") == [rule1, rule2]
+
+    def test_candidates_not_combinable_always_returned(self):
+        """Rules that can't be combined are always candidates."""
+        rule1 = FakeRule("foo")
+        rule2 = FakeRule(r"(?i)bar")
+        matcher = RuleMatcher([rule1, rule2])
+        assert matcher.candidates("BAR") == [rule2]
+        assert matcher.candidates("baz") == [rule2]
+        assert matcher.candidates("foo") == [rule1, rule2]
+
+    def test_candidates_no_rules(self):
+        """No candidates are returned if there are no rules."""
+        matcher = RuleMatcher([])
+        assert matcher.candidates("foo") == []
+
+    def test_candidates_same_group_names(self):
+        """Rules using the same named groups can be combined."""
+        rule1 = FakeRule(r"foo (?P<val>\d+)")
+        rule2 = FakeRule(r"bar (?P<val>\d+)")
+        matcher = RuleMatcher([rule1, rule2])
+        assert matcher._combined is not None
+
+    def test_candidates_bytes(self):
+        """Rules with bytes patterns are matched against bytes lines."""
+        rule1 = FakeRule(rb"foo (?P<val>\d+)")
+        rule2 = FakeRule(rb"bar (?P<val>\d+)")
+        matcher = RuleMatcher([rule1, rule2])
+        assert matcher.candidates(b"foo 10") == [rule1]
+        assert matcher.candidates(b"baz 10") == []
+
+
+class TestRequiredLiteral:
+    @pytest.mark.parametrize(
+        "pattern,literal",
+        [
+            ("foo", "foo"),
+            (r"foo \d+ barbaz", " barbaz"),
+            (r"^GET (?P<path>\S+)", "GET "),
+            (r"\d+", ""),
+            ("foo|bar", ""),
+            (r"a\.b", "a.b"),
+        ],
+    )
+    def test_literal(self, pattern, literal):
+        """The longest required literal is returned."""
+        assert required_literal(re.compile(pattern)) == literal
+
+    def test_ignore_case(self):
+        """No literal is returned for case-insensitive regexps."""
+        assert required_literal(re.compile("foo", re.IGNORECASE)) == ""
+
+    def test_bytes(self):
+        """For bytes patterns, the literal is bytes."""
+        assert required_literal(re.compile(rb"foo \d+ bar\xe8")) == b" bar\xe8"
+
+    def test_bytes_ignore_case(self):
+        """For case-insensitive bytes patterns, an empty literal is returned."""
+        assert required_literal(re.compile(b"foo", re.IGNORECASE)) == b""
+
+
+class TestCombinablePattern:
+    @pytest.mark.parametrize(
+        "pattern,result",
+        [
+            ("foo", "foo"),
+            (r"foo (?P<val>\d+)", r"foo (?:\d+)"),
+            (r"(?P<a>(?P<b>x))", r"(?:(?:x))"),
+            (r"\(?P<a>x\)", r"\(?P<a>x\)"),
+            (r"[(?P<a>]x", r"[(?P<a>]x"),
+        ],
+    )
+    def test_pattern(self, pattern, result):
+        """Named groups are made non-capturing."""
+        assert combinable_pattern(re.compile(pattern)) == result
+
+    @pytest.mark.parametrize(
+        "pattern", [r"(?i)foo", r"(?P<a>x)(?P=a)", r"(x)\1", r"(?P<a>x)?(?(a)y|z)"]
+    )
+    def test_not_combinable(self, pattern):
+        """None is returned for patterns that can't be combined."""
+        assert combinable_pattern(re.compile(pattern)) is None
+
+    def test_bytes(self):
+        """Bytes patterns are returned as bytes."""
+        regexp = re.compile(rb"\xe8 (?P<val>\d+)")
+        assert combinable_pattern(regexp) == rb"\xe8 (?:\d+)"
+
+    def test_bytes_not_combinable(self):
+        """None is returned for bytes patterns that can't be combined."""
+        assert combinable_pattern(re.compile(rb"(?i)foo")) is None
+
+
+class TestCombinePatterns:
+    def test_combine(self):
+        """The combined regexp matches if any pattern matches."""
+        regexp = combine_patterns(["foo", r"bar \d"])
+        assert regexp.search("a foo")
+        assert regexp.search("a bar 1")
+        assert not regexp.search("a bar")
+
+    def test_combine_bytes(self):
+        """Bytes patterns are combined in a bytes regexp."""
+        regexp = combine_patterns([b"foo", rb"bar \d"])
+        assert regexp.search(b"a bar 1")
+        assert not regexp.search(b"a bar")
+
+    def test_empty(self):
+        """None is returned if no pattern is passed."""
+        assert combine_patterns([]) is None
+
+    def test_invalid(self):
+        """None is returned if patterns can't be combined."""
+        assert combine_patterns(["foo", "(bar"]) is None
@@ -0,0 +1,59 @@
+import re
+
+from ..multiline import MultilineAssembler
+
+
+class TestMultilineAssembler:
+    def test_feed(self):
+        """Lines are grouped in records by start lines."""
+        assembler = MultilineAssembler(re.compile(r"^\d"), 10, 100)
+        assert assembler.feed(["1 error", "  at foo", "  at bar", "2 ok"]) == [
+            "1 error\n  at foo\n  at bar"
+        ]
+        assert assembler.feed(["3 ok"]) == ["2 ok"]
+
+    def test_feed_continued(self):
+        """Records continue across batches of lines."""
+        assembler = MultilineAssembler(re.compile(r"^\d"), 10, 100)
+        assert assembler.feed(["1 error", "  at foo"]) == []
+        assert assembler.feed(["  at bar", "2 ok"]) == ["1 error\n  at foo\n  at bar"]
+
+    def test_feed_no_start(self):
+        """Lines before the first start line form a record."""
+        assembler = MultilineAssembler(re.compile(r"^\d"), 10, 100)
+        assert assembler.feed(["  at foo", "  at bar", "1 ok"]) == [
+            "  at foo\n  at bar"
+        ]
+
+    def test_feed_bytes(self):
+        """Lines and records can be bytes."""
+        assembler = MultilineAssembler(re.compile(rb"^\d"), 10, 100)
+        assert assembler.feed([b"1 error", b"  at foo", b"2 ok"]) == [
+            b"1 error\n  at foo"
+        ]
+
+    def test_max_lines(self):
+        """Lines over the maximum are discarded until the next record."""
+        assembler = MultilineAssembler(re.compile(r"^\d"), 2, 100)
+        assembler.feed(["1 error", "  at foo", "  at bar", "  at baz"])
+        assert assembler.feed(["2 ok"]) == ["1 error\n  at foo"]
+
+    def test_max_length(self):
+        """Lines making records longer than the maximum are discarded."""
+        assembler = MultilineAssembler(re.compile(r"^\d"), 10, 16)
+        assembler.feed(["1 error", "  at foo", "  at bar", "x"])
+        assert assembler.feed(["2 ok"]) == ["1 error\n  at foo"]
+
+    def test_max_length_first_line(self):
+        """The first line of a record is always kept."""
+        assembler = MultilineAssembler(re.compile(r"^\d"), 10, 4)
+        assembler.feed(["1 error", "  at foo"])
+        assert assembler.flush() == ["1 error"]
+
+    def test_flush(self):
+        """flush returns the pending record."""
+        assembler = MultilineAssembler(re.compile(r"^\d"), 10, 100)
+        assembler.feed(["1 error", "  at foo"])
+        assert assembler.flush() == ["1 error\n  at foo"]
+        assert assembler.flush() == []
+        assert assembler.feed(["  at bar", "2 ok"]) == ["  at bar"]
@@ -0,0 +1,206 @@
+import gzip
+from io import StringIO
+from pathlib import Path
+
+import pytest
+import yaml
+
+from ..replay import ReplayScript
+
+RULES = """
+rules.rule = Rule([[line (?P<value>\\d+)]])
+function rules.rule.action(match)
+  metrics.total.inc(match.value)
+end
+"""
+
+
+@pytest.fixture
+def stdout():
+    yield StringIO()
+
+
+@pytest.fixture
+def stderr():
+    yield StringIO()
+
+
+@pytest.fixture
+def script(stdout, stderr):
+    yield ReplayScript(stdout=stdout, stderr=stderr)
+
+
+@pytest.fixture
+def rule_file(tmpdir):
+    rule_file = Path(tmpdir / "rules.lua")
+    rule_file.write_text(RULES)
+    yield rule_file
+
+
+@pytest.fixture
+def log_file(tmpdir):
+    log_file = Path(tmpdir / "app.log")
+    log_file.write_text("line 1\nother\nline 2\n")
+    yield log_file
+
+
+@pytest.fixture
+def config_file(tmpdir, rule_file):
+    config_file = Path(tmpdir / "config.yaml")
+    config = {
+        "metrics": {"total": {"type": "counter", "description": "total"}},
+        "files": {str(tmpdir / "*.log"): str(rule_file)},
+    }
+    config_file.write_text(yaml.dump(config))
+    yield config_file
+
+
+class TestReplayScript:
+    def test_replay(self, script, stdout, stderr, config_file, log_file, rule_file):
+        """Files are analyzed, and metrics and stats are printed."""
+        script([str(config_file), str(log_file)])
+        assert "total_total 3.0" in stdout.getvalue()
+        report = stderr.getvalue()
+        assert f"{log_file}: 3 lines in" in report
+        assert "total: 3 lines in" in report
+        assert f'rule "rule" ({rule_file}): 2 matches' in report
+        assert "0 errors" in report
+
+    def test_replay_multiple_files(self, tmpdir, script, stdout, config_file, log_file):
+        """Metrics from multiple files are accumulated."""
+        other_log = Path(tmpdir / "other.log")
+        other_log.write_text("line 10\n")
+        script([str(config_file), str(log_file), str(other_log)])
+        assert "total_total 13.0" in stdout.getvalue()
+
+    def test_replay_partial_last_line(self, script, stdout, config_file, log_file):
+        """The last line is analyzed even without a trailing newline."""
+        log_file.write_text("line 1\nline 5")
+        script([str(config_file), str(log_file)])
+        assert "total_total 6.0" in stdout.getvalue()
+
+    def test_replay_compressed(self, tmpdir, script, stdout, config_file):
+        """Compressed files are decompressed."""
+        log_file = Path(tmpdir / "app.log.gz")
+        with gzip.open(log_file, "wb") as fd:
+            fd.write(b"line 7\n")
+        config_file.write_text(config_file.read_text().replace("*.log", "*.log.gz"))
+        script([str(config_file), str(log_file)])
+        assert "total_total 7.0" in stdout.getvalue()
+
+    def test_replay_read_chunk_size(self, script, stdout, config_file, log_file):
+        """Files are read in chunks of the specified size."""
+        script([str(config_file), str(log_file), "--read-chunk-size", "3"])
+        assert "total_total 3.0" in stdout.getvalue()
+
+    @pytest.mark.parametrize("size", ["0", "-1", "foo"])
+    def test_replay_invalid_read_chunk_size(
+        self, capsys, script, config_file, log_file, size
+    ):
+        """The read chunk size must be a positive integer."""
+        with pytest.raises(SystemExit):
+            script([str(config_file), str(log_file), "--read-chunk-size", size])
+        assert f"invalid chunk size: {size}" in capsys.readouterr().err
+
+    def test_replay_binary(self, tmpdir, script, stdout, config_file, rule_file):
+        """Files configured as binary are analyzed as bytes."""
+        config = {
+            "metrics": {"total": {"type": "counter", "description": "total"}},
+            "files": {str(tmpdir / "*.log"): {"rules": str(rule_file), "binary": True}},
+        }
+        config_file.write_text(yaml.dump(config))
+        log_file = Path(tmpdir / "app.log")
+        log_file.write_bytes(b"line 4 \xff\n")
+        script([str(config_file), str(log_file)])
+        assert "total_total 4.0" in stdout.getvalue()
+
+    def test_replay_long_lines(self, tmpdir, script, stdout, config_file, rule_file):
+        """Long lines are truncated as configured for files."""
+        config = {
+            "metrics": {"total": {"type": "counter", "description": "total"}},
+            "files": {
+                str(tmpdir / "*.log"): {"rules": str(rule_file), "max_line_length": 6}
+            },
+        }
+        config_file.write_text(yaml.dump(config))
+        log_file = Path(tmpdir / "app.log")
+        log_file.write_text("line 12\nline 3\n")
+        script([str(config_file), str(log_file)])
+        assert "total_total 4.0" in stdout.getvalue()
+
+    def test_replay_multiline(self, tmpdir, script, stdout, config_file, rule_file):
+        """Multiline records are assembled as configured for files."""
+        config = {
+            "metrics": {"total": {"type": "counter", "description": "total"}},
+            "files": {
+                str(tmpdir / "*.log"): {
+                    "rules": str(rule_file),
+                    "multiline": {"start": "^line"},
+                }
+            },
+        }
+        config_file.write_text(yaml.dump(config))
+        log_file = Path(tmpdir / "app.log")
+        log_file.write_text("line 1\nother line 2\nline 3\n")
+        script([str(config_file), str(log_file)])
+        # "line 2" is part of the first record, only the first match counts
+        assert "total_total 4.0" in stdout.getvalue()
+
+    def test_replay_no_file_config(self, tmpdir, script, stderr, config_file):
+        """An error is reported for files not in the configuration."""
+        log_file = Path(tmpdir / "app.txt")
+        log_file.write_text("line 1\n")
+        with pytest.raises(SystemExit):
+            script([str(config_file), str(log_file)])
+        assert stderr.getvalue() == (
+            f"No configuration for file (use --entry to select one): {log_file}\n"
+        )
+
+    def test_replay_entry(self, tmpdir, script, stdout, config_file):
+        """Files can be analyzed with the configuration of a specific entry."""
+        log_file = Path(tmpdir / "app.log.1")
+        log_file.write_text("line 4\n")
+        script(
+            [
+                str(config_file),
+                str(log_file),
+                "--entry",
+                str(tmpdir / "*.log"),
+            ]
+        )
+        assert "total_total 4.0" in stdout.getvalue()
+
+    def test_replay_entry_not_found(self, tmpdir, script, stderr, config_file):
+        """An error is reported if the entry is not in the configuration."""
+        log_file = Path(tmpdir / "app.log")
+        log_file.write_text("line 1\n")
+        with pytest.raises(SystemExit):
+            script([str(config_file), str(log_file), "--entry", "*.txt"])
+        assert stderr.getvalue() == "No configuration entry: *.txt\n"
+
+    def test_replay_rule_file_not_found(
+        self, script, stderr, config_file, log_file, rule_file
+    ):
+        """An error is reported if a rule file is not found."""
+        rule_file.unlink()
+        with pytest.raises(SystemExit):
+            script([str(config_file), str(log_file)])
+        assert stderr.getvalue() == f"Rule file not found: {rule_file}\n"
+
+    def test_replay_invalid_rule(
+        self, script, stderr, config_file, log_file, rule_file
+    ):
+        """An error is reported if a rule file is invalid."""
+        rule_file.write_text("invalid")
+        with pytest.raises(SystemExit):
+            script([str(config_file), str(log_file)])
+        assert stderr.getvalue() == f"in {rule_file}:1: syntax error near <eof>\n"
+
+    def test_replay_invalid_config(self, script, stderr, config_file, log_file):
+        """An error is reported if the configuration is invalid."""
+        config_file.write_text(yaml.dump({"files": {"app.log": {"binary": True}}}))
+        with pytest.raises(SystemExit):
+            script([str(config_file), str(log_file)])
+        assert stderr.getvalue() == (
+            "Invalid configuration for app.log: missing rules\n"
+        )
@@ -1,35 +1,108 @@
 import logging
 from operator import attrgetter
 from pathlib import Path
+import random
+import re
+import sys
+from types import SimpleNamespace
 
+import lupa
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Summary,
+)
 import pytest
 
+from ..config import (
+    FileConfig,
+    LookbackConfig,
+    MultilineConfig,
+)
 from ..rule import (
+    compile_regexp,
     create_file_analyzers,
+    DeclarativeRule,
     FileAnalyzer,
     LuaFileRule,
+    LuaRule,
+    match_groups,
     RuleRegistry,
     RuleSyntaxError,
 )
+from ..sampling import SampleWeight
+from ..stats import Stats
 
 
 class FakeRule:
-    def __init__(self, *args, **kwargs):
+
+    batched = False
+    buffer = None
+
+    def __init__(self, regexp="line", name="rule"):
+        self.regexp = re.compile(regexp)
+        self.name = name
         self.lines = []
 
-    def analyze_line(self, line):
-        self.lines.append(line)
+    def match(self, line):
+        if self.regexp.search(line):
+            return {"line": line}
+
+    def action(self, values):
+        self.lines.append(values["line"])
+
+
+class FakeBatchRule(FakeRule):
+
+    batched = True
+
+    def __init__(self, regexp="line", name="rule"):
+        super().__init__(regexp=regexp, name=name)
+        self.batches = []
+
+    def batch_action(self, matches):
+        self.batches.append([values["line"] for values in matches])
+
+
+class FailingRule(FakeRule):
+    def action(self, values):
+        raise RuntimeError("boom")
+
+    def batch_action(self, matches):
+        raise RuntimeError("batch boom")
+
+
+@pytest.fixture
+def stats():
+    yield Stats(CollectorRegistry())
+
+
+@pytest.fixture
+def timed_stats():
+    yield Stats(CollectorRegistry(), rule_timing=True)
 
 
 class FakeLuaRule:
-    def __init__(self, regexp):
+
+    batch_action = None
+    sample = 1
+    random_sample = False
+
+    def __init__(self, regexp, types=None):
         self.regexp = regexp
+        self.types = types
         self.calls = []
 
     def action(self, values):
         self.calls.append(values)
 
 
+class FakeLuaBatchRule(FakeLuaRule):
+    def batch_action(self, matches):
+        self.calls.append(matches)
+
+
 class TestFileAnalyzer:
     def test_analyze_line(self):
         """analyze_line calls all rules with every line."""
@@ -41,6 +114,212 @@ class TestFileAnalyzer:
         assert rule1.lines == ["line1", "line2"]
         assert rule2.lines == ["line1", "line2"]
 
+    def test_analyze_lines(self):
+        """analyze_lines calls matching rules with every line."""
+        rule1 = FakeRule("foo")
+        rule2 = FakeRule("line")
+        analyzer = FileAnalyzer(Path("file.txt"), [rule1, rule2])
+        analyzer.analyze_lines(["line1", "foo line2", "line3"])
+        assert rule1.lines == ["foo line2"]
+        assert rule2.lines == ["line1", "foo line2", "line3"]
+
+    def test_analyze_lines_batch_action(self):
+        """Batch actions are called once with all matching lines."""
+        rule1 = FakeRule("line")
+        rule2 = FakeBatchRule("foo")
+        analyzer = FileAnalyzer(Path("file.txt"), [rule1, rule2])
+        analyzer.analyze_lines(["line1", "foo line2", "foo line3"])
+        assert rule1.lines == ["line1", "foo line2", "foo line3"]
+        assert rule2.batches == [["foo line2", "foo line3"]]
+
+    def test_analyze_lines_candidate_no_match(self):
+        """Candidate rules whose regexp doesn't match are not called."""
+        rule1 = FakeRule("linex")
+        rule2 = FakeBatchRule(r"line\d")
+        analyzer = FileAnalyzer(Path("file.txt"), [rule1, rule2])
+        analyzer.analyze_lines(["line1", "linex", "line2"])
+        assert rule1.lines == ["linex"]
+        assert rule2.batches == [["line1", "line2"]]
+
+    def test_analyze_lines_batch_action_no_match(self):
+        """Batch actions are not called if no line matches."""
+        rule = FakeBatchRule("foo")
+        analyzer = FileAnalyzer(Path("file.txt"), [rule])
+        analyzer.analyze_lines(["line1", "line2"])
+        assert rule.batches == []
+
+    def test_analyze_line_only_candidate_rules(self):
+        """analyze_line calls only rules that can match the line."""
+        rule1 = FakeRule("foo")
+        rule2 = FakeRule("bar")
+        analyzer = FileAnalyzer(Path("file.txt"), [rule1, rule2])
+        analyzer.analyze_line("a foo line")
+        analyzer.analyze_line("a bar line")
+        analyzer.analyze_line("a baz line")
+        assert rule1.lines == ["a foo line"]
+        assert rule2.lines == ["a bar line"]
+
+    def test_analyze_lines_action_error(self, caplog):
+        """Errors in actions are logged, and other rules are still called."""
+        caplog.set_level(logging.WARNING)
+        rule1 = FailingRule("foo", name="failing")
+        rule2 = FakeRule("line")
+        analyzer = FileAnalyzer(Path("file.txt"), [rule1, rule2])
+        analyzer.analyze_lines(["foo line1", "line2"])
+        assert rule2.lines == ["foo line1", "line2"]
+        assert 'action for rule "failing" failed: boom' in caplog.messages
+
+    def test_analyze_lines_batch_action_error(self, caplog):
+        """Errors in batch actions are logged."""
+        caplog.set_level(logging.WARNING)
+        rule = FailingRule("foo", name="failing")
+        rule.batched = True
+        analyzer = FileAnalyzer(Path("file.txt"), [rule])
+        analyzer.analyze_lines(["foo line1", "foo line2"])
+        assert 'action for rule "failing" failed: batch boom' in caplog.messages
+
+    @pytest.mark.parametrize("stats", [None, False, True])
+    def test_analyze_lines_binary_decode_error(self, caplog, stats):
+        """Matches with values that can't be decoded are logged and skipped."""
+        caplog.set_level(logging.WARNING)
+        if stats is not None:
+            stats = Stats(CollectorRegistry(), rule_timing=stats)
+        lua_rule = FakeLuaRule("foo(?P<val>.*)foo")
+        rule = LuaFileRule("rule", lua_rule, encoding="utf-8")
+        analyzer = FileAnalyzer(
+            Path("file.txt"), [rule], binary=True, rules_path="rules.lua", stats=stats
+        )
+        analyzer.analyze_lines([b"foob\xe8rfoo", b"foobarfoo"])
+        assert lua_rule.calls == [{"val": "bar"}]
+        [message] = caplog.messages
+        assert message.startswith('invalid match for rule "rule", not decoded: ')
+        if stats is not None:
+            assert stats.rule("rules.lua", "rule").matches._value.get() == 1
+
+    def test_analyze_lines_stats(self, stats):
+        """With stats, matches are counted for each rule, without timing."""
+        rule1 = FakeRule("linex", name="rule1")
+        rule2 = FakeBatchRule(r"line\d", name="rule2")
+        analyzer = FileAnalyzer(
+            Path("file.txt"), [rule1, rule2], rules_path="rules.lua", stats=stats
+        )
+        analyzer.analyze_lines(["line1", "linex", "line2"])
+        assert rule1.lines == ["linex"]
+        assert rule2.batches == [["line1", "line2"]]
+        rule1_stats = stats.rule("rules.lua", "rule1")
+        rule2_stats = stats.rule("rules.lua", "rule2")
+        assert rule1_stats.matches._value.get() == 1
+        assert rule2_stats.matches._value.get() == 2
+        assert rule1_stats.action_errors._value.get() == 0
+        assert rule1_stats.regexp_seconds is None
+        assert rule1_stats.action_seconds is None
+
+    def test_analyze_lines_timed_stats(self, timed_stats):
+        """With rule timing, time spent is also recorded for each rule."""
+        rule1 = FakeRule("linex", name="rule1")
+        rule2 = FakeBatchRule(r"line\d", name="rule2")
+        analyzer = FileAnalyzer(
+            Path("file.txt"),
+            [rule1, rule2],
+            rules_path="rules.lua",
+            stats=timed_stats,
+        )
+        analyzer.analyze_lines(["line1", "linex", "line2"])
+        assert rule1.lines == ["linex"]
+        assert rule2.batches == [["line1", "line2"]]
+        rule1_stats = timed_stats.rule("rules.lua", "rule1")
+        rule2_stats = timed_stats.rule("rules.lua", "rule2")
+        assert rule1_stats.matches._value.get() == 1
+        assert rule2_stats.matches._value.get() == 2
+        assert rule1_stats.regexp_seconds._value.get() > 0
+        assert rule1_stats.action_seconds._value.get() > 0
+        assert rule2_stats.action_seconds._value.get() > 0
+        assert rule1_stats.action_errors._value.get() == 0
+
+    @pytest.mark.parametrize("rule_timing", [False, True])
+    def test_analyze_lines_stats_action_errors(self, rule_timing):
+        """With stats, errors in actions are counted."""
+        stats = Stats(CollectorRegistry(), rule_timing=rule_timing)
+        rule1 = FailingRule("foo", name="rule1")
+        rule2 = FailingRule("line", name="rule2")
+        rule2.batched = True
+        analyzer = FileAnalyzer(
+            Path("file.txt"), [rule1, rule2], rules_path="rules.lua", stats=stats
+        )
+        analyzer.analyze_lines(["foo line1", "foo line2"])
+        assert stats.rule("rules.lua", "rule1").action_errors._value.get() == 2
+        assert stats.rule("rules.lua", "rule2").action_errors._value.get() == 1
+
+    def test_analyze_lines_multiline(self):
+        """With multiline records, rules match records."""
+        rule = FakeRule("error")
+        analyzer = FileAnalyzer(
+            Path("file.txt"), [rule], multiline=MultilineConfig(r"^\d")
+        )
+        analyzer.analyze_lines(["1 error", "  at foo"])
+        assert rule.lines == []
+        analyzer.analyze_lines(["  at bar", "2 error"])
+        assert rule.lines == ["1 error\n  at foo\n  at bar"]
+        analyzer.flush()
+        assert rule.lines == ["1 error\n  at foo\n  at bar", "2 error"]
+
+    def test_analyze_lines_multiline_binary(self):
+        """In binary mode, the multiline start regexp matches bytes."""
+        rule = FakeRule(b"error")
+        analyzer = FileAnalyzer(
+            Path("file.txt"),
+            [rule],
+            binary=True,
+            multiline=MultilineConfig(r"^\d"),
+        )
+        analyzer.analyze_lines([b"1 error", b"  at foo", b"2 ok"])
+        assert rule.lines == [b"1 error\n  at foo"]
+
+    def test_analyze_lines_multiline_stats(self, stats):
+        """With stats, matches of multiline records are counted."""
+        analyzer = FileAnalyzer(
+            Path("file.txt"),
+            [FakeRule(name="rule")],
+            multiline=MultilineConfig(r"^\d"),
+            rules_path="rules.lua",
+            stats=stats,
+        )
+        analyzer.analyze_lines(["1 line", "  line", "2 line"])
+        analyzer.flush()
+        assert stats.rule("rules.lua", "rule").matches._value.get() == 2
+
+    def test_flush_no_multiline(self):
+        """flush does nothing without multiline records."""
+        rule = FakeRule()
+        analyzer = FileAnalyzer(Path("file.txt"), [rule])
+        analyzer.flush()
+        assert rule.lines == []
+
+    def test_set_rules(self):
+        """Rules can be replaced."""
+        rule1 = FakeRule("foo")
+        rule2 = FakeRule("bar")
+        analyzer = FileAnalyzer(Path("file.txt"), [rule1])
+        analyzer.analyze_line("foo bar")
+        analyzer.set_rules([rule2])
+        analyzer.analyze_line("foo bar baz")
+        assert analyzer.rules == [rule2]
+        assert rule1.lines == ["foo bar"]
+        assert rule2.lines == ["foo bar baz"]
+
+    def test_set_rules_stats(self, stats):
+        """Stats are recorded for replaced rules."""
+        analyzer = FileAnalyzer(
+            Path("file.txt"),
+            [FakeRule(name="rule1")],
+            rules_path="rules.lua",
+            stats=stats,
+        )
+        analyzer.set_rules([FakeRule(name="rule2")])
+        analyzer.analyze_line("line")
+        assert stats.rule("rules.lua", "rule1").matches._value.get() == 0
+        assert stats.rule("rules.lua", "rule2").matches._value.get() == 1
+
 
 class TestLuaFileRule:
     def test_analyze_line_matching(self):
@@ -58,6 +337,209 @@ class TestLuaFileRule:
         rule.analyze_line("barfoobar")
         assert lua_rule.calls == []
 
+    def test_analyze_line_batch_action(self):
+        """analyze_line calls the batch action with a single match."""
+        lua_rule = FakeLuaBatchRule("foo(?P<val>.*)foo")
+        rule = LuaFileRule(Path("file.txt"), lua_rule)
+        rule.analyze_line("foobarfoo")
+        assert lua_rule.calls == [[{"val": "bar"}]]
+
+    def test_match(self):
+        """match returns values from the match."""
+        rule = LuaFileRule(Path("file.txt"), FakeLuaRule("foo(?P<val>.*)foo"))
+        assert rule.match("foo10foo") == {"val": 10.0}
+        assert rule.match("foobarfoo") == {"val": "bar"}
+
+    def test_match_no_match(self):
+        """match returns None if the line doesn't match."""
+        rule = LuaFileRule(Path("file.txt"), FakeLuaRule("foo(?P<val>.*)foo"))
+        assert rule.match("barfoobar") is None
+
+    def test_match_no_groups(self):
+        """match returns empty values if the regexp has no named groups."""
+        rule = LuaFileRule(Path("file.txt"), FakeLuaRule("foo(.*)foo"))
+        assert rule.match("foobarfoo") == {}
+
+    def test_match_types(self):
+        """If types are declared, only declared groups are converted."""
+        lua_rule = FakeLuaRule(
+            "(?P<a>\\S+) (?P<b>\\S+) (?P<c>\\S+) (?P<d>\\S+)",
+            types={"a": "int", "b": "float", "c": "str"},
+        )
+        rule = LuaFileRule(Path("file.txt"), lua_rule)
+        values = rule.match("10 2.5 3 4")
+        assert values == {"a": 10, "b": 2.5, "c": "3", "d": "4"}
+        assert isinstance(values["a"], int)
+
+    def test_match_types_invalid_value(self):
+        """Values which can't be converted are kept as strings."""
+        lua_rule = FakeLuaRule(
+            "(?P<a>\\S+)(?: (?P<b>\\S+))?", types={"a": "int", "b": "int"}
+        )
+        rule = LuaFileRule(Path("file.txt"), lua_rule)
+        assert rule.match("1.5") == {"a": "1.5", "b": None}
+
+    @pytest.mark.parametrize(
+        "types,message",
+        [
+            ({"other": "int"}, "unknown group: other"),
+            ({"val": "date"}, 'unknown type for group "val": date'),
+            ({"val": ["int"]}, "unknown type for group \"val\": ['int']"),
+        ],
+    )
+    def test_invalid_types(self, types, message):
+        """An error is raised if declared types are invalid."""
+        lua_rule = FakeLuaRule("foo(?P<val>.*)foo", types=types)
+        with pytest.raises(ValueError) as err:
+            LuaFileRule(Path("file.txt"), lua_rule)
+        assert str(err.value) == message
+
+    def test_batched(self):
+        """Rules are batched if they define a batch action."""
+        assert not LuaFileRule("rule", FakeLuaRule("foo")).batched
+        assert LuaFileRule("rule", FakeLuaBatchRule("foo")).batched
+
+    def test_match_binary(self):
+        """With an encoding, bytes lines are matched and values decoded."""
+        lua_rule = FakeLuaRule("foo(?P<val>.*)foo (?P<num>\\d+)")
+        rule = LuaFileRule(Path("file.txt"), lua_rule, encoding="utf-8")
+        assert rule.match("foobàrfoo 10".encode("utf-8")) == {"val": "bàr", "num": 10.0}
+
+    def test_match_binary_types(self):
+        """With an encoding, declared types are applied to decoded values."""
+        lua_rule = FakeLuaRule("(?P<a>\\S+) (?P<b>\\S+)", types={"a": "int"})
+        rule = LuaFileRule(Path("file.txt"), lua_rule, encoding="utf-8")
+        assert rule.match(b"10 20") == {"a": 10, "b": "20"}
+
+    def test_match_binary_encoding_errors(self):
+        """The error handling scheme is used for decoding values."""
+        lua_rule = FakeLuaRule("foo(?P<val>.*)foo")
+        rule = LuaFileRule(
+            Path("file.txt"), lua_rule, encoding="utf-8", encoding_errors="replace"
+        )
+        assert rule.match(b"foob\xe8rfoo") == {"val": "b\ufffdr"}
+
+    def test_match_sampled(self, stats):
+        """With a sample rate, only one in that many matches is returned."""
+        lua_rule = FakeLuaRule("foo(?P<val>.*)foo")
+        lua_rule.sample = 2
+        sampled_out = stats.rule_sampled_out.labels("rules.lua", "rule")
+        rule = LuaFileRule("rule", lua_rule, sampled_out=sampled_out)
+        assert rule.sample_rate == 2
+        assert [rule.match(f"foo{i}foo") for i in range(4)] == [
+            {"val": 0.0},
+            None,
+            {"val": 2.0},
+            None,
+        ]
+        assert rule.match("bar") is None
+        assert sampled_out._value.get() == 2
+
+    def test_match_sampled_no_counter(self):
+        """Matches can be sampled without counting those skipped."""
+        lua_rule = FakeLuaRule("foo")
+        lua_rule.sample = 2.0
+        rule = LuaFileRule("rule", lua_rule)
+        assert rule.sample_rate == 2
+        assert [rule.match("foo"), rule.match("foo")] == [{}, None]
+
+    def test_match_sampled_random(self, monkeypatch):
+        """Matches can be sampled at random."""
+        values = iter([0.9, 0.1])
+        monkeypatch.setattr(random, "random", lambda: next(values))
+        lua_rule = FakeLuaRule("foo")
+        lua_rule.sample = 2
+        lua_rule.random_sample = True
+        rule = LuaFileRule("rule", lua_rule)
+        assert [rule.match("foo"), rule.match("foo")] == [None, {}]
+
+    def test_sampled_actions_weighted(self):
+        """With a weight, actions run with it set to the sample rate."""
+        weights = []
+        weight = SampleWeight()
+        lua_rule = FakeLuaRule("foo")
+        lua_rule.sample = 3
+        lua_rule.action = lambda values: weights.append(weight.value)
+        rule = LuaFileRule("rule", lua_rule, weight=weight)
+        rule.action({})
+        assert weights == [3]
+        assert weight.value == 1
+
+    @pytest.mark.parametrize("sample", [0, 1.5, "foo", True])
+    def test_invalid_sample_rate(self, sample):
+        """A ValueError is raised if the sample rate is invalid."""
+        lua_rule = FakeLuaRule("foo")
+        lua_rule.sample = sample
+        with pytest.raises(ValueError) as err:
+            LuaFileRule("rule", lua_rule)
+        assert str(err.value) == f"invalid sample rate: {sample}"
+
+    def test_batch_action_table_from(self):
+        """The batch action is called with matches converted by table_from."""
+        lua_rule = FakeLuaBatchRule("foo")
+        rule = LuaFileRule("rule", lua_rule, table_from=tuple)
+        rule.batch_action([{"val": 1}, {"val": 2}])
+        assert lua_rule.calls == [({"val": 1}, {"val": 2})]
+
+    def test_batch_action_not_batched(self):
+        """Calling batch_action on a rule without one raises an error."""
+        rule = LuaFileRule("rule", FakeLuaRule("foo"))
+        with pytest.raises(TypeError) as error:
+            rule.batch_action([{}])
+        assert str(error.value) == 'rule "rule" has no batch action'
+
+
+class TestDeclarativeRule:
+    def test_match(self):
+        """match returns match groups as strings."""
+        rule = DeclarativeRule("rule", re.compile("foo(?P<val>.*)foo"), print)
+        assert rule.match("foo10foo") == {"val": "10"}
+
+    def test_match_no_match(self):
+        """match returns None if the line doesn't match."""
+        rule = DeclarativeRule("rule", re.compile("foo(?P<val>.*)foo"), print)
+        assert rule.match("barfoobar") is None
+
+    def test_not_batched(self):
+        """Declarative rules are not batched."""
+        assert not DeclarativeRule("rule", re.compile("foo"), print).batched
+
+    def test_batch_action(self):
+        """Calling batch_action on a declarative rule raises an error."""
+        rule = DeclarativeRule("rule", re.compile("foo"), print)
+        with pytest.raises(TypeError) as error:
+            rule.batch_action([{}])
+        assert str(error.value) == 'rule "rule" has no batch action'
+
+    def test_match_binary(self):
+        """With an encoding, bytes lines are matched and values decoded."""
+        rule = DeclarativeRule(
+            "rule", re.compile(b"foo(?P<val>.*)foo"), print, encoding="latin-1"
+        )
+        assert rule.match(b"foo\xe8foo") == {"val": "\xe8"}
+
+
+class TestCompileRegexp:
+    def test_text(self):
+        """Without an encoding, a text regexp is returned."""
+        assert compile_regexp("fòo").pattern == "fòo"
+
+    def test_bytes(self):
+        """With an encoding, a bytes regexp is returned."""
+        assert compile_regexp("fòo", "utf-8").pattern == "fòo".encode("utf-8")
+
+
+class TestMatchGroups:
+    def test_text(self):
+        """Without an encoding, groups are returned as they are."""
+        match = re.search("(?P<a>foo)(?P<b>x)?", "foo")
+        assert match_groups(match) == {"a": "foo", "b": None}
+
+    def test_decode(self):
+        """With an encoding, matched groups are decoded."""
+        match = re.search(b"(?P<a>\xe8)(?P<b>x)?", b"\xe8")
+        assert match_groups(match, "latin-1") == {"a": "\xe8", "b": None}
+
 
 @pytest.fixture
 def registry():
@@ -139,6 +621,248 @@ class TestRuleRegistry:
         # The rule code has called the call() method on the metric
         assert metric.calls == [{"val": "bar"}, {"val": "baz"}]
 
+    def test_rule_analyzer_run_batch_action(self, rule_file, log_file):
+        """The returned FileAnalyzer runs the batch action with a Lua table."""
+
+        class FakeMetric:
+            def __init__(self):
+                self.calls = []
+
+            def call(self, *args):
+                self.calls.append(args)
+
+        metric = FakeMetric()
+        registry = RuleRegistry({"metric": metric})
+        rule_code = """
+        rules.rule = Rule('foo(?P<val>.*)foo')
+        function rules.rule.batch_action(matches)
+          local total = 0
+          for _, match in ipairs(matches) do
+            total = total + match.val
+          end
+          metrics.metric.call(#matches, total)
+        end
+        """
+        rule_file.write_text(rule_code, "utf-8")
+        analyzer = registry.get_file_analyzer(log_file, rule_file)
+        analyzer.analyze_lines(["foo1foo", "baz foo", "foo2foo"])
+        analyzer.analyze_lines(["foo3foo"])
+        assert metric.calls == [(2, 3.0), (1, 3.0)]
+
+    def test_rule_analyzer_group_types(self, rule_file, log_file):
+        """Group types can be declared for Lua rules."""
+
+        class FakeMetric:
+            def __init__(self):
+                self.calls = []
+
+            def call(self, *args):
+                self.calls.append(args)
+
+        metric = FakeMetric()
+        registry = RuleRegistry({"metric": metric})
+        rule_code = """
+        rules.rule = Rule([[(?P<count>\\d+) (?P<code>\\d+)]], {count='int'})
+        function rules.rule.action(match)
+          metrics.metric.call(match.count + 1, match.code)
+        end
+        """
+        rule_file.write_text(rule_code, "utf-8")
+        analyzer = registry.get_file_analyzer(log_file, rule_file)
+        analyzer.analyze_line("10 200")
+        assert metric.calls == [(11, "200")]
+
+    def test_rule_group_types_lua_runtime(self, rule_file, log_file, registry):
+        """Group types can be declared by rules in non-default runtimes."""
+        # the default runtime is used if LuaJIT is not available
+        metric = Gauge("metric", "A metric", registry=CollectorRegistry())
+        registry = RuleRegistry({"metric": metric})
+        rule_code = """
+        rules.rule = Rule([[(?P<count>\\d+)]], {count='int'})
+        function rules.rule.action(match)
+          metrics.metric:set(match.count + 1)
+        end
+        """
+        rule_file.write_text(rule_code, "utf-8")
+        analyzer = registry.get_file_analyzer(
+            log_file, rule_file, lua_runtime="luajit21"
+        )
+        analyzer.analyze_line("10")
+        assert metric._value.get() == 11
+
+    def test_rule_group_types_table_like(self):
+        """Group types are accepted from objects with the table interface."""
+        # as tables from runtimes in lupa modules other than the default one
+        rule = LuaRule("(?P<count>\\d+)", types={"count": "int"})
+        assert rule.types == {"count": "int"}
+
+    def test_rule_invalid_group_types(self, rule_file, log_file, registry):
+        """Invalid group types for Lua rules raise an error."""
+        rule_code = """rules.rule = Rule('foo(?P<val>.*)foo', {val='date'})"""
+        rule_file.write_text(rule_code, "utf-8")
+        with pytest.raises(RuleSyntaxError) as err:
+            registry.get_file_analyzer(log_file, rule_file)
+        assert str(err.value) == (
+            f'in {rule_file}: rule "rule": unknown type for group "val": date'
+        )
+
+    @pytest.mark.parametrize("types", ["'int'", "1", "true"])
+    def test_rule_group_types_not_table(self, rule_file, log_file, registry, types):
+        """Group types for Lua rules must be a table."""
+        rule_code = f"rules.rule = Rule('foo(?P<val>.*)foo', {types})"
+        rule_file.write_text(rule_code, "utf-8")
+        with pytest.raises(RuleSyntaxError) as err:
+            registry.get_file_analyzer(log_file, rule_file)
+        assert str(err.value).startswith(
+            f"in {rule_file}: group types must be a table: "
+        )
+
+    def test_get_file_analyzer_binary(self, rule_file, log_file, registry):
+        """With binary mode, rules match bytes lines."""
+        analyzer = registry.get_file_analyzer(
+            log_file,
+            rule_file,
+            binary=True,
+            encoding="latin-1",
+            encoding_errors="replace",
+        )
+        assert analyzer.binary
+        assert analyzer.encoding == "latin-1"
+        assert analyzer.encoding_errors == "replace"
+        assert analyzer.rules[0].regexp.pattern == b"regexp"
+
+    def test_get_file_analyzer_binary_rules_cached_separately(
+        self, rule_file, registry
+    ):
+        """Rules for binary and text mode are not shared."""
+        analyzer1 = registry.get_file_analyzer("file1.txt", rule_file)
+        analyzer2 = registry.get_file_analyzer("file2.txt", rule_file, binary=True)
+        analyzer3 = registry.get_file_analyzer("file3.txt", rule_file, binary=True)
+        assert analyzer1.rules != analyzer2.rules
+        assert analyzer2.rules == analyzer3.rules
+
+    def test_get_file_analyzer_stats(self, rule_file, log_file, stats):
+        """Stats for rules are labeled with the rules file."""
+        registry = RuleRegistry({}, stats=stats)
+        analyzer = registry.get_file_analyzer(log_file, rule_file)
+        analyzer.analyze_lines(["a regexp line"])
+        rule_stats = stats.rule(str(rule_file), "rule")
+        assert rule_stats.matches._value.get() == 1
+
+    def test_get_file_analyzer_sampled_rule(self, rule_file, log_file, stats):
+        """Counter increments from sampled rules are scaled."""
+        rule_code = """
+        rules.rule = Rule([[foo (?P<val>\\d+)]], nil, 2)
+        function rules.rule.action(match)
+          metrics.counter.inc(match.val)
+          metrics.gauge.set(match.val)
+        end
+        rules.other = Rule([[foo]])
+        function rules.other.action(match)
+          metrics.counter.inc()
+        end
+        """
+        rule_file.write_text(rule_code, "utf-8")
+        metrics_registry = CollectorRegistry()
+        counter = Counter("counter", "A counter", registry=metrics_registry)
+        gauge = Gauge("gauge", "A gauge", registry=metrics_registry)
+        registry = RuleRegistry({"counter": counter, "gauge": gauge}, stats=stats)
+        analyzer = registry.get_file_analyzer(log_file, rule_file)
+        analyzer.analyze_lines(["foo 1", "foo 2", "foo 3", "foo 4"])
+        # sampled matches count twice, the other rule matches all lines
+        assert counter._value.get() == 2 * (1 + 3) + 4
+        assert gauge._value.get() == 3
+        rule_stats = stats.rule(str(rule_file), "rule")
+        assert rule_stats.matches._value.get() == 2
+        sampled_out = stats.rule_sampled_out.labels(str(rule_file), "rule")
+        assert sampled_out._value.get() == 2
+
+    def test_get_file_analyzer_sampled_rule_captured_metrics(self, rule_file, log_file):
+        """Counters are scaled also if metrics are referenced at load time."""
+        rule_code = """
+        local counter = metrics.counter
+        rules.rule = Rule([[foo]], nil, 2)
+        function rules.rule.action(match)
+          counter.inc()
+        end
+        """
+        rule_file.write_text(rule_code, "utf-8")
+        counter = Counter("counter", "A counter", registry=CollectorRegistry())
+        registry = RuleRegistry({"counter": counter})
+        analyzer = registry.get_file_analyzer(log_file, rule_file)
+        analyzer.analyze_lines(["foo", "foo", "foo", "foo"])
+        assert counter._value.get() == 4
+
+    def test_get_file_analyzer_sampled_batch_rule(self, rule_file, log_file):
+        """Counter increments from sampled batch rules are scaled."""
+        rule_code = """
+        rules.rule = Rule([[foo]])
+        rules.rule.sample = 2
+        function rules.rule.batch_action(matches)
+          metrics.counter.inc(#matches)
+        end
+        """
+        rule_file.write_text(rule_code, "utf-8")
+        counter = Counter("counter", "A counter", registry=CollectorRegistry())
+        registry = RuleRegistry({"counter": counter})
+        analyzer = registry.get_file_analyzer(log_file, rule_file)
+        analyzer.analyze_lines(["foo", "foo", "foo"])
+        assert counter._value.get() == 4
+
+    def test_get_file_analyzer_buffer_updates(self, rule_file, log_file):
+        """Metric updates can be buffered, and applied after each batch."""
+        rule_code = """
+        rules.rule = Rule([[foo (?P<val>\\d+)]])
+        function rules.rule.action(match)
+          metrics.counter.inc(match.val)
+          metrics.summary.observe(match.val)
+          metrics.gauge.set(match.val)
+        end
+        """
+        rule_file.write_text(rule_code, "utf-8")
+        metrics_registry = CollectorRegistry()
+        metrics = {
+            "counter": Counter("counter", "A counter", registry=metrics_registry),
+            "summary": Summary("summary", "A summary", registry=metrics_registry),
+            "gauge": Gauge("gauge", "A gauge", registry=metrics_registry),
+        }
+        registry = RuleRegistry(metrics, buffer_updates=True)
+        analyzer = registry.get_file_analyzer(log_file, rule_file)
+        [rule] = analyzer.rules
+        assert rule.buffer is not None
+        analyzer.analyze_lines(["foo 1", "foo 2"])
+        assert metrics["counter"]._value.get() == 3
+        assert metrics["summary"]._count.get() == 2
+        assert metrics["gauge"]._value.get() == 2
+
+    def test_get_file_analyzer_buffer_updates_sampled(self, rule_file, log_file, stats):
+        """Buffered counter increments from sampled rules are scaled."""
+        rule_code = """
+        rules.rule = Rule([[foo]], nil, 2)
+        function rules.rule.action(match)
+          metrics.counter.inc()
+        end
+        """
+        rule_file.write_text(rule_code, "utf-8")
+        counter = Counter("counter", "A counter", registry=CollectorRegistry())
+        registry = RuleRegistry({"counter": counter}, stats=stats, buffer_updates=True)
+        analyzer = registry.get_file_analyzer(log_file, rule_file)
+        analyzer.analyze_lines(["foo", "foo", "foo"])
+        assert counter._value.get() == 4
+
+    def test_get_file_analyzer_no_buffer_updates(self, rule_file, registry):
+        """By default, metric updates are not buffered."""
+        analyzer = registry.get_file_analyzer("file.txt", rule_file)
+        [rule] = analyzer.rules
+        assert rule.buffer is None
+
+    def test_get_file_analyzer_invalid_sample_rate(self, rule_file, registry):
+        """An error is raised if the sample rate of a rule is invalid."""
+        rule_file.write_text("rules.rule = Rule('foo', nil, 0)", "utf-8")
+        with pytest.raises(RuleSyntaxError) as err:
+            registry.get_file_analyzer("file.txt", rule_file)
+        assert str(err.value) == f'in {rule_file}: rule "rule": invalid sample rate: 0'
+
     def test_rule_print_logs(self, rule_file, caplog, log_file, registry):
         """The print function logs."""
         rule_code = """
@@ -168,6 +892,407 @@ class TestRuleRegistry:
             registry.get_file_analyzer(log_file, rule_file)
         assert "unexpected symbol" in str(err.value)
 
+    def test_get_file_analyzer_lua_runtime(self, monkeypatch, rule_file, registry):
+        """Lua rules can use a runtime from a lupa module."""
+        runtimes = []
+
+        def new_runtime(**kwargs):
+            runtime = lupa.LuaRuntime(**kwargs)
+            runtimes.append(runtime)
+            return runtime
+
+        monkeypatch.setitem(
+            sys.modules,
+            "lupa.luajit21",
+            SimpleNamespace(LuaRuntime=new_runtime, LuaError=lupa.LuaError),
+        )
+        analyzer = registry.get_file_analyzer(
+            "file1.txt", rule_file, lua_runtime="luajit21"
+        )
+        assert len(runtimes) == 1
+        assert analyzer.rules[0].regexp.pattern == "regexp"
+
+    @pytest.mark.parametrize(
+        "rule_code,message",
+        [
+            ("!WRONG", "unexpected symbol"),
+            ("error('boom')", ":1: boom"),
+        ],
+    )
+    def test_get_file_analyzer_lua_runtime_error(
+        self, monkeypatch, rule_file, registry, rule_code, message
+    ):
+        """Errors from Lua runtimes in other lupa modules are reported."""
+
+        class LuaError(Exception):
+            """Each lupa module has its own exception classes."""
+
+        class LuaRuntime(lupa.LuaRuntime):
+            def execute(self, code):
+                try:
+                    return super().execute(code)
+                except lupa.LuaError as error:
+                    raise LuaError(str(error))
+
+        monkeypatch.setitem(
+            sys.modules,
+            "lupa.luajit21",
+            SimpleNamespace(LuaRuntime=LuaRuntime, LuaError=LuaError),
+        )
+        rule_file.write_text(rule_code, "utf-8")
+        with pytest.raises(RuleSyntaxError) as err:
+            registry.get_file_analyzer("file1.txt", rule_file, lua_runtime="luajit21")
+        assert str(err.value).startswith(f"in {rule_file}:")
+        assert message in str(err.value)
+
+    def test_get_file_analyzer_lua_runtime_alias(
+        self, monkeypatch, rule_file, registry
+    ):
+        """The "luajit" runtime uses the most recent available LuaJIT."""
+        monkeypatch.setitem(sys.modules, "lupa.luajit21", None)
+        monkeypatch.setitem(sys.modules, "lupa.luajit20", lupa)
+        registry.get_file_analyzer("file1.txt", rule_file, lua_runtime="luajit")
+        assert registry._lua_runtimes == {"luajit": lupa}
+
+    def test_get_file_analyzer_lua_runtime_fallback(
+        self, monkeypatch, caplog, rule_file, registry
+    ):
+        """If the Lua runtime is not available, the default one is used."""
+        caplog.set_level(logging.WARNING)
+        monkeypatch.setitem(sys.modules, "lupa.lua51", None)
+        registry.get_file_analyzer("file1.txt", rule_file, lua_runtime="lua51")
+        registry.get_file_analyzer("file2.txt", rule_file, lua_runtime="lua51")
+        assert registry._lua_runtimes == {"lua51": lupa}
+        # the warning is logged once
+        assert caplog.messages == [
+            'Lua runtime "lua51" not available, using the default one'
+        ]
+
+    def test_get_file_analyzer_lua_runtime_rules_cached_separately(
+        self, monkeypatch, rule_file, registry
+    ):
+        """Rules for different Lua runtimes are not shared."""
+        monkeypatch.setitem(sys.modules, "lupa.lua51", None)
+        analyzer1 = registry.get_file_analyzer("file1.txt", rule_file)
+        analyzer2 = registry.get_file_analyzer(
+            "file2.txt", rule_file, lua_runtime="lua51"
+        )
+        assert analyzer1.rules != analyzer2.rules
+
+    def test_create_file_analyzers_lua_runtime(self, monkeypatch, rule_file, registry):
+        """The Lua runtime from file configs is used."""
+        monkeypatch.setitem(sys.modules, "lupa.lua51", None)
+        registry.get_file_analyzers(
+            {Path("file.txt"): FileConfig(str(rule_file), lua_runtime="lua51")}
+        )
+        assert list(registry._lua_runtimes) == ["lua51"]
+
+    def test_rule_paths(self, tmpdir, rule_file, registry):
+        """Paths of loaded rule files are returned."""
+        other_rule_file = Path(tmpdir / "other")
+        other_rule_file.write_text("")
+        registry.get_file_analyzer("file1.txt", other_rule_file)
+        registry.get_file_analyzer("file2.txt", rule_file)
+        registry.get_file_analyzer("file3.txt", rule_file, binary=True)
+        assert registry.rule_paths == [Path(other_rule_file), Path(rule_file)]
+
+    def test_reload_rules(self, caplog, rule_file, registry):
+        """Analyzers using rules from changed files get new rules."""
+        caplog.set_level(logging.INFO)
+        analyzer1 = registry.get_file_analyzer("file1.txt", rule_file)
+        analyzer2 = registry.get_file_analyzer("file2.txt", rule_file, binary=True)
+        rule_file.write_text("rules.rule = Rule('other')", "utf-8")
+        assert registry.reload_rules() == [Path(rule_file)]
+        assert analyzer1.rules[0].regexp.pattern == "other"
+        assert analyzer2.rules[0].regexp.pattern == b"other"
+        assert f"reloaded 1 rule(s) from {rule_file}" in caplog.messages
+        # rules are not reloaded again
+        assert registry.reload_rules() == []
+
+    def test_reload_rules_unchanged(self, tmpdir, rule_file, registry):
+        """Rules from unchanged files are kept."""
+        other_rule_file = Path(tmpdir / "other")
+        other_rule_file.write_text("rules.rule = Rule('other')")
+        analyzer1 = registry.get_file_analyzer("file1.txt", rule_file)
+        analyzer2 = registry.get_file_analyzer("file2.txt", other_rule_file)
+        rules = analyzer1.rules
+        other_rule_file.write_text("rules.rule = Rule('changed')")
+        assert registry.reload_rules() == [other_rule_file]
+        assert analyzer1.rules is rules
+        assert analyzer2.rules[0].regexp.pattern == "changed"
+
+    def test_reload_rules_keeps_metrics(self, rule_file, log_file):
+        """Metrics are kept when rules are reloaded."""
+        metric = Counter("metric", "A metric", registry=CollectorRegistry())
+        registry = RuleRegistry({"metric": metric})
+        rule_code = """
+        rules.rule = Rule('{}')
+        function rules.rule.action(match)
+          metrics.metric.inc()
+        end
+        """
+        rule_file.write_text(rule_code.format("foo"), "utf-8")
+        analyzer = registry.get_file_analyzer(log_file, rule_file)
+        analyzer.analyze_lines(["foo", "bar"])
+        rule_file.write_text(rule_code.format("bar"), "utf-8")
+        registry.reload_rules()
+        analyzer.analyze_lines(["foo", "bar"])
+        assert metric._value.get() == 2
+
+    def test_reload_rules_error(self, caplog, rule_file, registry):
+        """If rules can't be loaded, an error is logged and rules are kept."""
+        analyzer = registry.get_file_analyzer("file1.txt", rule_file)
+        rules = analyzer.rules
+        rule_file.write_text("!WRONG", "utf-8")
+        assert registry.reload_rules() == []
+        assert analyzer.rules is rules
+        [message] = caplog.messages[-1:]
+        assert message.startswith(f"failed reloading rules from {rule_file}: ")
+        assert "unexpected symbol" in message
+
+    @pytest.mark.parametrize(
+        "rule_code",
+        [
+            "error('boom')",
+            "undefined.rule = Rule('foo')",
+            "rules.rule = Rule('foo', 'int')",
+        ],
+    )
+    def test_reload_rules_runtime_error(self, caplog, rule_file, registry, rule_code):
+        """If running rules code fails, an error is logged and rules are kept."""
+        analyzer = registry.get_file_analyzer("file1.txt", rule_file)
+        rules = analyzer.rules
+        rule_file.write_text(rule_code, "utf-8")
+        assert registry.reload_rules() == []
+        assert analyzer.rules is rules
+        assert caplog.messages[-1].startswith(
+            f"failed reloading rules from {rule_file}: "
+        )
+
+    def test_reload_rules_error_other_files(self, tmpdir, rule_file, registry):
+        """An error reloading a file doesn't prevent reloading others."""
+        other_rule_file = Path(tmpdir / "other")
+        other_rule_file.write_text("rules.rule = Rule('other')")
+        registry.get_file_analyzer("file1.txt", rule_file)
+        analyzer = registry.get_file_analyzer("file2.txt", other_rule_file)
+        rule_file.write_text("error('boom')", "utf-8")
+        other_rule_file.write_text("rules.rule = Rule('changed')")
+        assert registry.reload_rules() == [other_rule_file]
+        assert analyzer.rules[0].regexp.pattern == "changed"
+
+    def test_reload_rules_file_removed(self, caplog, rule_file, registry):
+        """If a rule file is removed, an error is logged and rules are kept."""
+        analyzer = registry.get_file_analyzer("file1.txt", rule_file)
+        rules = analyzer.rules
+        rule_file.remove()
+        assert registry.reload_rules() == []
+        assert analyzer.rules is rules
+        assert caplog.messages[-1].startswith(
+            f"failed reloading rules from {rule_file}: "
+        )
+
+
+@pytest.fixture
+def declarative_metrics():
+    registry = CollectorRegistry()
+    yield {
+        "requests": Counter("requests", "requests", registry=registry),
+        "by_method": Counter(
+            "by_method", "by method", labelnames=["method"], registry=registry
+        ),
+        "size": Gauge("size", "size", registry=registry),
+        "time": Summary("time", "time", labelnames=["path"], registry=registry),
+    }
+
+
+@pytest.fixture
+def declarative_rule_file(tmpdir):
+    yield Path(tmpdir / "rules.yaml")
+
+
+def sample_value(metric, suffix="_total", **labels):
+    """Return the value of a metric sample."""
+    for family in metric.collect():
+        for sample in family.samples:
+            if sample.name == family.name + suffix and sample.labels == labels:
+                return sample.value
+
+
+class TestRuleRegistryDeclarative:
+    def test_rules(self, declarative_rule_file, declarative_metrics, log_file):
+        """Declarative rules call metric operations with match groups."""
+        declarative_rule_file.write_text(
+            """
+            rules:
+              requests:
+                regexp: 'GET (?P<path>\\S+)'
+                metric: requests
+              by_method:
+                regexp: '(?P<method>GET|POST) '
+                metric: by_method
+                labels:
+                  method: method
+              size:
+                regexp: 'size=(?P<size>\\d+)'
+                metric: size
+                operation: set
+                value: size
+              time:
+                regexp: '(?P<path>/\\S*) time=(?P<time>[\\d.]+)'
+                metric: time
+                operation: observe
+                value: time
+                labels:
+                  path: path
+            """
+        )
+        registry = RuleRegistry(declarative_metrics)
+        analyzer = registry.get_file_analyzer(log_file, declarative_rule_file)
+        analyzer.analyze_lines(
+            [
+                "GET /foo time=0.5 size=10",
+                "POST /bar time=1.5",
+                "GET /foo time=2.0 size=20",
+            ]
+        )
+        requests = declarative_metrics["requests"]
+        by_method = declarative_metrics["by_method"]
+        size = declarative_metrics["size"]
+        time = declarative_metrics["time"]
+        assert sample_value(requests) == 2.0
+        assert sample_value(by_method, method="GET") == 2.0
+        assert sample_value(by_method, method="POST") == 1.0
+        assert sample_value(size, suffix="") == 20.0
+        assert sample_value(time, suffix="_sum", path="/foo") == 2.5
+        assert sample_value(time, suffix="_count", path="/bar") == 1.0
+
+    def test_binary(self, declarative_rule_file, declarative_metrics, log_file):
+        """Declarative rules can match bytes lines."""
+        declarative_rule_file.write_text(
+            """
+            rules:
+              by_method:
+                regexp: '(?P<method>GET|POST) '
+                metric: by_method
+                labels:
+                  method: method
+            """
+        )
+        registry = RuleRegistry(declarative_metrics)
+        analyzer = registry.get_file_analyzer(
+            log_file, declarative_rule_file, binary=True
+        )
+        analyzer.analyze_lines([b"GET /foo", b"POST /bar", b"GET /baz"])
+        by_method = declarative_metrics["by_method"]
+        assert sample_value(by_method, method="GET") == 2.0
+
+    def test_yml_suffix(self, tmpdir, declarative_metrics, log_file):
+        """Rule files with the .yml suffix are declarative."""
+        rule_file = Path(tmpdir / "rules.yml")
+        rule_file.write_text("rules: {rule: {regexp: foo, metric: requests}}")
+        registry = RuleRegistry(declarative_metrics)
+        analyzer = registry.get_file_analyzer(log_file, rule_file)
+        [rule] = analyzer.rules
+        assert isinstance(rule, DeclarativeRule)
+        assert rule.name == "rule"
+
+    def test_non_numeric_value_ignored(
+        self, declarative_rule_file, declarative_metrics, log_file
+    ):
+        """Lines with non-numeric values are ignored."""
+        declarative_rule_file.write_text(
+            """
+            rules:
+              size:
+                regexp: 'size=(?P<size>\\w+)?'
+                metric: size
+                operation: inc
+                value: size
+            """
+        )
+        registry = RuleRegistry(declarative_metrics)
+        analyzer = registry.get_file_analyzer(log_file, declarative_rule_file)
+        analyzer.analyze_lines(["size=3", "size=foo", "size=", "size=2"])
+        assert sample_value(declarative_metrics["size"], suffix="") == 5.0
+
+    def test_unmatched_label_group(
+        self, declarative_rule_file, declarative_metrics, log_file
+    ):
+        """Label groups not matching in a line give empty label values."""
+        declarative_rule_file.write_text(
+            """
+            rules:
+              by_method:
+                regexp: 'request(?: (?P<method>\\w+))?'
+                metric: by_method
+                labels:
+                  method: method
+            """
+        )
+        registry = RuleRegistry(declarative_metrics)
+        analyzer = registry.get_file_analyzer(log_file, declarative_rule_file)
+        analyzer.analyze_lines(["request", "request GET"])
+        by_method = declarative_metrics["by_method"]
+        assert sample_value(by_method, method="") == 1.0
+        assert sample_value(by_method, method="GET") == 1.0
+
+    @pytest.mark.parametrize(
+        "content,message",
+        [
+            ("rules: [", "while parsing a flow"),
+            ("foo: bar", 'a "rules" mapping is required'),
+            ("[]", 'a "rules" mapping is required'),
+            ("rules: {rule: foo}", 'rule "rule": must be a mapping'),
+            ("rules: {rule: {metric: requests}}", 'rule "rule": missing regexp'),
+            (
+                "rules: {rule: {regexp: '(', metric: requests}}",
+                'rule "rule": invalid regexp: missing ), unterminated subpattern',
+            ),
+            (
+                "rules: {rule: {regexp: 1, metric: requests}}",
+                'rule "rule": invalid regexp',
+            ),
+            (
+                "rules: {rule: {regexp: foo, metric: other}}",
+                'rule "rule": unknown metric: other',
+            ),
+            (
+                "rules: {rule: {regexp: foo, metric: requests, operation: set}}",
+                'rule "rule": unsupported operation: set',
+            ),
+            (
+                "rules: {rule: {regexp: foo, metric: requests, operation: foo}}",
+                'rule "rule": unsupported operation: foo',
+            ),
+            (
+                "rules: {rule: {regexp: foo, metric: size, operation: set}}",
+                'rule "rule": a value is required for "set"',
+            ),
+            (
+                "rules: {rule: {regexp: foo, metric: requests, labels: [foo]}}",
+                'rule "rule": labels must be a mapping',
+            ),
+            (
+                "rules: {rule: {regexp: foo, metric: requests, value: val}}",
+                'rule "rule": unknown group: val',
+            ),
+            (
+                "rules: {rule: {regexp: foo, metric: requests, labels: {l: g}}}",
+                'rule "rule": unknown group: g',
+            ),
+        ],
+    )
+    def test_invalid(
+        self, declarative_rule_file, declarative_metrics, log_file, content, message
+    ):
+        """Errors in declarative rules are reported."""
+        declarative_rule_file.write_text(content)
+        registry = RuleRegistry(declarative_metrics)
+        with pytest.raises(RuleSyntaxError) as err:
+            registry.get_file_analyzer(log_file, declarative_rule_file)
+        assert str(err.value).startswith(f"in {declarative_rule_file}: ")
+        assert message in str(err.value)
+
 
 class TestCreateFileAnalyzers:
     def test_create_analyzers(self, tmpdir):
@@ -187,8 +1312,8 @@ class TestCreateFileAnalyzers:
         rule_file2 = tmpdir / "rule2"
         rule_file2.write_text(rule_code2, "utf-8")
         rules_map = {
-            Path("file1.txt").absolute(): rule_file1,
-            Path("file2.txt").absolute(): rule_file2,
+            Path("file1.txt").absolute(): FileConfig(str(rule_file1)),
+            Path("file2.txt").absolute(): FileConfig(str(rule_file2)),
         }
         metrics = {"metric1": object(), "metric2": object()}
         analyzers = create_file_analyzers(rules_map, metrics)
@@ -198,3 +1323,31 @@ class TestCreateFileAnalyzers:
         # Each file uses a different rule (since they come from different
         # rule files)
         assert analyzer1.rules[0] is not analyzer2.rules[0]
+
+    def test_create_analyzers_file_options(self, tmpdir, rule_file):
+        """Options for files are passed to analyzers."""
+        files = {
+            Path("file.txt"): FileConfig(
+                str(rule_file),
+                binary=True,
+                encoding_errors="replace",
+                max_line_length=100,
+                long_lines="drop",
+                multiline=MultilineConfig("start"),
+                lookback=LookbackConfig("^\\S+", 60),
+            )
+        }
+        [analyzer] = create_file_analyzers(files, {})
+        assert analyzer.binary
+        assert analyzer.encoding_errors == "replace"
+        assert analyzer.max_line_length == 100
+        assert analyzer.drop_long_lines
+        assert analyzer.multiline == MultilineConfig("start")
+        assert analyzer.lookback == LookbackConfig("^\\S+", 60)
+
+    def test_create_analyzers_stats(self, rule_file, stats):
+        """Stats are passed to analyzers."""
+        files = {Path("file.txt"): FileConfig(str(rule_file))}
+        [analyzer] = create_file_analyzers(files, {}, stats=stats)
+        analyzer.analyze_lines(["regexp"])
+        assert stats.rule(str(rule_file), "rule").matches._value.get() == 1
@@ -0,0 +1,107 @@
+import random
+
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+)
+import pytest
+
+from ..sampling import (
+    Sampler,
+    SampleWeight,
+    scale_counters,
+    ScaledCounter,
+    weighted_action,
+)
+
+
+@pytest.fixture
+def registry():
+    yield CollectorRegistry()
+
+
+@pytest.fixture
+def weight():
+    yield SampleWeight()
+
+
+class TestSampler:
+    def test_select(self):
+        """One in every rate matches is selected."""
+        sampler = Sampler(3)
+        assert [sampler.select() for _ in range(7)] == [
+            True,
+            False,
+            False,
+            True,
+            False,
+            False,
+            True,
+        ]
+
+    def test_select_random(self, monkeypatch):
+        """Matches can be selected at random."""
+        values = iter([0.1, 0.5, 0.3])
+        monkeypatch.setattr(random, "random", lambda: next(values))
+        sampler = Sampler(3, random_sample=True)
+        assert [sampler.select() for _ in range(3)] == [True, False, True]
+
+
+class TestScaledCounter:
+    def test_inc(self, registry, weight):
+        """Increments are scaled by the weight."""
+        counter = Counter("counter", "A counter", registry=registry)
+        scaled = ScaledCounter(counter, weight)
+        scaled.inc()
+        weight.value = 10
+        scaled.inc(2)
+        assert counter._value.get() == 21
+
+    def test_labels(self, registry, weight):
+        """Increments of child counters are scaled."""
+        counter = Counter("counter", "A counter", ["label"], registry=registry)
+        scaled = ScaledCounter(counter, weight)
+        weight.value = 5
+        scaled.labels("foo").inc()
+        scaled.labels(label="bar").inc(2)
+        assert counter.labels("foo")._value.get() == 5
+        assert counter.labels("bar")._value.get() == 10
+
+    def test_proxy_attributes(self, registry, weight):
+        """Other attributes are proxied to the counter."""
+        counter = Counter("counter", "A counter", registry=registry)
+        assert ScaledCounter(counter, weight).describe() == counter.describe()
+
+
+class TestScaleCounters:
+    def test_scale_counters(self, registry, weight):
+        """Only counters are wrapped."""
+        counter = Counter("counter", "A counter", registry=registry)
+        gauge = Gauge("gauge", "A gauge", registry=registry)
+        metrics = scale_counters({"counter": counter, "gauge": gauge}, weight)
+        assert isinstance(metrics["counter"], ScaledCounter)
+        assert metrics["gauge"] is gauge
+
+
+class TestWeightedAction:
+    def test_weight_set(self, weight):
+        """The weight is set while the action runs."""
+        calls = []
+        action = weighted_action(
+            lambda arg: calls.append((arg, weight.value)), weight, 4
+        )
+        action("foo")
+        assert calls == [("foo", 4)]
+        assert weight.value == 1
+
+    def test_weight_reset_on_error(self, weight):
+        """The weight is reset if the action fails."""
+
+        def fail(arg):
+            raise RuntimeError("boom")
+
+        action = weighted_action(fail, weight, 4)
+        with pytest.raises(RuntimeError):
+            action("foo")
+        assert weight.value == 1
@@ -0,0 +1,153 @@
+import json
+import logging
+from pathlib import Path
+
+import pytest
+
+from ..state import (
+    FilePosition,
+    FilePositions,
+)
+
+
+@pytest.fixture
+def state_file(tmpdir):
+    yield Path(tmpdir / "state.json")
+
+
+@pytest.fixture
+def positions(state_file):
+    yield FilePositions(state_file)
+
+
+class TestFilePositions:
+    def test_get_unknown(self, positions):
+        """get returns None for unknown files."""
+        assert positions.get(Path("/file.txt")) is None
+
+    def test_set(self, positions):
+        """set sets the position for a file."""
+        position = FilePosition(1, 2, 3)
+        positions.set(Path("/file.txt"), position)
+        assert positions.get(Path("/file.txt")) == position
+
+    def test_remove(self, positions):
+        """remove removes the position for a file."""
+        positions.set(Path("/file.txt"), FilePosition(1, 2, 3))
+        positions.remove(Path("/file.txt"))
+        assert positions.get(Path("/file.txt")) is None
+
+    def test_remove_unknown(self, positions):
+        """Removing an unknown file is a no-op."""
+        positions.remove(Path("/file.txt"))
+        assert positions.get(Path("/file.txt")) is None
+
+    def test_find(self, positions):
+        """find returns the path and position for a file by identity."""
+        position = FilePosition(1, 2, 3)
+        positions.set(Path("/file1.txt"), FilePosition(1, 3, 4))
+        positions.set(Path("/file2.txt"), position)
+        assert positions.find(1, 2) == (Path("/file2.txt"), position)
+
+    def test_find_unknown(self, positions):
+        """find returns None if no file has the identity."""
+        positions.set(Path("/file.txt"), FilePosition(1, 2, 3))
+        assert positions.find(2, 2) is None
+
+    def test_prune(self, tmpdir, state_file, positions):
+        """prune removes positions for files that don't exist."""
+        path = Path(tmpdir / "file.txt")
+        path.write_text("")
+        positions.set(path, FilePosition(1, 2, 3))
+        positions.set(Path(tmpdir / "other.txt"), FilePosition(1, 3, 3))
+        positions.save()
+        positions.prune()
+        assert positions.get(Path(tmpdir / "other.txt")) is None
+        positions.save()
+        assert list(json.loads(state_file.read_text())) == [str(path)]
+
+    def test_prune_renamed(self, tmpdir, positions):
+        """prune keeps positions for files renamed within the same directory."""
+        path = Path(tmpdir / "file.txt")
+        path.write_text("")
+        stat = path.stat()
+        positions.set(path, FilePosition(stat.st_dev, stat.st_ino, 3))
+        path.rename(tmpdir / "file.txt.1")
+        positions.prune()
+        assert positions.get(path) == FilePosition(stat.st_dev, stat.st_ino, 3)
+
+    def test_prune_directory_not_found(self, tmpdir, positions):
+        """prune removes positions for files in directories that don't exist."""
+        path = Path(tmpdir / "dir" / "file.txt")
+        positions.set(path, FilePosition(1, 2, 3))
+        positions.prune()
+        assert positions.get(path) is None
+
+    def test_save(self, state_file, positions):
+        """save writes positions to file."""
+        positions.set(Path("/file.txt"), FilePosition(1, 2, 3))
+        positions.save()
+        assert json.loads(state_file.read_text()) == {
+            "/file.txt": {"device": 1, "inode": 2, "offset": 3, "complete": False}
+        }
+        # no temporary file is left around
+        assert list(state_file.parent.iterdir()) == [state_file]
+
+    def test_save_only_if_changed(self, state_file, positions):
+        """The state file is written only if positions changed."""
+        positions.set(Path("/file.txt"), FilePosition(1, 2, 3))
+        positions.save()
+        state_file.unlink()
+        positions.set(Path("/file.txt"), FilePosition(1, 2, 3))
+        positions.save()
+        assert not state_file.exists()
+
+    def test_save_after_remove(self, state_file, positions):
+        """Removing a position causes the file to be saved."""
+        positions.set(Path("/file.txt"), FilePosition(1, 2, 3))
+        positions.save()
+        positions.remove(Path("/file.txt"))
+        positions.save()
+        assert json.loads(state_file.read_text()) == {}
+
+    def test_save_error(self, caplog, tmpdir):
+        """An error is logged if saving the state file fails."""
+        positions = FilePositions(Path(tmpdir / "not-here" / "state.json"))
+        positions.set(Path("/file.txt"), FilePosition(1, 2, 3))
+        positions.save()
+        [message] = caplog.messages
+        assert message.startswith("failed saving state file:")
+
+    def test_load(self, state_file, positions):
+        """load reads positions from file."""
+        state_file.write_text(
+            json.dumps({"/file.txt": {"device": 1, "inode": 2, "offset": 3}})
+        )
+        positions.load()
+        assert positions.get(Path("/file.txt")) == FilePosition(1, 2, 3)
+
+    def test_load_complete(self, state_file, positions):
+        """load reads whether files have been read completely."""
+        state_file.write_text(
+            json.dumps(
+                {"/file.gz": {"device": 1, "inode": 2, "offset": 3, "complete": True}}
+            )
+        )
+        positions.load()
+        assert positions.get(Path("/file.gz")) == FilePosition(1, 2, 3, True)
+
+    def test_load_not_found(self, positions):
+        """If the state file doesn't exist, no position is loaded."""
+        positions.load()
+        assert positions.get(Path("/file.txt")) is None
+
+    @pytest.mark.parametrize(
+        "content", ["not json", "[]", '{"/file.txt": {"device": 1}}']
+    )
+    def test_load_invalid(self, caplog, state_file, positions, content):
+        """If the state file is invalid, a warning is logged."""
+        caplog.set_level(logging.WARNING)
+        state_file.write_text(content)
+        positions.load()
+        assert positions.get(Path("/file.txt")) is None
+        assert caplog.messages == [f"invalid state file {state_file}, ignoring"]
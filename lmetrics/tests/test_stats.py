@@ -0,0 +1,92 @@
+from pathlib import Path
+
+from prometheus_client import CollectorRegistry
+import pytest
+
+from ..stats import Stats
+
+
+@pytest.fixture
+def registry():
+    yield CollectorRegistry()
+
+
+@pytest.fixture
+def stats(registry):
+    yield Stats(registry)
+
+
+class TestStats:
+    def test_file_read(self, registry, stats):
+        """Bytes and lines read are accumulated for each file."""
+        stats.file_read(Path("/file1"), 10, 2)
+        stats.file_read(Path("/file1"), 5, 1)
+        stats.file_read(Path("/file2"), 3, 1)
+        labels = {"file": "/file1"}
+        assert registry.get_sample_value("lmetrics_bytes_read_total", labels) == 15
+        assert registry.get_sample_value("lmetrics_lines_read_total", labels) == 3
+        labels = {"file": "/file2"}
+        assert registry.get_sample_value("lmetrics_bytes_read_total", labels) == 3
+
+    def test_file_read_long_lines(self, registry, stats):
+        """Long lines are counted for each file."""
+        stats.file_read(Path("/file1"), 10, 2, long_lines=1)
+        stats.file_read(Path("/file1"), 5, 1, long_lines=2)
+        stats.file_read(Path("/file2"), 3, 1)
+        labels = {"file": "/file1"}
+        assert registry.get_sample_value("lmetrics_long_lines_total", labels) == 3
+        labels = {"file": "/file2"}
+        assert registry.get_sample_value("lmetrics_long_lines_total", labels) is None
+
+    def test_file_lag(self, registry, stats):
+        """The read lag is set for each file."""
+        stats.file_lag(Path("/file"), 100)
+        stats.file_lag(Path("/file"), 20)
+        labels = {"file": "/file"}
+        assert registry.get_sample_value("lmetrics_read_lag_bytes", labels) == 20
+
+    def test_forget_file(self, registry, stats):
+        """The read lag is no longer reported for forgotten files."""
+        stats.file_lag(Path("/file"), 100)
+        stats.forget_file(Path("/file"))
+        labels = {"file": "/file"}
+        assert registry.get_sample_value("lmetrics_read_lag_bytes", labels) is None
+
+    def test_forget_file_unknown(self, stats):
+        """Forgetting an unknown file is a no-op."""
+        stats.forget_file(Path("/file"))
+
+    def test_rule(self, registry, stats):
+        """Metrics for a rule are labeled with the rules file and name."""
+        rule_stats = stats.rule("rules.lua", "rule")
+        rule_stats.matches.inc(3)
+        labels = {"rules": "rules.lua", "rule": "rule"}
+        assert registry.get_sample_value("lmetrics_rule_matches_total", labels) == 3
+        assert (
+            registry.get_sample_value("lmetrics_rule_action_errors_total", labels) == 0
+        )
+
+    def test_rule_no_timing(self, registry, stats):
+        """By default, time spent by rules is not recorded."""
+        rule_stats = stats.rule("rules.lua", "rule")
+        assert rule_stats.regexp_seconds is None
+        assert rule_stats.action_seconds is None
+        metrics = {metric.name for metric in registry.collect()}
+        assert "lmetrics_rule_regexp_seconds" not in metrics
+        assert "lmetrics_rule_action_seconds" not in metrics
+
+    def test_rule_timing(self, registry):
+        """With rule timing, time spent by rules is recorded."""
+        stats = Stats(registry, rule_timing=True)
+        rule_stats = stats.rule("rules.lua", "rule")
+        rule_stats.regexp_seconds.inc(0.5)
+        rule_stats.action_seconds.inc(0.25)
+        labels = {"rules": "rules.lua", "rule": "rule"}
+        assert (
+            registry.get_sample_value("lmetrics_rule_regexp_seconds_total", labels)
+            == 0.5
+        )
+        assert (
+            registry.get_sample_value("lmetrics_rule_action_seconds_total", labels)
+            == 0.25
+        )
@@ -1,23 +1,71 @@
+import argparse
 import asyncio
+import bz2
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import logging
+import lzma
+import os
 from pathlib import Path
+import threading
 from typing import (
     Callable,
+    List,
     NamedTuple,
+    Optional,
 )
 
+from butter._inotify import InotifyEvent
+from butter.inotify import (
+    IN_CREATE,
+    IN_DELETE,
+    IN_MODIFY,
+)
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+)
 import pytest
 
+from ..backfill import Backfill
+from ..config import (
+    LookbackConfig,
+    MultilineConfig,
+)
+from ..lookback import Lookback
+from ..state import (
+    FilePosition,
+    FilePositions,
+)
+from ..stats import Stats
 from ..watch import (
+    BytesLineStream,
+    ChangeWatcher,
+    coalesce_events,
     create_watchers,
     FileWatcher,
+    InotifyDispatcher,
+    is_compressed,
+    LineStream,
+    parse_chunk_size,
+    rotation_order,
     WatchedFiles,
 )
+from ..workers import MergedCollector
 
 
 class FakeAnalyzer(NamedTuple):
 
     path: str
-    analyze_line: Callable[[str], None]
+    analyze_lines: Callable[[List[str]], None]
+    binary: bool = False
+    encoding: str = "utf-8"
+    encoding_errors: str = "strict"
+    max_line_length: int = 0
+    drop_long_lines: bool = False
+    multiline: Optional[MultilineConfig] = None
+    lookback: Optional[LookbackConfig] = None
+    flush: Callable[[], None] = lambda: None
 
 
 @pytest.fixture
@@ -39,7 +87,7 @@ def analyze_calls():
 
 @pytest.fixture
 def watcher(event_loop, watched_file, analyze_calls):
-    yield FileWatcher(watched_file, analyze_calls.append, loop=event_loop)
+    yield FileWatcher(watched_file, analyze_calls.extend, loop=event_loop)
 
 
 @pytest.mark.asyncio
@@ -52,6 +100,17 @@ class TestFileWatcher:
         await watcher.stop()
         assert analyze_calls == ["line1", "line2"]
 
+    async def test_file_invalid_data(self, watched_file, watcher, analyze_calls):
+        """Content that can't be decoded doesn't stop watching the file."""
+        watched_file.write_bytes(b"line1\nb\xe8r\n")
+        watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        with watched_file.open("a") as fd:
+            fd.write("line2\n")
+        await asyncio.sleep(0.1)  # let the loop run
+        await watcher.stop()
+        assert analyze_calls == ["line1", "b\ufffdr", "line2"]
+
     async def test_file_created_later(self, watched_file, watcher, analyze_calls):
         """If the file doesn't exist upfront, it's read once it's created."""
         watcher.watch()
@@ -139,11 +198,1086 @@ class TestFileWatcher:
         await watcher.stop()
         assert analyze_calls == ["line1", "line2", "line3", "line4"]
 
+    async def test_file_read_in_chunks(self, event_loop, watched_file, analyze_calls):
+        """File content is read in chunks, yielding to the loop in between."""
+        watched_file.write_text("line1\nline2\nline3\n")
+        watcher = FileWatcher(
+            watched_file, analyze_calls.extend, chunk_size=8, loop=event_loop
+        )
+
+        async def other_task():
+            analyze_calls.append("other")
+
+        event_loop.create_task(other_task())
+        await watcher._read_file_content(watched_file, from_start=True)
+        await watcher.stop()
+        assert analyze_calls == ["line1", "other", "line2", "line3"]
+
+    async def test_file_read_whole(self, event_loop, watched_file, analyze_calls):
+        """With a negative chunk size, file content is read at once."""
+        watched_file.write_text("line1\nline2\n")
+        watcher = FileWatcher(
+            watched_file, analyze_calls.extend, chunk_size=-1, loop=event_loop
+        )
+        await watcher._read_file_content(watched_file, from_start=True)
+        await watcher.stop()
+        assert analyze_calls == ["line1", "line2"]
+
+    async def test_file_binary(self, event_loop, watched_file, analyze_calls):
+        """In binary mode, lines are passed as bytes."""
+        watched_file.write_bytes(b"line1\nline\xe8\n")
+        watcher = FileWatcher(
+            watched_file, analyze_calls.extend, binary=True, loop=event_loop
+        )
+        watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        await watcher.stop()
+        assert analyze_calls == [b"line1", b"line\xe8"]
+
+    async def test_file_long_lines(self, event_loop, watched_file, analyze_calls):
+        """Long lines are truncated to the maximum length."""
+        watched_file.write_text("line1\n" + "x" * 20 + "\nline2\n")
+        watcher = FileWatcher(
+            watched_file,
+            analyze_calls.extend,
+            max_line_length=5,
+            chunk_size=4,
+            loop=event_loop,
+        )
+        watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        await watcher.stop()
+        assert analyze_calls == ["line1", "xxxxx", "line2"]
+
+    async def test_file_encoding_errors(self, event_loop, watched_file, analyze_calls):
+        """The error handling scheme for decoding can be specified."""
+        watched_file.write_bytes(b"line1\nline\xe8\n")
+        watcher = FileWatcher(
+            watched_file,
+            analyze_calls.extend,
+            encoding_errors="replace",
+            loop=event_loop,
+        )
+        watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        await watcher.stop()
+        assert analyze_calls == ["line1", "line\ufffd"]
+
+    async def test_file_modifications_coalesced(
+        self, event_loop, watched_file, analyze_calls
+    ):
+        """Modifications within the coalesce interval are read at once."""
+        calls = []
+        watched_file.write_text("")
+        watcher = FileWatcher(
+            watched_file, calls.append, coalesce_interval=0.2, loop=event_loop
+        )
+        watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        with watched_file.open("a") as fd:
+            for line in ("line1\n", "line2\n", "line3\n"):
+                fd.write(line)
+                fd.flush()
+                await asyncio.sleep(0.01)
+        await asyncio.sleep(0.3)  # let the loop run
+        await watcher.stop()
+        assert calls == [["line1", "line2", "line3"]]
+
+    async def test_file_event_unknown_wd(self, watcher, analyze_calls):
+        """Events for unknown watch descriptors are ignored."""
+
+        class FakeEvent(NamedTuple):
+            wd: int
+            mask: int = 0
+            cookie: int = 0
+            filename: bytes = b""
+
+        await watcher._handle_file_event(FakeEvent(123))
+        assert analyze_calls == []
+
+    async def test_file_read_partial_line(self, watched_file, watcher, analyze_calls):
+        """A partial line is processed once it's completed."""
+        with watched_file.open("w") as fd:
+            fd.write("line1\nli")
+            fd.flush()
+            watcher.watch()
+            await asyncio.sleep(0.1)  # let the loop run
+            assert analyze_calls == ["line1"]
+            fd.write("ne2\n")
+
+        await asyncio.sleep(0.1)  # let the loop run
+        await watcher.stop()
+        assert analyze_calls == ["line1", "line2"]
+
+
+@pytest.fixture
+def dispatcher(event_loop):
+    yield InotifyDispatcher(loop=event_loop)
+
+
+@pytest.mark.asyncio
+class TestInotifyDispatcher:
+    async def test_shared_directory_watch(self, event_loop, watched_dir, dispatcher):
+        """Watchers in the same directory share the inotify watch."""
+        calls1, calls2 = [], []
+        watcher1 = FileWatcher(
+            watched_dir / "file1*.txt",
+            calls1.extend,
+            dispatcher=dispatcher,
+            loop=event_loop,
+        )
+        watcher2 = FileWatcher(
+            watched_dir / "file2*.txt",
+            calls2.extend,
+            dispatcher=dispatcher,
+            loop=event_loop,
+        )
+        watcher1.watch()
+        watcher2.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        (watched_dir / "file1.txt").write_text("file1\n")
+        (watched_dir / "file2.txt").write_text("file2\n")
+        (watched_dir / "other.txt").write_text("other\n")
+        await asyncio.sleep(0.1)  # let the loop run
+        assert len(dispatcher._dir_globs) == 1
+        await watcher1.stop()
+        await watcher2.stop()
+        assert calls1 == ["file1"]
+        assert calls2 == ["file2"]
+
+    async def test_shared_file_watch(self, event_loop, watched_file, dispatcher):
+        """Files watched by multiple watchers are watched until all stop."""
+        calls1, calls2 = [], []
+        watcher1 = FileWatcher(
+            watched_file, calls1.extend, dispatcher=dispatcher, loop=event_loop
+        )
+        watcher2 = FileWatcher(
+            watched_file.parent / "*.txt",
+            calls2.extend,
+            dispatcher=dispatcher,
+            loop=event_loop,
+        )
+        watched_file.write_text("line1\n")
+        watcher1.watch()
+        watcher2.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        with watched_file.open("a") as fd:
+            fd.write("line2\n")
+        await asyncio.sleep(0.1)  # let the loop run
+        assert calls1 == ["line1", "line2"]
+        assert calls2 == ["line1", "line2"]
+
+        await watcher1.stop()
+        with watched_file.open("a") as fd:
+            fd.write("line3\n")
+        await asyncio.sleep(0.1)  # let the loop run
+        await watcher2.stop()
+        assert calls1 == ["line1", "line2"]
+        assert calls2 == ["line1", "line2", "line3"]
+
+    async def test_closed_when_no_watchers(self, event_loop, watched_file, dispatcher):
+        """The inotify instance is closed when no watcher is registered."""
+        watcher = FileWatcher(
+            watched_file, lambda lines: None, dispatcher=dispatcher, loop=event_loop
+        )
+        watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        assert dispatcher._inotify is not None
+        await watcher.stop()
+        assert dispatcher._inotify is None
+        assert dispatcher._dir_globs == {}
+
+    async def test_watch_removed_on_delete(self, event_loop, watched_file, dispatcher):
+        """Watches for removed files are forgotten."""
+        watched_file.write_text("line1\n")
+        watcher = FileWatcher(
+            watched_file, lambda lines: None, dispatcher=dispatcher, loop=event_loop
+        )
+        watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        assert len(dispatcher._file_watchers) == 1
+        watched_file.unlink()
+        await asyncio.sleep(0.1)  # let the loop run
+        assert dispatcher._file_watchers == {}
+        await watcher.stop()
+
+    async def test_unregister_unknown(self, event_loop, watched_file, dispatcher):
+        """Unregistering a watcher that's not registered is a no-op."""
+        watcher = FileWatcher(
+            watched_file, lambda lines: None, dispatcher=dispatcher, loop=event_loop
+        )
+        await dispatcher.unregister(watcher)
+        assert dispatcher._inotify is None
+
+    async def test_stop_before_registered(self, event_loop, watched_file, dispatcher):
+        """Watchers can be stopped right after starting."""
+        file_watcher = FileWatcher(
+            watched_file, lambda lines: None, dispatcher=dispatcher, loop=event_loop
+        )
+        change_watcher = ChangeWatcher(
+            watched_file, lambda: None, dispatcher=dispatcher, loop=event_loop
+        )
+        file_watcher.watch()
+        change_watcher.watch()
+        await file_watcher.stop()
+        await change_watcher.stop()
+        assert dispatcher._queues == {}
+
+    async def test_ignore_file_unknown(self, dispatcher):
+        """Ignoring an unknown watch is a no-op."""
+        dispatcher.ignore_file(object(), 123)
+        assert dispatcher._file_watchers == {}
+
+
+@pytest.fixture
+def change_calls():
+    yield []
+
+
+@pytest.fixture
+def change_watcher(event_loop, watched_file, change_calls):
+    yield ChangeWatcher(
+        watched_file, lambda: change_calls.append(None), delay=0.1, loop=event_loop
+    )
+
+
+@pytest.mark.asyncio
+class TestChangeWatcher:
+    async def test_file_modified(self, watched_file, change_watcher, change_calls):
+        """Multiple modifications result in a single callback call."""
+        watched_file.write_text("content")
+        change_watcher.watch()
+        await asyncio.sleep(0.05)  # let the loop run
+        for _ in range(3):
+            with watched_file.open("a") as fd:
+                fd.write("more")
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.2)
+        await change_watcher.stop()
+        assert change_calls == [None]
+
+    async def test_file_replaced(
+        self, watched_dir, watched_file, change_watcher, change_calls
+    ):
+        """The callback is called when the file is replaced, and the new file
+        is watched."""
+        watched_file.write_text("content")
+        change_watcher.watch()
+        await asyncio.sleep(0.05)  # let the loop run
+        new_file = watched_dir / "new.txt"
+        new_file.write_text("new content")
+        new_file.rename(watched_file)
+        await asyncio.sleep(0.2)
+        assert change_calls == [None]
+        with watched_file.open("a") as fd:
+            fd.write("more")
+        await asyncio.sleep(0.2)
+        await change_watcher.stop()
+        assert change_calls == [None, None]
+
+    async def test_file_missing(
+        self, caplog, watched_file, change_watcher, change_calls
+    ):
+        """If the file doesn't exist, a warning is logged, and the callback is
+        called when it's created."""
+        caplog.set_level(logging.WARNING)
+        change_watcher.watch()
+        await asyncio.sleep(0.05)  # let the loop run
+        assert caplog.messages[0].startswith("can't watch file:")
+        watched_file.write_text("content")
+        await asyncio.sleep(0.2)
+        await change_watcher.stop()
+        assert change_calls == [None]
+
+    async def test_stop_not_started(self, change_watcher):
+        """Stopping a watcher not started is a no-op."""
+        await change_watcher.stop()
+        assert change_watcher._task is None
+
+
+@pytest.fixture
+def executor():
+    executor = ThreadPoolExecutor(max_workers=2)
+    yield executor
+    executor.shutdown()
+
+
+@pytest.mark.asyncio
+class TestFileWatcherExecutor:
+    async def test_lines_processed_in_executor(
+        self, event_loop, watched_file, executor
+    ):
+        """Lines are processed in the executor, in order."""
+        calls = []
+
+        def callback(lines):
+            calls.append((threading.current_thread(), lines))
+
+        watched_file.write_text("line1\nline2\nline3\nline4\n")
+        watcher = FileWatcher(
+            watched_file, callback, chunk_size=12, executor=executor, loop=event_loop
+        )
+        watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        await watcher.stop()
+        assert [lines for _, lines in calls] == [
+            ["line1", "line2"],
+            ["line3", "line4"],
+        ]
+        assert threading.main_thread() not in [thread for thread, _ in calls]
+
+    async def test_stop_waits_pending(self, event_loop, watched_file, executor):
+        """Stopping the watcher waits for pending lines to be processed."""
+        event = threading.Event()
+        calls = []
+
+        def callback(lines):
+            event.wait()
+            calls.extend(lines)
+
+        watched_file.write_text("line1\nline2\n")
+        watcher = FileWatcher(
+            watched_file, callback, executor=executor, loop=event_loop
+        )
+        watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        assert calls == []
+        event_loop.call_later(0.1, event.set)
+        await watcher.stop()
+        assert calls == ["line1", "line2"]
+
+
+def write_segment(path, content, mtime):
+    """Write a compressed log segment with the specified modification time."""
+    opener = {".gz": gzip.open, ".xz": lzma.open, ".bz2": bz2.open}[path.suffix]
+    with opener(path, "wb") as fd:
+        fd.write(content)
+    os.utime(path, (mtime, mtime))
+
+
+@pytest.fixture
+def compressed_watcher(event_loop, watched_dir, analyze_calls, positions):
+    yield FileWatcher(
+        watched_dir / "app.log*",
+        analyze_calls.extend,
+        positions=positions,
+        loop=event_loop,
+    )
+
+
+@pytest.mark.asyncio
+class TestFileWatcherCompressed:
+    async def test_segments_read_in_order(
+        self, watched_dir, compressed_watcher, analyze_calls
+    ):
+        """Compressed segments are read from the oldest, before the live file."""
+        write_segment(watched_dir / "app.log.3.bz2", b"line1\n", 1000)
+        write_segment(watched_dir / "app.log.2.xz", b"line2\n", 2000)
+        write_segment(watched_dir / "app.log.1.gz", b"line3\n", 3000)
+        (watched_dir / "app.log").write_text("line4\n")
+        compressed_watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        await compressed_watcher.stop()
+        assert analyze_calls == ["line1", "line2", "line3", "line4"]
+
+    async def test_segment_read_in_chunks(self, event_loop, watched_dir, analyze_calls):
+        """Compressed content is decompressed in chunks."""
+        write_segment(watched_dir / "app.log.1.gz", b"line1\nline2\nline3", 1000)
+        calls = []
+
+        def callback(lines):
+            calls.append(lines)
+
+        watcher = FileWatcher(
+            watched_dir / "app.log*", callback, chunk_size=8, loop=event_loop
+        )
+        watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        await watcher.stop()
+        # the last line is read even without a trailing newline
+        assert calls == [["line1"], ["line2"], ["line3"]]
+
+    async def test_segment_marked_complete(
+        self, watched_dir, compressed_watcher, positions
+    ):
+        """Compressed segments read completely are marked as such."""
+        segment = watched_dir / "app.log.1.gz"
+        write_segment(segment, b"line1\nline2\n", 1000)
+        compressed_watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        await compressed_watcher.stop()
+        assert positions.get(segment) == file_position(segment, 12)._replace(
+            complete=True
+        )
+
+    async def test_complete_segment_skipped(
+        self, watched_dir, compressed_watcher, analyze_calls, positions
+    ):
+        """Compressed segments already read completely are skipped."""
+        segment = watched_dir / "app.log.1.gz"
+        write_segment(segment, b"line1\n", 1000)
+        positions.set(segment, file_position(segment, 6)._replace(complete=True))
+        (watched_dir / "app.log").write_text("line2\n")
+        compressed_watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        await compressed_watcher.stop()
+        assert analyze_calls == ["line2"]
+
+    async def test_segment_resumed(
+        self, watched_dir, compressed_watcher, analyze_calls, positions
+    ):
+        """Partially read segments are resumed from the decompressed offset."""
+        segment = watched_dir / "app.log.1.xz"
+        write_segment(segment, b"line1\nline2\n", 1000)
+        positions.set(segment, file_position(segment, 6))
+        compressed_watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        await compressed_watcher.stop()
+        assert analyze_calls == ["line2"]
+
+    async def test_segment_different_file(
+        self, watched_dir, compressed_watcher, analyze_calls, positions
+    ):
+        """Positions for a different file with the same name are ignored."""
+        segment = watched_dir / "app.log.1.gz"
+        write_segment(segment, b"line1\n", 1000)
+        stat = segment.stat()
+        positions.set(segment, FilePosition(stat.st_dev, stat.st_ino + 1, 6, True))
+        compressed_watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        await compressed_watcher.stop()
+        assert analyze_calls == ["line1"]
+
+    async def test_segment_renamed(
+        self, watched_dir, compressed_watcher, analyze_calls, positions
+    ):
+        """Positions follow segments renamed while not watching."""
+        segment1 = watched_dir / "app.log.1.gz"
+        segment2 = watched_dir / "app.log.2.gz"
+        write_segment(segment1, b"line1\n", 1000)
+        positions.set(segment1, file_position(segment1, 6)._replace(complete=True))
+        # rotation
+        segment1.rename(segment2)
+        write_segment(segment1, b"line2\n", 2000)
+        compressed_watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        await compressed_watcher.stop()
+        assert analyze_calls == ["line2"]
+        assert positions.get(segment2) == file_position(segment2, 6)._replace(
+            complete=True
+        )
+        assert positions.get(segment1) == file_position(segment1, 6)._replace(
+            complete=True
+        )
+
+    async def test_segment_invalid(
+        self, caplog, watched_dir, compressed_watcher, analyze_calls
+    ):
+        """Errors decompressing segments are logged, and other files read."""
+        caplog.set_level(logging.ERROR)
+        segment = watched_dir / "app.log.1.gz"
+        segment.write_bytes(b"not gzip")
+        (watched_dir / "app.log").write_text("line1\n")
+        compressed_watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        await compressed_watcher.stop()
+        assert analyze_calls == ["line1"]
+        [message] = caplog.messages
+        assert message.startswith(f"failed reading compressed file {segment}:")
+
+    async def test_segment_created_not_read(
+        self, watched_dir, compressed_watcher, analyze_calls, positions
+    ):
+        """Compressed files created while watching are marked as read."""
+        compressed_watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        segment = watched_dir / "app.log.1.gz"
+        write_segment(segment, b"line1\n", 1000)
+        await asyncio.sleep(0.1)  # let the loop run
+        assert analyze_calls == []
+        assert positions.get(segment).complete
+        # the position is forgotten when the file is renamed
+        new_segment = watched_dir / "app.log.2.gz"
+        segment.rename(new_segment)
+        await asyncio.sleep(0.1)  # let the loop run
+        await compressed_watcher.stop()
+        assert positions.get(segment) is None
+        assert positions.get(new_segment).complete
+
+    async def test_segment_created_removed(self, watched_dir, compressed_watcher):
+        """Compressed files removed before being handled are ignored."""
+        event = InotifyEvent(1, IN_CREATE, 0, b"app.log.1.gz")
+        await compressed_watcher._handle_dir_event(event)
+        event = InotifyEvent(1, IN_DELETE, 0, b"app.log.1.gz")
+        await compressed_watcher._handle_dir_event(event)
+
+    async def test_segment_vanished(self, watched_dir, compressed_watcher):
+        """Compressed files removed before being read are skipped."""
+        await compressed_watcher._read_compressed_content(watched_dir / "app.log.gz")
+
+    async def test_segment_stats(self, event_loop, watched_dir, stats, stats_registry):
+        """Data read from compressed segments is recorded."""
+        segment = watched_dir / "app.log.1.bz2"
+        write_segment(segment, b"line1\nline2\n", 1000)
+        watcher = FileWatcher(
+            watched_dir / "app.log*", lambda lines: None, stats=stats, loop=event_loop
+        )
+        watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        await watcher.stop()
+        labels = {"file": str(segment)}
+        assert stats_registry.get_sample_value("lmetrics_lines_read_total", labels) == 2
+        assert (
+            stats_registry.get_sample_value("lmetrics_bytes_read_total", labels) == 12
+        )
+
+
+class TestParseChunkSize:
+    def test_parse(self):
+        """The chunk size is returned as an integer."""
+        assert parse_chunk_size("1024") == 1024
+
+    @pytest.mark.parametrize("value", ["0", "-1", "foo"])
+    def test_parse_invalid(self, value):
+        """The chunk size must be a positive integer."""
+        with pytest.raises(argparse.ArgumentTypeError) as err:
+            parse_chunk_size(value)
+        assert str(err.value) == f"invalid chunk size: {value}"
+
+
+class TestIsCompressed:
+    @pytest.mark.parametrize("name", ["app.log.gz", "app.log.1.xz", "app.bz2"])
+    def test_compressed(self, name):
+        """Files with known compression suffixes are compressed."""
+        assert is_compressed(Path(name))
+
+    @pytest.mark.parametrize("name", ["app.log", "app.log.1", "app.zip"])
+    def test_not_compressed(self, name):
+        """Other files are not compressed."""
+        assert not is_compressed(Path(name))
+
+
+class TestRotationOrder:
+    def test_order(self, watched_dir):
+        """Files are sorted by modification time, then name."""
+        paths = [watched_dir / name for name in ("c", "b", "a")]
+        for path, mtime in zip(paths, (1000, 2000, 1000)):
+            path.write_text("")
+            os.utime(path, (mtime, mtime))
+        assert rotation_order(paths) == [paths[2], paths[0], paths[1]]
+
+    def test_missing_skipped(self, watched_dir):
+        """Files not found are skipped."""
+        path = watched_dir / "file"
+        path.write_text("")
+        assert rotation_order([watched_dir / "missing", path]) == [path]
+
+
+@pytest.fixture
+def stats_registry():
+    yield CollectorRegistry()
+
+
+@pytest.fixture
+def stats(stats_registry):
+    yield Stats(stats_registry)
+
+
+@pytest.mark.asyncio
+class TestFileWatcherStats:
+    async def test_read_stats(
+        self, event_loop, watched_file, analyze_calls, stats, stats_registry
+    ):
+        """Lines and bytes read, and the read lag are recorded for files."""
+        watched_file.write_text("line1\nline2\npart")
+        watcher = FileWatcher(
+            watched_file,
+            analyze_calls.extend,
+            chunk_size=6,
+            stats=stats,
+            loop=event_loop,
+        )
+        labels = {"file": str(watched_file)}
+        watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        await watcher.stop()
+        assert stats_registry.get_sample_value("lmetrics_lines_read_total", labels) == 2
+        assert (
+            stats_registry.get_sample_value("lmetrics_bytes_read_total", labels) == 16
+        )
+        assert stats_registry.get_sample_value("lmetrics_read_lag_bytes", labels) == 0
+
+    async def test_long_lines_stats(
+        self, event_loop, watched_file, analyze_calls, stats, stats_registry
+    ):
+        """Long lines are counted for files."""
+        watched_file.write_text("line1\n" + "x" * 20 + "\nline2\n" + "y" * 10)
+        watcher = FileWatcher(
+            watched_file,
+            analyze_calls.extend,
+            max_line_length=5,
+            drop_long_lines=True,
+            chunk_size=4,
+            stats=stats,
+            loop=event_loop,
+        )
+        labels = {"file": str(watched_file)}
+        watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        await watcher.stop()
+        assert analyze_calls == ["line1", "line2"]
+        assert stats_registry.get_sample_value("lmetrics_long_lines_total", labels) == 2
+        assert stats_registry.get_sample_value("lmetrics_read_lag_bytes", labels) == 0
+
+    async def test_read_lag(self, event_loop, watched_file, stats, stats_registry):
+        """The read lag is the size of content not read yet."""
+        watched_file.write_text("line1\nline2\n")
+        lags = []
+
+        def callback(lines):
+            lags.append(
+                stats_registry.get_sample_value(
+                    "lmetrics_read_lag_bytes", {"file": str(watched_file)}
+                )
+            )
+
+        watcher = FileWatcher(
+            watched_file, callback, chunk_size=6, stats=stats, loop=event_loop
+        )
+        watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        await watcher.stop()
+        assert lags == [6, 0]
+
+    async def test_stats_removed_on_delete(
+        self, event_loop, watched_file, stats, stats_registry
+    ):
+        """The read lag is no longer reported for removed files."""
+        watched_file.write_text("line1\n")
+        watcher = FileWatcher(
+            watched_file, lambda lines: None, stats=stats, loop=event_loop
+        )
+        labels = {"file": str(watched_file)}
+        watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        assert stats_registry.get_sample_value("lmetrics_read_lag_bytes", labels) == 0
+        watched_file.unlink()
+        await asyncio.sleep(0.1)  # let the loop run
+        await watcher.stop()
+        assert (
+            stats_registry.get_sample_value("lmetrics_read_lag_bytes", labels) is None
+        )
+
+    async def test_stats_removed_on_move(
+        self, event_loop, watched_dir, watched_file, stats, stats_registry
+    ):
+        """The read lag is no longer reported for files moved away."""
+        watched_file.write_text("line1\n")
+        watcher = FileWatcher(
+            watched_file, lambda lines: None, stats=stats, loop=event_loop
+        )
+        watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        watched_file.rename(watched_dir / "other.txt")
+        await asyncio.sleep(0.1)  # let the loop run
+        await watcher.stop()
+        assert (
+            stats_registry.get_sample_value(
+                "lmetrics_read_lag_bytes", {"file": str(watched_file)}
+            )
+            is None
+        )
+
+    async def test_inotify_events(
+        self, event_loop, watched_file, stats, stats_registry
+    ):
+        """Inotify events handled by the dispatcher are counted."""
+        dispatcher = InotifyDispatcher(loop=event_loop, stats=stats)
+        watcher = FileWatcher(
+            watched_file, lambda lines: None, dispatcher=dispatcher, loop=event_loop
+        )
+        watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        watched_file.write_text("line1\n")
+        await asyncio.sleep(0.1)  # let the loop run
+        await watcher.stop()
+        assert stats_registry.get_sample_value("lmetrics_inotify_events_total") >= 1
+
+
+class TestCoalesceEvents:
+    def test_modify_events_coalesced(self):
+        """Only the first modification for each file is kept."""
+        events = [
+            InotifyEvent(1, IN_MODIFY, 0, b""),
+            InotifyEvent(2, IN_MODIFY, 0, b""),
+            InotifyEvent(1, IN_MODIFY, 0, b""),
+            InotifyEvent(2, IN_MODIFY, 0, b""),
+        ]
+        assert coalesce_events(events) == events[:2]
+
+    def test_dir_events_kept(self):
+        """Events for files in directories are kept, in order."""
+        events = [
+            InotifyEvent(1, IN_MODIFY, 0, b""),
+            InotifyEvent(3, IN_CREATE, 0, b"file1"),
+            InotifyEvent(1, IN_MODIFY, 0, b""),
+            InotifyEvent(3, IN_CREATE, 0, b"file2"),
+        ]
+        assert coalesce_events(events) == [events[0], events[1], events[3]]
+
+
+@pytest.fixture
+def positions(tmpdir):
+    yield FilePositions(Path(tmpdir / "state.json"))
+
+
+@pytest.fixture
+def positions_watcher(event_loop, watched_file, analyze_calls, positions):
+    yield FileWatcher(
+        watched_file, analyze_calls.extend, positions=positions, loop=event_loop
+    )
+
+
+def file_position(path, offset):
+    stat = path.stat()
+    return FilePosition(stat.st_dev, stat.st_ino, offset)
+
+
+@pytest.mark.asyncio
+class TestFileWatcherPositions:
+    async def test_position_saved(
+        self, watched_file, positions_watcher, analyze_calls, positions
+    ):
+        """The position of the last full line read is saved."""
+        watched_file.write_text("line1\nline2\nline3")
+        positions_watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        await positions_watcher.stop()
+        assert analyze_calls == ["line1", "line2"]
+        assert positions.get(watched_file) == file_position(watched_file, 12)
+
+    async def test_resume_from_position(
+        self, watched_file, positions_watcher, analyze_calls, positions
+    ):
+        """An existing file is read from the saved position."""
+        watched_file.write_text("line1\nline2\nline3\n")
+        positions.set(watched_file, file_position(watched_file, 6))
+        positions_watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        await positions_watcher.stop()
+        assert analyze_calls == ["line2", "line3"]
+        assert positions.get(watched_file) == file_position(watched_file, 18)
+
+    async def test_resume_different_file(
+        self, watched_file, positions_watcher, analyze_calls, positions
+    ):
+        """If the file has a different inode, it's read from the start."""
+        watched_file.write_text("line1\nline2\n")
+        stat = watched_file.stat()
+        positions.set(watched_file, FilePosition(stat.st_dev, stat.st_ino + 1, 6))
+        positions_watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        await positions_watcher.stop()
+        assert analyze_calls == ["line1", "line2"]
+
+    async def test_resume_rotated_file(
+        self, event_loop, watched_dir, watched_file, analyze_calls, positions
+    ):
+        """A file rotated while not watching is read from the saved position."""
+        watcher = FileWatcher(
+            watched_dir / "file.txt*",
+            analyze_calls.extend,
+            positions=positions,
+            loop=event_loop,
+        )
+        watched_file.write_text("line1\nline2\n")
+        positions.set(watched_file, file_position(watched_file, 6))
+        rotated_file = watched_dir / "file.txt.1"
+        watched_file.rename(rotated_file)
+        watched_file.write_text("line3\n")
+        watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        await watcher.stop()
+        assert analyze_calls == ["line2", "line3"]
+        assert positions.get(rotated_file) == file_position(rotated_file, 12)
+        assert positions.get(watched_file) == file_position(watched_file, 6)
+
+    async def test_resume_truncated_file(
+        self, watched_file, positions_watcher, analyze_calls, positions
+    ):
+        """If the file is shorter than the position, it's read from the start."""
+        watched_file.write_text("line1\nline2\n")
+        positions.set(watched_file, file_position(watched_file, 100))
+        positions_watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        await positions_watcher.stop()
+        assert analyze_calls == ["line1", "line2"]
+
+    async def test_created_file_not_resumed(
+        self, watched_file, positions_watcher, analyze_calls, positions
+    ):
+        """Files created after the watch started are read from the start."""
+        positions_watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        watched_file.write_text("line1\nline2\n")
+        await asyncio.sleep(0.1)  # let the loop run
+        await positions_watcher.stop()
+        assert analyze_calls == ["line1", "line2"]
+
+    async def test_position_removed_on_delete(
+        self, watched_file, positions_watcher, positions
+    ):
+        """The position for a file is removed when the file is deleted."""
+        watched_file.write_text("line1\n")
+        positions_watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        watched_file.unlink()
+        await asyncio.sleep(0.1)  # let the loop run
+        await positions_watcher.stop()
+        assert positions.get(watched_file) is None
+
+    async def test_position_moved(
+        self, event_loop, watched_dir, watched_file, analyze_calls, positions
+    ):
+        """The position follows a file renamed within the watched glob."""
+        watcher = FileWatcher(
+            watched_dir / "file*.txt",
+            analyze_calls.extend,
+            positions=positions,
+            loop=event_loop,
+        )
+        watched_file.write_text("line1\n")
+        watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        new_file = watched_dir / "file-new.txt"
+        os.rename(watched_file, new_file)
+        await asyncio.sleep(0.1)  # let the loop run
+        await watcher.stop()
+        assert positions.get(watched_file) is None
+        assert positions.get(new_file) == file_position(new_file, 6)
+
+
+@pytest.fixture
+def lookback():
+    # lines from the last minute of the hour are read
+    yield Lookback(lambda line: float(line.split()[0]), 60, clock=lambda: 3600)
+
+
+@pytest.fixture
+def lookback_watcher(event_loop, watched_file, analyze_calls, positions, lookback):
+    yield FileWatcher(
+        watched_file,
+        analyze_calls.extend,
+        positions=positions,
+        lookback=lookback,
+        loop=event_loop,
+    )
+
+
+@pytest.mark.asyncio
+class TestFileWatcherLookback:
+    async def test_existing_file(self, watched_file, lookback_watcher, analyze_calls):
+        """Existing files are read from the first line within the window."""
+        watched_file.write_text("3000 line1\n3540 line2\n3600 line3\n")
+        lookback_watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        await lookback_watcher.stop()
+        assert analyze_calls == ["3540 line2", "3600 line3"]
+
+    async def test_existing_file_old_lines(
+        self, watched_file, lookback_watcher, analyze_calls, positions
+    ):
+        """If no line is within the window, reading starts from the end."""
+        watched_file.write_text("3000 line1\n3100 line2\n")
+        lookback_watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        with watched_file.open("a") as fh:
+            fh.write("3600 line3\n")
+        await asyncio.sleep(0.1)  # let the loop run
+        await lookback_watcher.stop()
+        assert analyze_calls == ["3600 line3"]
+        assert positions.get(watched_file) == file_position(watched_file, 33)
+
+    async def test_resumed_file(
+        self, watched_file, lookback_watcher, analyze_calls, positions
+    ):
+        """Files are read from the saved position, if present."""
+        watched_file.write_text("3000 line1\n3100 line2\n3600 line3\n")
+        positions.set(watched_file, file_position(watched_file, 11))
+        lookback_watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        await lookback_watcher.stop()
+        assert analyze_calls == ["3100 line2", "3600 line3"]
+
+    async def test_no_timestamps(self, caplog, event_loop, watched_file, analyze_calls):
+        """If no timestamp is found, a warning is logged and files are read."""
+        watched_file.write_text("foo line1\nbar line2\n")
+        watcher = FileWatcher(
+            watched_file,
+            analyze_calls.extend,
+            lookback=Lookback(lambda line: None, 60),
+            loop=event_loop,
+        )
+        watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        await watcher.stop()
+        assert analyze_calls == ["foo line1", "bar line2"]
+        assert (
+            f"no timestamps found for lookback, reading from the start: "
+            f"{watched_file}" in caplog.messages
+        )
+
+    async def test_created_file(self, watched_file, lookback_watcher, analyze_calls):
+        """Files created after the watch started are read from the start."""
+        lookback_watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        watched_file.write_text("3000 line1\n3600 line2\n")
+        await asyncio.sleep(0.1)  # let the loop run
+        await lookback_watcher.stop()
+        assert analyze_calls == ["3000 line1", "3600 line2"]
+
+
+class CountingAnalyzer:
+    def __init__(self):
+        self.registry = CollectorRegistry()
+        self.counter = Counter("lines", "Lines", registry=self.registry)
+
+    def analyze_lines(self, lines):
+        self.counter.inc(len(lines))
+
+
+def create_counting_analyzer():
+    analyzer = CountingAnalyzer()
+    return analyzer, analyzer.registry
+
+
+@pytest.fixture
+def backfill_collector():
+    yield MergedCollector()
+
+
+@pytest.fixture
+def backfill(event_loop, backfill_collector):
+    yield Backfill(
+        create_counting_analyzer,
+        backfill_collector,
+        processes=2,
+        min_size=20,
+        loop=event_loop,
+    )
+
+
+@pytest.fixture
+def backfill_watcher(event_loop, watched_file, analyze_calls, positions, backfill):
+    yield FileWatcher(
+        watched_file,
+        analyze_calls.extend,
+        positions=positions,
+        backfill=backfill,
+        loop=event_loop,
+    )
+
+
+def backfilled_lines(collector):
+    for family in collector.collect():
+        for sample in family.samples:
+            if sample.name == "lines_total":
+                return sample.value
+    return 0
+
+
+@pytest.mark.asyncio
+class TestFileWatcherBackfill:
+    async def test_existing_file(
+        self,
+        watched_file,
+        backfill_watcher,
+        backfill_collector,
+        analyze_calls,
+        positions,
+    ):
+        """Existing content of large files is backfilled."""
+        watched_file.write_text("line1\nline2\nline3\nline4\npart")
+        backfill_watcher.watch()
+        await asyncio.sleep(0.5)  # let the loop run
+        assert analyze_calls == []
+        assert backfilled_lines(backfill_collector) == 4
+        assert positions.get(watched_file) == file_position(watched_file, 24)
+        # new content is read as usual
+        with watched_file.open("a") as fd:
+            fd.write("ial\nline5\n")
+        await asyncio.sleep(0.1)  # let the loop run
+        await backfill_watcher.stop()
+        assert analyze_calls == ["partial", "line5"]
+        assert backfilled_lines(backfill_collector) == 4
+
+    async def test_small_file(
+        self, watched_file, backfill_watcher, backfill_collector, analyze_calls
+    ):
+        """Files with little content to read are read as usual."""
+        watched_file.write_text("line1\nline2\n")
+        backfill_watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        await backfill_watcher.stop()
+        assert analyze_calls == ["line1", "line2"]
+        assert backfilled_lines(backfill_collector) == 0
+
+    async def test_resumed_file(
+        self,
+        watched_file,
+        backfill_watcher,
+        backfill_collector,
+        analyze_calls,
+        positions,
+    ):
+        """Files are backfilled from the saved position."""
+        watched_file.write_text("line1\nline2\nline3\nline4\nline5\n")
+        positions.set(watched_file, file_position(watched_file, 6))
+        backfill_watcher.watch()
+        await asyncio.sleep(0.5)  # let the loop run
+        await backfill_watcher.stop()
+        assert analyze_calls == []
+        assert backfilled_lines(backfill_collector) == 4
+
+    async def test_created_file(
+        self, watched_file, backfill_watcher, backfill_collector, analyze_calls
+    ):
+        """Files created after the watch started are not backfilled."""
+        backfill_watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        watched_file.write_text("line1\nline2\nline3\nline4\n")
+        await asyncio.sleep(0.1)  # let the loop run
+        await backfill_watcher.stop()
+        assert analyze_calls == ["line1", "line2", "line3", "line4"]
+        assert backfilled_lines(backfill_collector) == 0
+
+    async def test_stats(
+        self, event_loop, watched_file, analyze_calls, backfill, stats, stats_registry
+    ):
+        """Backfilled content is recorded in stats."""
+        watched_file.write_text("line1\nline2\nline3\nline4\n")
+        watcher = FileWatcher(
+            watched_file,
+            analyze_calls.extend,
+            backfill=backfill,
+            stats=stats,
+            loop=event_loop,
+        )
+        labels = {"file": str(watched_file)}
+        watcher.watch()
+        await asyncio.sleep(0.5)  # let the loop run
+        await watcher.stop()
+        assert stats_registry.get_sample_value("lmetrics_lines_read_total", labels) == 4
+        assert (
+            stats_registry.get_sample_value("lmetrics_bytes_read_total", labels) == 24
+        )
+        assert stats_registry.get_sample_value("lmetrics_read_lag_bytes", labels) == 0
+
 
 @pytest.fixture
 async def glob_watcher(event_loop, watched_dir, analyze_calls):
     glob_path = watched_dir / "file*.txt"
-    watcher = FileWatcher(glob_path, analyze_calls.append, loop=event_loop)
+    watcher = FileWatcher(glob_path, analyze_calls.extend, loop=event_loop)
     yield watcher
     await watcher.stop()
 
@@ -249,16 +1383,400 @@ class TestFileWatcherGlob:
         assert analyze_calls == ["some content", "more content"]
 
 
+@pytest.mark.asyncio
+class TestFileWatcherFlush:
+    async def test_flush_timeout(self, event_loop, watched_file, analyze_calls):
+        """The flush callback is called once no lines are read for a while."""
+        watcher = FileWatcher(
+            watched_file,
+            analyze_calls.extend,
+            flush=lambda: analyze_calls.append("flush"),
+            flush_timeout=0.05,
+            loop=event_loop,
+        )
+        watched_file.write_text("line1\n")
+        watcher.watch()
+        await asyncio.sleep(0.02)
+        with watched_file.open("a") as fd:
+            fd.write("line2\n")
+        await asyncio.sleep(0.02)
+        assert analyze_calls == ["line1", "line2"]
+        await asyncio.sleep(0.1)
+        assert analyze_calls == ["line1", "line2", "flush"]
+        await watcher.stop()
+        assert analyze_calls == ["line1", "line2", "flush"]
+
+    async def test_flush_on_stop(self, event_loop, watched_file, analyze_calls):
+        """The flush callback is called when the watch is stopped."""
+        watcher = FileWatcher(
+            watched_file,
+            analyze_calls.extend,
+            flush=lambda: analyze_calls.append("flush"),
+            flush_timeout=10,
+            loop=event_loop,
+        )
+        watched_file.write_text("line1\n")
+        watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        await watcher.stop()
+        assert analyze_calls == ["line1", "flush"]
+
+    async def test_flush_other_file(self, event_loop, watched_dir, analyze_calls):
+        """The flush callback is called before lines from another file."""
+        watcher = FileWatcher(
+            watched_dir / "file*.txt",
+            analyze_calls.extend,
+            flush=lambda: analyze_calls.append("flush"),
+            flush_timeout=10,
+            loop=event_loop,
+        )
+        file1 = watched_dir / "file1.txt"
+        file1.write_text("line1\n")
+        os.utime(file1, ns=(1000, 1000))
+        file2 = watched_dir / "file2.txt"
+        file2.write_text("line2\n")
+        os.utime(file2, ns=(2000, 2000))
+        watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        with file2.open("a") as fd:
+            fd.write("line3\n")
+        await asyncio.sleep(0.1)  # let the loop run
+        await watcher.stop()
+        assert analyze_calls == ["line1", "flush", "line2", "line3", "flush"]
+
+    async def test_flush_in_executor(self, event_loop, watched_file, executor):
+        """The flush callback is run in the executor, after lines."""
+        calls = []
+        watcher = FileWatcher(
+            watched_file,
+            lambda lines: calls.append((lines, threading.current_thread())),
+            flush=lambda: calls.append(("flush", threading.current_thread())),
+            flush_timeout=10,
+            executor=executor,
+            loop=event_loop,
+        )
+        watched_file.write_text("line1\n")
+        watcher.watch()
+        await asyncio.sleep(0.1)  # let the loop run
+        await watcher.stop()
+        assert [call for call, _ in calls] == [["line1"], "flush"]
+        assert all(thread is not threading.main_thread() for _, thread in calls)
+
+
 class TestCreateWatchers:
     def test_create_watchers(self):
         """create_watchers return a FileWatcher for each analyzer."""
         fake_loop = object()
-        analyzer1 = FakeAnalyzer("file1", lambda line: True)
-        analyzer2 = FakeAnalyzer("file2", lambda line: True)
+        analyzer1 = FakeAnalyzer("file1", lambda lines: True)
+        analyzer2 = FakeAnalyzer("file2", lambda lines: True)
         watcher1, watcher2 = create_watchers([analyzer1, analyzer2], fake_loop)
         assert watcher1.path == Path.cwd() / "file1"
         assert watcher2.path == Path.cwd() / "file2"
 
+    def test_create_watchers_shared_dispatcher(self):
+        """create_watchers uses a single dispatcher for all watchers."""
+        analyzer1 = FakeAnalyzer("file1", lambda lines: True)
+        analyzer2 = FakeAnalyzer("file2", lambda lines: True)
+        watcher1, watcher2 = create_watchers([analyzer1, analyzer2], object())
+        assert watcher1._dispatcher is watcher2._dispatcher
+
+    def test_create_watchers_file_options(self):
+        """create_watchers sets options from analyzers for watchers."""
+        analyzer = FakeAnalyzer(
+            "file",
+            lambda lines: True,
+            binary=True,
+            encoding="latin-1",
+            encoding_errors="replace",
+            max_line_length=100,
+            drop_long_lines=True,
+        )
+        [watcher] = create_watchers([analyzer], object())
+        assert watcher._binary
+        assert watcher._encoding == "latin-1"
+        assert watcher._encoding_errors == "replace"
+        assert watcher._max_line_length == 100
+        assert watcher._drop_long_lines
+
+    def test_create_watchers_multiline(self):
+        """create_watchers sets flushing of multiline records for watchers."""
+        calls = []
+        analyzer = FakeAnalyzer(
+            "file",
+            lambda lines: True,
+            multiline=MultilineConfig("start", timeout=5.0),
+            flush=lambda: calls.append("flush"),
+        )
+        [watcher] = create_watchers(
+            [analyzer], object(), on_analyzed=lambda: calls.append("analyzed")
+        )
+        assert watcher._flush_timeout == 5.0
+        watcher._flush()
+        assert calls == ["flush", "analyzed"]
+
+    def test_create_watchers_multiline_no_callback(self):
+        """Without a callback, watchers flush analyzers directly."""
+        analyzer = FakeAnalyzer(
+            "file", lambda lines: True, multiline=MultilineConfig("start")
+        )
+        [watcher] = create_watchers([analyzer], object())
+        assert watcher._flush is analyzer.flush
+
+    def test_create_watchers_no_multiline(self):
+        """Watchers don't flush if analyzers don't use multiline records."""
+        analyzer = FakeAnalyzer("file", lambda lines: True)
+        [watcher] = create_watchers([analyzer], object())
+        assert watcher._flush is None
+
+    def test_create_watchers_lookback(self):
+        """create_watchers sets the lookback for watchers."""
+        analyzer = FakeAnalyzer(
+            "file", lambda lines: True, lookback=LookbackConfig(r"^\S+", 60)
+        )
+        [watcher] = create_watchers([analyzer], object())
+        assert watcher._lookback._window == 60
+        assert watcher._lookback._parse(b"2020-01-01T00:00:00+00:00 line") == (
+            1577836800.0
+        )
+
+    def test_create_watchers_no_lookback(self):
+        """Watchers don't use a lookback if analyzers don't set it."""
+        analyzer = FakeAnalyzer("file", lambda lines: True)
+        [watcher] = create_watchers([analyzer], object())
+        assert watcher._lookback is None
+
+    def test_create_watchers_coalesce_interval(self):
+        """create_watchers sets the coalesce interval for watchers."""
+        analyzer = FakeAnalyzer("file", lambda lines: True)
+        [watcher] = create_watchers([analyzer], object(), coalesce_interval=0.5)
+        assert watcher._coalesce_interval == 0.5
+
+    def test_create_watchers_chunk_size(self):
+        """create_watchers sets the read chunk size for watchers."""
+        analyzer = FakeAnalyzer("file", lambda lines: True)
+        [watcher] = create_watchers([analyzer], object(), chunk_size=100)
+        assert watcher._chunk_size == 100
+
+    def test_create_watchers_executor(self):
+        """create_watchers sets the executor for watchers."""
+        analyzer = FakeAnalyzer("file", lambda lines: True)
+        executor = object()
+        [watcher] = create_watchers([analyzer], object(), executor=executor)
+        assert watcher._executor is executor
+
+    def test_create_watchers_stats(self, stats):
+        """create_watchers passes stats to watchers and the dispatcher."""
+        analyzer = FakeAnalyzer("file", lambda lines: True)
+        [watcher] = create_watchers([analyzer], object(), stats=stats)
+        assert watcher._stats is stats
+        assert watcher._dispatcher._stats is stats
+
+    def test_create_watchers_on_analyzed(self):
+        """create_watchers can call back after lines are analyzed."""
+        calls = []
+        analyzer = FakeAnalyzer("file", calls.extend)
+        [watcher] = create_watchers(
+            [analyzer], object(), on_analyzed=lambda: calls.append("analyzed")
+        )
+        watcher._callback(["line1", "line2"])
+        assert calls == ["line1", "line2", "analyzed"]
+
+
+class TestLineStream:
+    def test_feed(self):
+        """feed returns full lines from data."""
+        stream = LineStream()
+        assert stream.feed(b"line1\nline2\n") == ["line1", "line2"]
+
+    def test_feed_partial(self):
+        """Partial lines are kept until they're completed."""
+        stream = LineStream()
+        assert stream.feed(b"line1\nli") == ["line1"]
+        assert stream.feed(b"ne") == []
+        assert stream.feed(b"2\nline3\n") == ["line2", "line3"]
+
+    def test_feed_skip_empty(self):
+        """Empty lines are skipped."""
+        stream = LineStream()
+        assert stream.feed(b"line1\n\n\nline2\n") == ["line1", "line2"]
+
+    def test_feed_crlf(self):
+        """Carriage returns at the end of lines are stripped."""
+        stream = LineStream(max_line_length=5)
+        assert stream.feed(b"line1\r\nli\r2\r\n\r\n") == ["line1", "li\r2"]
+        assert stream.pop_long_lines() == 0
+
+    def test_feed_crlf_split(self):
+        """CRLF line endings can be split between chunks."""
+        stream = LineStream()
+        assert stream.feed(b"line1\r") == []
+        assert stream.feed(b"\nline2\r\n") == ["line1", "line2"]
+        stream.feed(b"line3\r")
+        assert stream.flush() == ["line3"]
+
+    def test_feed_split_character(self):
+        """Multibyte characters split between chunks are decoded."""
+        stream = LineStream()
+        data = "line \u2603\n".encode("utf-8")
+        assert stream.feed(data[:6]) == []
+        assert stream.feed(data[6:]) == ["line \u2603"]
+
+    def test_pending_size(self):
+        """pending_size returns the size of data not returned as lines."""
+        stream = LineStream()
+        data = "line\nli\u2603".encode("utf-8")
+        stream.feed(data[:-1])
+        assert stream.pending_size() == 4
+        stream.feed(data[-1:])
+        assert stream.pending_size() == 5
+
+    def test_feed_encoding(self):
+        """Data are decoded with the specified encoding."""
+        stream = LineStream(encoding="latin-1")
+        assert stream.feed("caf\xe9\n".encode("latin-1")) == ["caf\xe9"]
+
+    def test_flush(self):
+        """flush returns the last partial line."""
+        stream = LineStream()
+        assert stream.feed(b"line1\nline2") == ["line1"]
+        assert stream.flush() == ["line2"]
+        assert stream.pending_size() == 0
+        assert stream.flush() == []
+
+    def test_flush_incomplete_character(self):
+        """flush decodes incomplete characters at the end of the stream."""
+        stream = LineStream(errors="replace")
+        stream.feed("line \u2603".encode("utf-8")[:-1])
+        assert stream.flush() == ["line \ufffd"]
+
+    def test_feed_invalid_data(self, caplog):
+        """Invalid data is logged and replaced, with strict error handling."""
+        caplog.set_level(logging.WARNING)
+        stream = LineStream(encoding="ascii")
+        assert stream.feed(b"line1\nb\xe8r\nli") == ["line1", "b\ufffdr"]
+        assert stream.pending_size() == 2
+        assert stream.feed(b"ne2\n") == ["line2"]
+        [message] = caplog.messages
+        assert message.startswith("invalid data, replacing: ")
+
+    def test_feed_invalid_data_partial(self, caplog):
+        """Invalid data in a partial line is replaced once decoded."""
+        caplog.set_level(logging.WARNING)
+        stream = LineStream(encoding="ascii")
+        assert stream.feed(b"b\xe8r") == []
+        assert stream.pending_size() == 3
+        assert stream.feed(b"\n") == ["b\ufffdr"]
+
+    def test_flush_invalid_incomplete_character(self, caplog):
+        """Incomplete characters at the end of the stream are replaced."""
+        caplog.set_level(logging.WARNING)
+        stream = LineStream()
+        stream.feed("line \u2603".encode("utf-8")[:-1])
+        assert stream.flush() == ["line \ufffd"]
+        [message] = caplog.messages
+        assert message.startswith("invalid data, replacing: ")
+
+    def test_feed_truncate_long_lines(self):
+        """Lines longer than the maximum are truncated."""
+        stream = LineStream(max_line_length=5)
+        assert stream.feed(b"line1\nlong line\nline2\n") == ["line1", "long ", "line2"]
+        assert stream.pop_long_lines() == 1
+        assert stream.pop_long_lines() == 0
+
+    def test_feed_drop_long_lines(self):
+        """Lines longer than the maximum can be dropped."""
+        stream = LineStream(max_line_length=5, drop_long_lines=True)
+        assert stream.feed(b"line1\nlong line\nline2\n") == ["line1", "line2"]
+        assert stream.pop_long_lines() == 1
+
+    def test_feed_long_partial_line(self):
+        """Long partial lines are not kept beyond the maximum length."""
+        stream = LineStream(max_line_length=5)
+        assert stream.feed(b"line1\nlong ") == ["line1"]
+        assert stream.feed(b"line ") == []
+        assert stream._splitter._partial == "long "
+        assert stream.pending_size() == 10
+        assert stream.feed(b"more\nline2\n") == ["long ", "line2"]
+        assert stream.pending_size() == 0
+        assert stream.pop_long_lines() == 1
+
+    def test_feed_long_partial_line_dropped(self):
+        """Long partial lines are discarded if long lines are dropped."""
+        stream = LineStream(max_line_length=5, drop_long_lines=True)
+        assert stream.feed(b"long line") == []
+        assert stream._splitter._partial == ""
+        assert stream.pending_size() == 9
+        assert stream.feed(b" more\nline2\n") == ["line2"]
+        assert stream.pop_long_lines() == 1
+
+    def test_flush_long_line(self):
+        """The last partial line is truncated if long."""
+        stream = LineStream(max_line_length=5)
+        stream.feed(b"long")
+        assert stream.flush() == ["long"]
+        stream.feed(b"long line")
+        assert stream.flush() == ["long "]
+        assert stream.pending_size() == 0
+        assert stream.pop_long_lines() == 1
+
+    def test_flush_long_line_incomplete_character(self):
+        """The last partial line is truncated if long once fully decoded."""
+        stream = LineStream(max_line_length=4, errors="replace")
+        stream.feed("long\u2603".encode("utf-8")[:-1])
+        assert stream.flush() == ["long"]
+        assert stream.pop_long_lines() == 1
+
+    def test_flush_long_line_dropped(self):
+        """The last partial line is dropped if long."""
+        stream = LineStream(max_line_length=5, drop_long_lines=True)
+        stream.feed(b"long line")
+        assert stream.flush() == []
+        assert stream.pop_long_lines() == 1
+
+    def test_long_lines_length_in_characters(self):
+        """The maximum length is in characters for text."""
+        stream = LineStream(max_line_length=2)
+        data = "\u2603\u2603\n".encode("utf-8")
+        assert stream.feed(data) == ["\u2603\u2603"]
+        assert stream.pop_long_lines() == 0
+
+
+class TestBytesLineStream:
+    def test_feed(self):
+        """Full lines are returned as bytes."""
+        stream = BytesLineStream()
+        assert stream.feed(b"line1\nline2\n") == [b"line1", b"line2"]
+
+    def test_feed_partial(self):
+        """Partial lines are returned once completed."""
+        stream = BytesLineStream()
+        assert stream.feed(b"line1\nli") == [b"line1"]
+        assert stream.pending_size() == 2
+        assert stream.feed(b"ne2\n\n") == [b"line2"]
+        assert stream.pending_size() == 0
+
+    def test_feed_crlf(self):
+        """Carriage returns at the end of lines are stripped."""
+        stream = BytesLineStream()
+        assert stream.feed(b"line1\r\nline2\r") == [b"line1"]
+        assert stream.feed(b"\n") == [b"line2"]
+
+    def test_flush(self):
+        """flush returns the last partial line."""
+        stream = BytesLineStream()
+        stream.feed(b"line1\nline2")
+        assert stream.flush() == [b"line2"]
+        assert stream.flush() == []
+
+    def test_feed_long_lines(self):
+        """Lines longer than the maximum bytes are truncated."""
+        stream = BytesLineStream(max_line_length=5)
+        assert stream.feed(b"long line\nline") == [b"long "]
+        assert stream.feed(b" more") == []
+        assert stream.pending_size() == 9
+        assert stream.flush() == [b"line "]
+        assert stream.pop_long_lines() == 2
+
 
 @pytest.fixture
 def files():
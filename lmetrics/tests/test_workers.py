@@ -0,0 +1,306 @@
+import asyncio
+import logging
+import multiprocessing
+import signal
+import sys
+
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Metric,
+)
+import pytest
+
+from ..workers import (
+    MergedCollector,
+    run_worker,
+    split_files,
+    WorkerProcess,
+)
+
+
+class TestSplitFiles:
+    def test_split(self):
+        """Files are split in groups in a round-robin fashion."""
+        files = {"file1": "rule1", "file2": "rule2", "file3": "rule3"}
+        assert split_files(files, 2) == [
+            {"file1": "rule1", "file3": "rule3"},
+            {"file2": "rule2"},
+        ]
+
+    def test_split_more_groups_than_files(self):
+        """Empty groups are not returned."""
+        files = {"file1": "rule1", "file2": "rule2"}
+        assert split_files(files, 4) == [{"file1": "rule1"}, {"file2": "rule2"}]
+
+
+def make_family(name, typ, samples):
+    family = Metric(name, f"{name} metric", typ)
+    for sample_name, labels, value in samples:
+        family.add_sample(sample_name, labels, value)
+    return family
+
+
+def collected_samples(collector):
+    return {
+        family.name: [
+            (sample.name, sample.labels, sample.value) for sample in family.samples
+        ]
+        for family in collector.collect()
+    }
+
+
+@pytest.fixture
+def collector():
+    yield MergedCollector()
+
+
+class TestMergedCollector:
+    def test_collect_empty(self, collector):
+        """If no update is received, no metric is returned."""
+        assert list(collector.collect()) == []
+
+    def test_collect_counter_summed(self, collector):
+        """Counter values are summed across workers."""
+        collector.update(
+            0,
+            [
+                make_family(
+                    "c",
+                    "counter",
+                    [
+                        ("c_total", {"l": "a"}, 1.0),
+                        ("c_created", {"l": "a"}, 100.0),
+                    ],
+                )
+            ],
+        )
+        collector.update(
+            1,
+            [
+                make_family(
+                    "c",
+                    "counter",
+                    [
+                        ("c_total", {"l": "a"}, 2.0),
+                        ("c_created", {"l": "a"}, 50.0),
+                        ("c_total", {"l": "b"}, 3.0),
+                    ],
+                )
+            ],
+        )
+        [family] = collector.collect()
+        assert family.name == "c"
+        assert family.type == "counter"
+        assert family.documentation == "c metric"
+        assert collected_samples(collector) == {
+            "c": [
+                ("c_total", {"l": "a"}, 3.0),
+                ("c_created", {"l": "a"}, 50.0),
+                ("c_total", {"l": "b"}, 3.0),
+            ]
+        }
+
+    def test_collect_histogram_summed(self, collector):
+        """Histogram values are summed across workers."""
+        for worker in (0, 1):
+            collector.update(
+                worker,
+                [
+                    make_family(
+                        "h",
+                        "histogram",
+                        [
+                            ("h_bucket", {"le": "1.0"}, 1.0),
+                            ("h_bucket", {"le": "+Inf"}, 2.0),
+                            ("h_count", {}, 2.0),
+                            ("h_sum", {}, 3.5),
+                        ],
+                    )
+                ],
+            )
+        assert collected_samples(collector) == {
+            "h": [
+                ("h_bucket", {"le": "1.0"}, 2.0),
+                ("h_bucket", {"le": "+Inf"}, 4.0),
+                ("h_count", {}, 4.0),
+                ("h_sum", {}, 7.0),
+            ]
+        }
+
+    def test_collect_updated_values(self, collector):
+        """Only the last update from a worker is used."""
+        collector.update(0, [make_family("c", "counter", [("c_total", {}, 1.0)])])
+        collector.update(0, [make_family("c", "counter", [("c_total", {}, 5.0)])])
+        assert collected_samples(collector) == {"c": [("c_total", {}, 5.0)]}
+
+    def test_on_update(self):
+        """A function can be called after each update."""
+        calls = []
+        collector = MergedCollector(on_update=lambda: calls.append(None))
+        collector.update(0, [make_family("c", "counter", [("c_total", {}, 1.0)])])
+        assert calls == [None]
+
+    def test_collect_gauge_last_changed(self, collector):
+        """For gauges, the value last changed by any worker is used."""
+        collector.update(0, [make_family("g", "gauge", [("g", {}, 1.0)])])
+        collector.update(1, [make_family("g", "gauge", [("g", {}, 0.0)])])
+        assert collected_samples(collector) == {"g": [("g", {}, 0.0)]}
+        # the first worker changes the value
+        collector.update(0, [make_family("g", "gauge", [("g", {}, 3.0)])])
+        # the second worker doesn't
+        collector.update(1, [make_family("g", "gauge", [("g", {}, 0.0)])])
+        assert collected_samples(collector) == {"g": [("g", {}, 3.0)]}
+
+    def test_collect_local(self):
+        """Metrics from a local registry are merged when collected."""
+        registry = CollectorRegistry()
+        counter = Counter("c", "A counter", registry=registry)
+        collector = MergedCollector(local=registry)
+        counter.inc(2)
+        collector.update(
+            ("file", 0), [make_family("c", "counter", [("c_total", {}, 1.0)])]
+        )
+        counter.inc()
+        assert collected_samples(collector)["c"][0] == ("c_total", {}, 4.0)
+
+    def test_collect_local_gauge_last_changed(self):
+        """Gauges from a local registry are only used once changed."""
+        registry = CollectorRegistry()
+        gauge = Gauge("g", "A gauge", registry=registry)
+        collector = MergedCollector(local=registry)
+        collector.update(0, [make_family("g", "gauge", [("g", {}, 3.0)])])
+        assert collected_samples(collector) == {"g": [("g", {}, 3.0)]}
+        gauge.set(5)
+        assert collected_samples(collector) == {"g": [("g", {}, 5.0)]}
+
+
+def fake_worker(conn):
+    conn.send([make_family("c", "counter", [("c_total", {}, 1.0)])])
+    conn.recv()  # wait until told to stop
+    conn.send([make_family("c", "counter", [("c_total", {}, 2.0)])])
+    conn.close()
+
+
+def failing_worker(conn):
+    sys.exit(1)
+
+
+def counting_worker(conn):
+    loop = asyncio.new_event_loop()
+    registry = CollectorRegistry()
+    counter = Counter("c", "A counter", registry=registry)
+    gauge = Gauge("g", "A gauge", registry=registry)
+
+    async def start():
+        counter.inc(3)
+
+    async def stop():
+        gauge.set(10)
+
+    run_worker(conn, loop, registry, start, stop, update_interval=0.01)
+
+
+def signal_worker(conn):
+    loop = asyncio.new_event_loop()
+    registry = CollectorRegistry()
+    counter = Counter("c", "A counter", registry=registry)
+
+    async def start():
+        loop.add_signal_handler(signal.SIGHUP, counter.inc)
+
+    async def stop():
+        loop.remove_signal_handler(signal.SIGHUP)
+
+    run_worker(conn, loop, registry, start, stop, update_interval=0.01)
+
+
+@pytest.mark.asyncio
+class TestWorkerProcess:
+    async def test_start_stop(self, event_loop, collector):
+        """Updates from the worker are passed to the collector."""
+        worker = WorkerProcess(0, fake_worker, collector, event_loop)
+        worker.start()
+        await asyncio.sleep(0.2)
+        assert collected_samples(collector) == {"c": [("c_total", {}, 1.0)]}
+        await worker.stop()
+        # final values are received
+        assert collected_samples(collector) == {"c": [("c_total", {}, 2.0)]}
+
+    async def test_stop_not_started(self, event_loop, collector):
+        """Stopping a worker not started is a no-op."""
+        worker = WorkerProcess(0, fake_worker, collector, event_loop)
+        await worker.stop()
+
+    async def test_worker_exited(self, caplog, event_loop, collector):
+        """If the worker exits unexpectedly, an error is logged."""
+        caplog.set_level(logging.ERROR)
+        worker = WorkerProcess(0, failing_worker, collector, event_loop)
+        worker.start()
+        await asyncio.sleep(0.2)
+        assert caplog.messages == ["worker exited unexpectedly"]
+        # the worker can still be stopped
+        await worker.stop()
+        assert list(collector.collect()) == []
+
+    async def test_run_worker(self, event_loop, collector):
+        """run_worker sends metrics periodically and when stopped."""
+        worker = WorkerProcess(0, counting_worker, collector, event_loop)
+        worker.start()
+        await asyncio.sleep(0.3)
+        samples = collected_samples(collector)
+        assert samples["c"][0] == ("c_total", {}, 3.0)
+        assert samples["g"] == [("g", {}, 0.0)]
+        await worker.stop()
+        samples = collected_samples(collector)
+        assert samples["g"] == [("g", {}, 10.0)]
+
+    async def test_send_signal(self, event_loop, collector):
+        """Signals can be sent to the worker process."""
+        worker = WorkerProcess(0, signal_worker, collector, event_loop)
+        worker.start()
+        await asyncio.sleep(0.2)
+        worker.send_signal(signal.SIGHUP)
+        await asyncio.sleep(0.1)
+        await worker.stop()
+        assert collected_samples(collector)["c"][0] == ("c_total", {}, 1.0)
+
+    async def test_send_signal_not_started(self, event_loop, collector):
+        """Sending a signal to a worker not started is a no-op."""
+        worker = WorkerProcess(0, fake_worker, collector, event_loop)
+        worker.send_signal(signal.SIGHUP)
+
+
+class TestRunWorker:
+    def test_run_worker(self, monkeypatch, collector):
+        """The worker runs until told to stop, then sends final metrics."""
+        handlers = {}
+        monkeypatch.setattr(signal, "signal", handlers.__setitem__)
+        loop = asyncio.new_event_loop()
+        registry = CollectorRegistry()
+        counter = Counter("c", "A counter", registry=registry)
+
+        async def start():
+            counter.inc(3)
+
+        async def stop():
+            counter.inc()
+
+        conn, worker_conn = multiprocessing.Pipe()
+        # tell the worker to stop once started
+        conn.send(None)
+        try:
+            run_worker(worker_conn, loop, registry, start, stop)
+        finally:
+            asyncio.set_event_loop(None)
+        assert loop.is_closed()
+        # read updates until the worker closes the connection
+        with pytest.raises(EOFError):
+            while True:
+                collector.update(0, conn.recv())
+        assert collected_samples(collector)["c"][0] == ("c_total", {}, 4.0)
+        assert handlers == {
+            signal.SIGINT: signal.SIG_IGN,
+            signal.SIGHUP: signal.SIG_IGN,
+        }
@@ -1,12 +1,26 @@
+import argparse
 import asyncio
+import bz2
+import codecs
+from concurrent.futures import Executor
 import contextlib
+import fnmatch
+import gzip
+import lzma
+import os
 from pathlib import Path
+import re
 from typing import (
+    Any,
     Callable,
+    Dict,
     IO,
+    Iterable,
     List,
     Optional,
+    Pattern,
     Set,
+    Tuple,
     Union,
 )
 
@@ -15,34 +29,274 @@ from butter.asyncio.inotify import Inotify_async
 from butter.inotify import (
     IN_CREATE,
     IN_DELETE,
+    IN_IGNORED,
     IN_MODIFY,
     IN_MOVED_FROM,
     IN_MOVED_TO,
 )
-from toolrack.aio import StreamHelper
 from toolrack.log import Loggable
 
+from .backfill import Backfill
+from .lookback import (
+    Lookback,
+    TimestampParser,
+)
 from .rule import FileAnalyzer
+from .state import (
+    FilePosition,
+    FilePositions,
+)
+from .stats import Stats
+
+# Default maximum size of data read from a file at once
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# Default seconds without changes to a file before calling back for them
+DEFAULT_CHANGE_DELAY = 1.0
+
+# Events watched on directories containing watched files
+DIR_EVENTS = IN_CREATE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+
+# Functions to open compressed files, by file suffix
+COMPRESSED_OPENERS: Dict[str, Callable[..., IO]] = {
+    ".bz2": bz2.open,
+    ".gz": gzip.open,
+    ".xz": lzma.open,
+}
+
+
+# Objects receiving events for a path from an InotifyDispatcher
+Watcher = Union["FileWatcher", "ChangeWatcher"]
+
+
+class InotifyDispatcher(Loggable):
+    """Share an inotify instance across FileWatchers.
+
+    Each directory is watched once, and events for files in it are queued
+    only for watchers whose glob pattern matches the file name.  Patterns are
+    compiled once, when watchers are registered.
+
+    Watches on files can be shared by multiple watchers, and are removed when
+    no watcher uses them anymore.
+
+    Watchers are :class:`FileWatcher` or :class:`ChangeWatcher` instances.
+
+    If :class:`Stats` are passed, handled events are counted.
+
+    """
+
+    _inotify: Optional[Inotify_async] = None
+    _task: Optional[asyncio.Task] = None
+
+    def __init__(
+        self,
+        loop: Optional[asyncio.AbstractEventLoop] = None,
+        stats: Optional[Stats] = None,
+    ):
+        self.loop = loop or asyncio.get_event_loop()
+        self._stats = stats
+        self._queues: Dict[Watcher, asyncio.Queue] = {}
+        # map directory watch descriptors to patterns for watchers
+        self._dir_globs: Dict[int, List[Tuple[Pattern, Watcher]]] = {}
+        # map file watch descriptors to watchers using them
+        self._file_watchers: Dict[int, Set[Watcher]] = {}
+
+    def register(self, watcher: Watcher) -> asyncio.Queue:
+        """Watch the directory for a watcher, returning its queue of events."""
+        queue: asyncio.Queue = asyncio.Queue()
+        self._queues[watcher] = queue
+        wd = self._get_inotify().watch(str(watcher.path.parent), DIR_EVENTS)
+        glob = re.compile(fnmatch.translate(watcher.path.name))
+        self._dir_globs.setdefault(wd, []).append((glob, watcher))
+        return queue
+
+    async def unregister(self, watcher: Watcher):
+        """Remove watches for a watcher.
+
+        Once no watcher is registered, the inotify instance is closed.  This
+        is a no-op if the watcher is not registered.
+
+        """
+        if self._queues.pop(watcher, None) is None:
+            return
+        for wd, globs in list(self._dir_globs.items()):
+            globs[:] = [entry for entry in globs if entry[1] is not watcher]
+            if not globs:
+                del self._dir_globs[wd]
+                self._ignore(wd)
+        for wd in list(self._file_watchers):
+            self.ignore_file(watcher, wd)
+
+        if not self._queues:
+            await self._stop()
+
+    def watch_file(self, watcher: Watcher, path: Path) -> int:
+        """Watch a file for modifications, returning the watch descriptor."""
+        wd: int = self._get_inotify().watch(str(path), IN_MODIFY)
+        self._file_watchers.setdefault(wd, set()).add(watcher)
+        return wd
+
+    def ignore_file(self, watcher: Watcher, wd: int):
+        """Stop watching a file for a watcher."""
+        watchers = self._file_watchers.get(wd)
+        if watchers is None:
+            return
+        watchers.discard(watcher)
+        if not watchers:
+            del self._file_watchers[wd]
+            self._ignore(wd)
+
+    async def _dispatch(self):
+        while True:
+            event = await self._inotify.get_event()
+            if self._stats is not None:
+                self._stats.inotify_events.inc()
+            if event.mask & IN_IGNORED:
+                # the watch has been removed, e.g. because the file was deleted
+                self._file_watchers.pop(event.wd, None)
+            elif event.filename:
+                # the event is for a file in a watched directory
+                name = os.fsdecode(event.filename)
+                for glob, watcher in self._dir_globs.get(event.wd, ()):
+                    if glob.match(name):
+                        self._queues[watcher].put_nowait(event)
+            else:
+                # the event is on a file
+                for watcher in self._file_watchers.get(event.wd, ()):
+                    self._queues[watcher].put_nowait(event)
+
+    def _get_inotify(self) -> Inotify_async:
+        """Return the inotify instance, creating it if needed."""
+        if self._inotify is None:
+            self._inotify = Inotify_async(loop=self.loop)
+            self._task = self.loop.create_task(self._dispatch())
+            self.logger.debug("start dispatch loop")
+        return self._inotify
+
+    def _ignore(self, wd: int):
+        """Remove a watch, if still present."""
+        with contextlib.suppress(OSError):
+            self._get_inotify().ignore(wd)
+
+    async def _stop(self):
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        self._inotify.close()
+        self._inotify = None
+        self._task = None
+        self._dir_globs.clear()
+        self._file_watchers.clear()
+        self.logger.debug("stop dispatch loop")
 
 
 class FileWatcher(Loggable):
-    """Watch a file with inotify and call back with every line."""
+    """Watch a file with inotify and call back with lines read from it.
+
+    File content is read in chunks of at most ``chunk_size`` bytes, yielding
+    to the event loop between chunks.  The callback is called with the list
+    of lines from each chunk.
+
+    If an :class:`Executor` is passed, the callback is run in it.  Lines are
+    still processed in order, since a batch is submitted only after the
+    previous one has completed.
+
+    If :class:`FilePositions` are passed, read positions for files are
+    tracked, and files existing when the watch is started are read from the
+    saved position, if they're still the same file.
+
+    If a :class:`Lookback` is passed, files existing when the watch is
+    started (and not resumed from a saved position) are read from the first
+    line within its time window, found through a binary search, instead of
+    from the start.
+
+    If a :class:`Backfill` is passed, existing content of large files found
+    when the watch is started is analyzed in parallel by worker processes,
+    and reading continues after it.
+
+    Inotify events are received through an :class:`InotifyDispatcher`, which
+    can be shared by watchers.  If one is not passed, the watcher uses its
+    own.
+
+    If ``binary`` is True, the callback is called with lines as bytes,
+    without decoding them.
+
+    If ``max_line_length`` is set, longer lines (in characters, or bytes in
+    binary mode) are truncated, or dropped if ``drop_long_lines`` is True,
+    without buffering them in full.
+
+    If a ``flush`` callback is passed, it's called once no lines have been
+    read for ``flush_timeout`` seconds, before lines from a different file
+    are processed, and when the watch is stopped.  This allows completing
+    records assembled from multiple lines.
+
+    Events are handled in batches, where multiple modifications of a file are
+    coalesced, so that it's read once.  After an event is received, the
+    watcher waits for ``coalesce_interval`` seconds for more events to
+    accumulate.  By default, only events already received are coalesced.
+
+    Compressed files (e.g. rotated segments of logs) matching the path are
+    decompressed in chunks and read when the watch is started, from the
+    oldest.  Compressed files are not expected to change, so they're read only
+    once, and if :class:`FilePositions` are passed, those already read
+    completely are skipped.  Compressed files appearing while watching are
+    assumed to be segments of files already read, and are only marked as
+    complete.
+
+    If :class:`Stats` are passed, data read from files and the size of
+    content not yet read are recorded.
+
+    """
 
     _task: Optional[asyncio.Task] = None
+    _pending: Optional[asyncio.Future] = None
+    # loop time at which the flush callback must be called
+    _flush_deadline: Optional[float] = None
+    # file from which lines were last processed
+    _flush_path: Optional[Path] = None
 
     def __init__(
         self,
         path: Union[str, Path],
-        callback: Callable[[str], None],
+        callback: Callable[[List[Any]], None],
         encoding: str = "utf-8",
+        encoding_errors: str = "strict",
+        binary: bool = False,
+        max_line_length: int = 0,
+        drop_long_lines: bool = False,
+        flush: Optional[Callable[[], None]] = None,
+        flush_timeout: float = 0.0,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        positions: Optional[FilePositions] = None,
+        lookback: Optional[Lookback] = None,
+        backfill: Optional[Backfill] = None,
+        executor: Optional[Executor] = None,
+        coalesce_interval: float = 0.0,
+        dispatcher: Optional[InotifyDispatcher] = None,
+        stats: Optional[Stats] = None,
         loop: Optional[asyncio.AbstractEventLoop] = None,
     ):
         self.loop = loop or asyncio.get_event_loop()
         self.path = Path(path).absolute()
         self.name = str(self.path)  # for the logger
+        self._callback = callback
         self._encoding = encoding
-        self._stream = StreamHelper(callback=callback)
+        self._encoding_errors = encoding_errors
+        self._binary = binary
+        self._max_line_length = max_line_length
+        self._drop_long_lines = drop_long_lines
+        self._flush = flush
+        self._flush_timeout = flush_timeout
+        self._chunk_size = chunk_size
+        self._positions = positions
+        self._lookback = lookback
+        self._backfill = backfill
+        self._executor = executor
+        self._coalesce_interval = coalesce_interval
+        self._stats = stats
+        self._dispatcher = dispatcher or InotifyDispatcher(loop=self.loop)
         self._files = WatchedFiles()
+        self._streams: Dict[Path, Union[LineStream, BytesLineStream]] = {}
         self._move_cookies: Set[str] = set()
 
     def watch(self) -> asyncio.Task:
@@ -54,10 +308,16 @@ class FileWatcher(Loggable):
         """Stop watching the file."""
         if self._task:
             self._task.cancel()
-        try:
-            await self._task
-        except asyncio.CancelledError:
-            pass
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            await self._dispatcher.unregister(self)
+        if self._flush_deadline is not None:
+            await self._flush_pending()
+        if self._pending:
+            # wait for processing of the last batch of lines
+            await self._pending
 
         for file_path in self._files.paths():
             self._close_file(file_path)
@@ -65,97 +325,347 @@ class FileWatcher(Loggable):
         self.logger.debug("stop watch loop")
 
     async def _watch(self):
-        with contextlib.closing(Inotify_async(loop=self.loop)) as inotify:
-            self.logger.debug("start watch loop")
-            await self._watch_loop(inotify)
-
-    async def _watch_loop(self, inotify: Inotify_async):
         # always watch the containing directory
-        self._watch_dir(inotify)
+        self.logger.debug(f"watching directory {self.path.parent}")
+        events = self._dispatcher.register(self)
+        self.logger.debug("start watch loop")
 
         # split the basename which might contain glob chars
-        for file_path in self.path.parent.glob(self.path.name):
-            self._read_file_content(file_path, from_start=True)
-            self._watch_file(inotify, file_path)
+        for file_path in rotation_order(self.path.parent.glob(self.path.name)):
+            if is_compressed(file_path):
+                await self._read_compressed_content(file_path)
+                continue
+            await self._read_file_content(file_path, from_start=True, resume=True)
+            self._watch_file(file_path)
 
         while True:
-            event = await inotify.get_event()
-            if event.filename:
-                # the event is for a file in the watched directory
-                self._handle_dir_event(inotify, event)
-            else:
-                # the event is on a file
-                self._handle_file_event(inotify, event)
+            batch = [await self._get_event(events)]
+            # let more events accumulate, so that modifications are read once
+            await asyncio.sleep(self._coalesce_interval)
+            while not events.empty():
+                batch.append(events.get_nowait())
 
-    def _watch_dir(self, inotify: Inotify_async):
-        """Watch the containing dir."""
-        self.logger.debug(f"watching directory {self.path.parent}")
-        inotify.watch(
-            str(self.path.parent), IN_CREATE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
-        )
+            for event in coalesce_events(batch):
+                if event.filename:
+                    # the event is for a file in the watched directory,
+                    # matching the path
+                    await self._handle_dir_event(event)
+                else:
+                    # the event is on a file
+                    await self._handle_file_event(event)
 
-    def _watch_file(self, inotify: Inotify_async, path: Path):
+    async def _get_event(self, events: asyncio.Queue) -> InotifyEvent:
+        """Return the next event, flushing if none is received in time."""
+        if self._flush_deadline is None:
+            return await events.get()
+        timeout = max(self._flush_deadline - self.loop.time(), 0)
+        try:
+            return await asyncio.wait_for(events.get(), timeout)
+        except asyncio.TimeoutError:
+            await self._flush_pending()
+            return await events.get()
+
+    def _watch_file(self, path: Path):
         """Watch a file."""
         self.logger.debug(f"watching file {path}")
-        wd = inotify.watch(str(path), IN_MODIFY)
+        wd = self._dispatcher.watch_file(self, path)
         self._files.set(path, wd=wd)
 
-    def _handle_dir_event(self, inotify: Inotify_async, event: InotifyEvent):
+    async def _handle_dir_event(self, event: InotifyEvent):
         file_path = self.path.parent / event.filename.decode(self._encoding)
-        if not file_path.match(str(self.path)):
-            return
-        if event.create_event or event.moved_to_event:
+        if is_compressed(file_path):
+            self._handle_compressed_dir_event(event, file_path)
+        elif event.create_event or event.moved_to_event:
             if event.cookie in self._move_cookies:
                 # the file has been moved within the watched dir, don't read
                 # content again
                 self._move_cookies.remove(event.cookie)
                 self._skip_to_file_end(file_path)
             else:
-                self._read_file_content(file_path, from_start=True)
-            self._watch_file(inotify, file_path)
+                await self._read_file_content(file_path, from_start=True)
+            self._watch_file(file_path)
         elif event.moved_from_event:
             self.logger.debug(f"file moved {file_path}")
-            inotify.ignore(self._files[file_path]["wd"])
+            self._dispatcher.ignore_file(self, self._files[file_path]["wd"])
             self._move_cookies.add(event.cookie)
             self._close_file(file_path)
+            self._forget_position(file_path)
+            self._forget_stats(file_path)
             del self._files[file_path]
         elif event.delete_event:
             self.logger.debug(f"file removed: {file_path}")
             self._close_file(file_path)
+            self._forget_position(file_path)
+            self._forget_stats(file_path)
             del self._files[file_path]
 
-    def _handle_file_event(self, inotify: Inotify_async, event: InotifyEvent):
+    def _handle_compressed_dir_event(self, event: InotifyEvent, path: Path):
+        if event.create_event or event.moved_to_event:
+            self.logger.debug(f"compressed file added, marking as read: {path}")
+            with contextlib.suppress(FileNotFoundError):
+                self._set_position(path, path.stat(), 0, complete=True)
+        elif event.moved_from_event or event.delete_event:
+            self._forget_position(path)
+
+    async def _handle_file_event(self, event: InotifyEvent):
         file_info = self._files[event.wd]
         if not file_info:
             return  # the file has been ignored or removed
         file_path = file_info["path"]
         if event.modify_event:
             self.logger.debug(f"file modified: {file_path}")
-            self._read_file_content(file_path)
+            await self._read_file_content(file_path)
 
-    def _read_file_content(self, path: Path, from_start: bool = False):
-        """Read and process content of the file."""
+    async def _read_file_content(
+        self,
+        path: Path,
+        from_start: bool = False,
+        resume: bool = False,
+    ):
+        """Read and process content of the file, in chunks.
+
+        If ``resume`` is True, reading starts from the saved position, if
+        present, or from the first line within the lookback window, and
+        content is backfilled if possible.
+
+        """
         if from_start:
             # force a close, in case file has been overwritten
             self._close_file(path)
 
         fd = self._get_file_fd(path)
-        self._stream.receive_data(fd.read())
+        if resume:
+            if not self._resume_position(path, fd):
+                self._seek_lookback(path, fd)
+            if self._backfill is not None:
+                await self._backfill_content(path, fd)
+        stream = self._streams[path]
+        while True:
+            data = fd.read(self._chunk_size)
+            lines = stream.feed(data)
+            if self._stats is not None:
+                self._record_read(
+                    path, fd, len(data), len(lines), stream.pop_long_lines()
+                )
+            if lines:
+                await self._process_lines(path, lines)
+            self._save_position(path, fd, stream)
+            if not data or len(data) < self._chunk_size:
+                break
+            # let other tasks run before reading the next chunk
+            await asyncio.sleep(0)
+
+    async def _backfill_content(self, path: Path, fd: IO):
+        """Analyze existing content with the backfill, skipping past it."""
+        assert self._backfill is not None
+        start = fd.tell()
+        result = await self._backfill.run(path, start, self._new_stream)
+        if result is None:
+            return
+        fd.seek(result.end)
+        if self._stats is not None:
+            self._record_read(
+                path, fd, result.end - start, result.lines, result.long_lines
+            )
+        self._save_position(path, fd, self._streams[path])
+
+    async def _read_compressed_content(self, path: Path):
+        """Read and process content of a compressed file, in chunks.
+
+        Reading resumes from the saved position in decompressed content, and
+        is skipped if the file has already been read completely.  Positions
+        are looked up by file identity, since segments are renamed when logs
+        are rotated.
+
+        """
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return
+        offset = 0
+        position = self._file_position(path, stat)
+        if position is not None:
+            if position.complete:
+                self.logger.debug(f"compressed file already read, skipping: {path}")
+                return
+            offset = position.offset
+
+        self.logger.debug(f"reading compressed file from offset {offset}: {path}")
+        stream = self._new_stream()
+        try:
+            with COMPRESSED_OPENERS[path.suffix](path) as fd:
+                fd.seek(offset)
+                while True:
+                    data = fd.read(self._chunk_size)
+                    lines = stream.feed(data) if data else stream.flush()
+                    if self._stats is not None:
+                        self._stats.file_read(
+                            path, len(data), len(lines), stream.pop_long_lines()
+                        )
+                    if lines:
+                        await self._process_lines(path, lines)
+                    if not data:
+                        break
+                    offset = fd.tell() - stream.pending_size()
+                    self._set_position(path, stat, offset)
+                    # let other tasks run before reading the next chunk
+                    await asyncio.sleep(0)
+        except (OSError, EOFError, lzma.LZMAError) as error:
+            self.logger.error(f"failed reading compressed file {path}: {error}")
+            return
+        self._set_position(path, stat, offset, complete=True)
+
+    def _file_position(
+        self, path: Path, stat: os.stat_result
+    ) -> Optional[FilePosition]:
+        """Return the saved position for a file, by its identity.
+
+        If the position was saved for the file at a different path, such as
+        before it was rotated, it's moved to the current one.
+
+        """
+        if self._positions is None:
+            return None
+        position = self._positions.get(path)
+        if position and (position.device, position.inode) == (
+            stat.st_dev,
+            stat.st_ino,
+        ):
+            return position
+        found = self._positions.find(stat.st_dev, stat.st_ino)
+        if found is None:
+            return None
+        old_path, position = found
+        self.logger.debug(f"file renamed from {old_path}: {path}")
+        self._positions.remove(old_path)
+        self._positions.set(path, position)
+        return position
+
+    async def _process_lines(self, path: Path, lines: List[Any]):
+        """Process a batch of lines from a file, possibly in the executor."""
+        if self._flush_deadline is not None and path != self._flush_path:
+            await self._flush_pending()
+        await self._run_callback(self._callback, lines)
+        if self._flush is not None:
+            self._flush_path = path
+            self._flush_deadline = self.loop.time() + self._flush_timeout
+
+    async def _flush_pending(self):
+        """Call the flush callback for lines processed so far."""
+        self._flush_deadline = None
+        await self._run_callback(self._flush)
+
+    async def _run_callback(self, callback: Callable, *args: Any):
+        """Run a callback, possibly in the executor."""
+        if self._executor is None:
+            callback(*args)
+            return
+
+        if self._pending:
+            await self._pending
+        self._pending = self.loop.run_in_executor(self._executor, callback, *args)
+
+    def _record_read(
+        self, path: Path, fd: IO, size: int, lines: int, long_lines: int = 0
+    ):
+        """Record stats for data read from a file."""
+        assert self._stats is not None
+        self._stats.file_read(path, size, lines, long_lines)
+        self._stats.file_lag(path, os.fstat(fd.fileno()).st_size - fd.tell())
+
+    def _forget_stats(self, path: Path):
+        """Forget stats for a file which is no longer read."""
+        if self._stats is not None:
+            self._stats.forget_file(path)
 
     def _skip_to_file_end(self, path: Path):
         """Skip to the end of a file, leaving the file open."""
         fd = self._get_file_fd(path)
         fd.seek(0, 2)  # go the the end
+        self._save_position(path, fd, self._streams[path])
+
+    def _resume_position(self, path: Path, fd: IO) -> bool:
+        """Seek to the saved position for the file, if it's still valid.
+
+        Return whether the position was used.
+
+        """
+        if self._positions is None:
+            return False
+        stat = os.fstat(fd.fileno())
+        position = self._file_position(path, stat)
+        if position is None:
+            if self._positions.get(path) is not None:
+                self.logger.debug(f"file changed, not resuming: {path}")
+        elif position.offset > stat.st_size:
+            self.logger.debug(f"file truncated, not resuming: {path}")
+        else:
+            self.logger.debug(f"resuming from offset {position.offset}: {path}")
+            fd.seek(position.offset)
+            return True
+        return False
+
+    def _seek_lookback(self, path: Path, fd: IO):
+        """Seek to the first line within the lookback window, if set."""
+        if self._lookback is None:
+            return
+        offset = self._lookback.find_start(fd)
+        if offset is None:
+            self.logger.warning(
+                f"no timestamps found for lookback, reading from the start: {path}"
+            )
+            offset = 0
+        else:
+            self.logger.debug(f"reading from lookback offset {offset}: {path}")
+        fd.seek(offset)
+
+    def _save_position(
+        self, path: Path, fd: IO, stream: Union["LineStream", "BytesLineStream"]
+    ):
+        """Save the position of the last full line read from the file."""
+        if self._positions is None:
+            return
+        stat = os.fstat(fd.fileno())
+        self._set_position(path, stat, fd.tell() - stream.pending_size())
+
+    def _set_position(
+        self, path: Path, stat: os.stat_result, offset: int, complete: bool = False
+    ):
+        """Set the position for a file, if positions are tracked."""
+        if self._positions is None:
+            return
+        position = FilePosition(stat.st_dev, stat.st_ino, offset, complete)
+        self._positions.set(path, position)
+
+    def _forget_position(self, path: Path):
+        """Forget the saved position for a file."""
+        if self._positions is not None:
+            self._positions.remove(path)
 
     def _get_file_fd(self, path: Path) -> IO:
         """Return the file descriptor for a path."""
         file_info = self._files.set(path)
         fd: Optional[IO] = file_info["fd"]
         if fd is None:
-            fd = path.open(encoding=self._encoding)
+            fd = path.open("rb")
             self._files.set(path, fd=fd)
+            self._streams[path] = self._new_stream()
         return fd
 
+    def _new_stream(self) -> Union["LineStream", "BytesLineStream"]:
+        """Return a stream to split file content in lines."""
+        if self._binary:
+            return BytesLineStream(
+                max_line_length=self._max_line_length,
+                drop_long_lines=self._drop_long_lines,
+            )
+        return LineStream(
+            encoding=self._encoding,
+            errors=self._encoding_errors,
+            max_line_length=self._max_line_length,
+            drop_long_lines=self._drop_long_lines,
+        )
+
     def _close_file(self, path: Path):
         """Close the file if open."""
         file_info = self._files[path]
@@ -166,16 +676,405 @@ class FileWatcher(Loggable):
         if fd is not None:
             fd.close()
             self._files.set(path, fd=None)
+            del self._streams[path]
+
+
+class ChangeWatcher(Loggable):
+    """Watch a file with inotify and call back when it changes.
+
+    Both modifications of the file and its replacement (e.g. by editors saving
+    a new version) are detected.  The callback is called once the file hasn't
+    changed for ``delay`` seconds, so that a file written in multiple steps
+    causes a single call.
+
+    """
+
+    _task: Optional[asyncio.Task] = None
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        callback: Callable[[], Any],
+        delay: float = DEFAULT_CHANGE_DELAY,
+        dispatcher: Optional[InotifyDispatcher] = None,
+        loop: Optional[asyncio.AbstractEventLoop] = None,
+    ):
+        self.loop = loop or asyncio.get_event_loop()
+        self.path = Path(path).absolute()
+        self.name = str(self.path)  # for the logger
+        self._callback = callback
+        self._delay = delay
+        self._dispatcher = dispatcher or InotifyDispatcher(loop=self.loop)
+
+    def watch(self) -> asyncio.Task:
+        """Start watching for changes to the file."""
+        self._task = self.loop.create_task(self._watch())
+        return self._task
+
+    async def stop(self):
+        """Stop watching the file."""
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            await self._dispatcher.unregister(self)
+
+    async def _watch(self):
+        events = self._dispatcher.register(self)
+        self._watch_file()
+        while True:
+            await events.get()
+            with contextlib.suppress(asyncio.TimeoutError):
+                while True:
+                    await asyncio.wait_for(events.get(), self._delay)
+            # the file might have been replaced
+            self._watch_file()
+            self.logger.debug("file changed")
+            self._callback()
+
+    def _watch_file(self):
+        try:
+            self._dispatcher.watch_file(self, self.path)
+        except (OSError, ValueError) as error:
+            # the file might not exist, e.g. while it's being replaced
+            self.logger.warning(f"can't watch file: {error}")
+
+
+def create_watchers(
+    analyzers: List[FileAnalyzer],
+    loop: asyncio.AbstractEventLoop,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    positions: Optional[FilePositions] = None,
+    executor: Optional[Executor] = None,
+    coalesce_interval: float = 0.0,
+    stats: Optional[Stats] = None,
+    on_analyzed: Optional[Callable[[], Any]] = None,
+    backfills: Optional[Dict[FileAnalyzer, Backfill]] = None,
+):
+    """Return a list of FileWatchers for FileAnalyzers.
+
+    Watchers share a single :class:`InotifyDispatcher`.
 
+    If ``backfills`` are passed, watchers for analyzers in it use the
+    corresponding :class:`Backfill`.
 
-def create_watchers(analyzers: List[FileAnalyzer], loop: asyncio.AbstractEventLoop):
-    """Return a list of FileWatchers for FileAnalyzers."""
+    If ``on_analyzed`` is passed, it's called after each batch of lines is
+    analyzed.
+
+    """
+    dispatcher = InotifyDispatcher(loop=loop, stats=stats)
     return [
-        FileWatcher(analyzer.path, analyzer.analyze_line, loop=loop)
+        FileWatcher(
+            analyzer.path,
+            _analyze_callback(analyzer, on_analyzed),
+            encoding=analyzer.encoding,
+            encoding_errors=analyzer.encoding_errors,
+            binary=analyzer.binary,
+            max_line_length=analyzer.max_line_length,
+            drop_long_lines=analyzer.drop_long_lines,
+            flush=_flush_callback(analyzer, on_analyzed),
+            flush_timeout=analyzer.multiline.timeout if analyzer.multiline else 0.0,
+            chunk_size=chunk_size,
+            positions=positions,
+            lookback=_lookback(analyzer),
+            backfill=backfills.get(analyzer) if backfills else None,
+            executor=executor,
+            coalesce_interval=coalesce_interval,
+            dispatcher=dispatcher,
+            stats=stats,
+            loop=loop,
+        )
         for analyzer in analyzers
     ]
 
 
+def _analyze_callback(
+    analyzer: FileAnalyzer, on_analyzed: Optional[Callable[[], Any]]
+) -> Callable[[List[Any]], None]:
+    """Return a function analyzing lines, and calling back if requested."""
+    if on_analyzed is None:
+        return analyzer.analyze_lines
+
+    def analyze_lines(lines: List[Any]):
+        analyzer.analyze_lines(lines)
+        on_analyzed()
+
+    return analyze_lines
+
+
+def _flush_callback(
+    analyzer: FileAnalyzer, on_analyzed: Optional[Callable[[], Any]]
+) -> Optional[Callable[[], None]]:
+    """Return a function flushing multiline records, if the analyzer uses them."""
+    if analyzer.multiline is None:
+        return None
+    if on_analyzed is None:
+        return analyzer.flush
+
+    def flush():
+        analyzer.flush()
+        on_analyzed()
+
+    return flush
+
+
+def _lookback(analyzer: FileAnalyzer) -> Optional[Lookback]:
+    """Return the Lookback for files of an analyzer, if configured."""
+    config = analyzer.lookback
+    if config is None:
+        return None
+    parse = TimestampParser(
+        re.compile(config.timestamp), config.format, encoding=analyzer.encoding
+    )
+    return Lookback(parse, config.window)
+
+
+def parse_chunk_size(value: str) -> int:
+    """Parse a chunk size for reading files from a command line argument."""
+    try:
+        size = int(value)
+    except ValueError:
+        size = 0
+    if size < 1:
+        raise argparse.ArgumentTypeError(f"invalid chunk size: {value}")
+    return size
+
+
+def is_compressed(path: Path) -> bool:
+    """Return whether a file is compressed, based on its suffix."""
+    return path.suffix in COMPRESSED_OPENERS
+
+
+def rotation_order(paths: Iterable[Path]) -> List[Path]:
+    """Return existing files sorted in rotation order, from the oldest.
+
+    Files are sorted by modification time, since rotated segments (and their
+    compressed versions) are written before newer ones.
+
+    """
+    mtimes = {}
+    for path in paths:
+        with contextlib.suppress(FileNotFoundError):
+            mtimes[path] = path.stat().st_mtime_ns
+    return sorted(mtimes, key=lambda path: (mtimes[path], str(path)))
+
+
+def coalesce_events(events: List[InotifyEvent]) -> List[InotifyEvent]:
+    """Return events, dropping repeated modifications for the same file.
+
+    Since a file is read up to the end for a modification, only the first
+    modification event for each watch descriptor is kept.
+
+    """
+    modified = set()
+    result = []
+    for event in events:
+        if not event.filename and event.modify_event:
+            if event.wd in modified:
+                continue
+            modified.add(event.wd)
+        result.append(event)
+    return result
+
+
+class LineSplitter:
+    """Split lines from chunks of text or bytes, limiting their length.
+
+    Partial lines are kept until the rest of the line is received.  Empty
+    lines are skipped, and a carriage return before the newline (as in CRLF
+    line endings) is stripped.
+
+    If ``max_length`` is set, longer lines are truncated to that length, or
+    dropped if ``drop_long`` is True.  Partial lines are never kept beyond
+    the maximum length, so memory use is bounded even for content without
+    newlines.  The size of content discarded from a partial line is still
+    accounted in :meth:`pending_size`, using ``size`` to measure it.
+
+    """
+
+    def __init__(
+        self,
+        empty: Any,
+        size: Callable[[Any], int] = len,
+        max_length: int = 0,
+        drop_long: bool = False,
+    ):
+        self._empty = empty
+        self._newline = "\n" if isinstance(empty, str) else b"\n"
+        self._return = "\r" if isinstance(empty, str) else b"\r"
+        self._size = size
+        self._max_length = max_length
+        self._drop_long = drop_long
+        self._partial = empty
+        # whether the partial line exceeded the maximum length
+        self._overflow = False
+        # size of content discarded from the partial line
+        self._discarded = 0
+        self._long_lines = 0
+
+    def split(self, data: Any) -> List[Any]:
+        """Return full lines, including content from previous chunks."""
+        content = self._partial + data
+        lines = content.split(self._newline)
+        self._partial = lines.pop()
+        if self._return in content:
+            lines = [self._strip_return(line) for line in lines]
+        if self._max_length:
+            lines = self._limit_lines(lines)
+        return [line for line in lines if line]
+
+    def flush(self, data: Any) -> List[Any]:
+        """Return the last partial line, at the end of the stream."""
+        line = self._strip_return(self._partial + data)
+        overflow = self._overflow
+        self._reset()
+        if self._max_length and (overflow or len(line) > self._max_length):
+            if not overflow:
+                self._long_lines += 1
+            line = self._empty if self._drop_long else line[: self._max_length]
+        return [line] if line else []
+
+    def pending_size(self) -> int:
+        """Return the size of content of the partial line."""
+        return self._size(self._partial) + self._discarded
+
+    def pop_long_lines(self) -> int:
+        """Return the number of long lines found since the last call."""
+        count, self._long_lines = self._long_lines, 0
+        return count
+
+    def _limit_lines(self, lines: List[Any]) -> List[Any]:
+        """Truncate or drop long lines, and limit the partial line."""
+        limited = []
+        for index, line in enumerate(lines):
+            if index == 0 and self._overflow:
+                # the rest of a long line, already counted
+                self._overflow = False
+                self._discarded = 0
+            elif len(line) > self._max_length:
+                self._long_lines += 1
+            else:
+                limited.append(line)
+                continue
+            if not self._drop_long:
+                limited.append(line[: self._max_length])
+
+        if len(self._partial) > self._max_length:
+            if not self._overflow:
+                self._long_lines += 1
+                self._overflow = True
+            keep = 0 if self._drop_long else self._max_length
+            self._discarded += self._size(self._partial[keep:])
+            self._partial = self._partial[:keep]
+        return limited
+
+    def _strip_return(self, line: Any) -> Any:
+        """Strip a trailing carriage return from a line."""
+        return line[:-1] if line.endswith(self._return) else line
+
+    def _reset(self):
+        self._partial = self._empty
+        self._overflow = False
+        self._discarded = 0
+
+
+class LineStream(Loggable):
+    """Split a stream of bytes in lines of text.
+
+    Data is decoded incrementally, and partial lines are kept until the rest
+    of the line is received.  Empty lines are skipped, and CRLF line endings
+    are handled like newlines.
+
+    If data can't be decoded with the ``errors`` handling scheme, the error
+    is logged and invalid bytes are replaced, so that reading goes on.
+
+    Lines longer than ``max_line_length`` characters (if set) are truncated,
+    or dropped if ``drop_long_lines`` is True.
+
+    """
+
+    def __init__(
+        self,
+        encoding: str = "utf-8",
+        errors: str = "strict",
+        max_line_length: int = 0,
+        drop_long_lines: bool = False,
+    ):
+        self._encoding = encoding
+        self._decoder = codecs.getincrementaldecoder(encoding)(errors=errors)
+        # invalid bytes are replaced if they can't be decoded
+        size_errors = "replace" if errors == "strict" else errors
+        self._splitter = LineSplitter(
+            "",
+            size=lambda text: len(text.encode(encoding, size_errors)),
+            max_length=max_line_length,
+            drop_long=drop_long_lines,
+        )
+
+    def feed(self, data: bytes) -> List[str]:
+        """Process data, returning full lines."""
+        return self._splitter.split(self._decode(data))
+
+    def flush(self) -> List[str]:
+        """Return the last partial line, at the end of the stream."""
+        return self._splitter.flush(self._decode(b"", final=True))
+
+    def pending_size(self) -> int:
+        """Return the size in bytes of data not yet returned as lines."""
+        undecoded, _ = self._decoder.getstate()
+        return self._splitter.pending_size() + len(undecoded)
+
+    def pop_long_lines(self) -> int:
+        """Return the number of long lines found since the last call."""
+        return self._splitter.pop_long_lines()
+
+    def _decode(self, data: bytes, final: bool = False) -> str:
+        """Decode data, replacing invalid bytes if it fails."""
+        try:
+            return self._decoder.decode(data, final=final)
+        except UnicodeDecodeError as error:
+            self.logger.warning(f"invalid data, replacing: {error}")
+        errors = self._decoder.errors
+        self._decoder.errors = "replace"
+        try:
+            return self._decoder.decode(data, final=final)
+        finally:
+            self._decoder.errors = errors
+
+
+class BytesLineStream:
+    """Split a stream of bytes in lines, without decoding them.
+
+    Partial lines are kept until the rest of the line is received.  Empty
+    lines are skipped, and CRLF line endings are handled like newlines.
+
+    Lines longer than ``max_line_length`` bytes (if set) are truncated, or
+    dropped if ``drop_long_lines`` is True.
+
+    """
+
+    def __init__(self, max_line_length: int = 0, drop_long_lines: bool = False):
+        self._splitter = LineSplitter(
+            b"", max_length=max_line_length, drop_long=drop_long_lines
+        )
+
+    def feed(self, data: bytes) -> List[bytes]:
+        """Process data, returning full lines."""
+        return self._splitter.split(data)
+
+    def flush(self) -> List[bytes]:
+        """Return the last partial line, at the end of the stream."""
+        return self._splitter.flush(b"")
+
+    def pending_size(self) -> int:
+        """Return the size in bytes of data not yet returned as lines."""
+        return self._splitter.pending_size()
+
+    def pop_long_lines(self) -> int:
+        """Return the number of long lines found since the last call."""
+        return self._splitter.pop_long_lines()
+
+
 class WatchedFiles:
     """Track info about watched files."""
 
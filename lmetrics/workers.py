@@ -0,0 +1,265 @@
+"""Analyze log files in multiple worker processes."""
+
+import asyncio
+import contextlib
+import multiprocessing
+from multiprocessing.connection import Connection
+import os
+import signal
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+from prometheus_client import (
+    CollectorRegistry,
+    Metric,
+)
+from toolrack.aio import PeriodicCall
+from toolrack.log import Loggable
+
+# Interval in seconds between updates sent from workers
+UPDATE_INTERVAL = 1.0
+
+# Metric types whose values are summed across workers
+_SUMMED_TYPES = frozenset(["counter", "histogram", "summary"])
+
+SampleKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+# Key for metrics from the local registry in a MergedCollector
+_LOCAL = object()
+
+
+def split_files(files: Dict[str, Any], count: int) -> List[Dict[str, Any]]:
+    """Split entries from the files config in up to count groups."""
+    groups: List[Dict[str, Any]] = [{} for _ in range(min(count, len(files)))]
+    for index, (path, config) in enumerate(files.items()):
+        groups[index % count][path] = config
+    return groups
+
+
+class MergedCollector:
+    """A collector merging metrics from multiple workers.
+
+    Samples for counters, histograms and summaries are summed across workers
+    (except for creation timestamps, where the oldest is used).  For other
+    metric types, the value most recently changed by any worker is used.
+
+    Workers are identified by any hashable key.  If a ``local`` registry is
+    passed, its metrics are merged like those from a worker, and they're
+    refreshed each time metrics are updated or collected.
+
+    If ``on_update`` is passed, it's called after each update.
+
+    """
+
+    def __init__(
+        self,
+        on_update: Optional[Callable[[], Any]] = None,
+        local: Optional[CollectorRegistry] = None,
+    ):
+        self._on_update = on_update
+        self._local = local
+        self._families: Dict[Hashable, List[Metric]] = {}
+        self._latest: Dict[SampleKey, float] = {}
+
+    def update(self, worker: Hashable, families: List[Metric]):
+        """Update metrics for a worker."""
+        self._refresh_local()
+        self._set_families(worker, families)
+        if self._on_update is not None:
+            self._on_update()
+
+    def collect(self) -> Iterator[Metric]:
+        """Return merged metrics."""
+        self._refresh_local()
+        merged: Dict[str, Metric] = {}
+        values: Dict[str, Dict[SampleKey, float]] = {}
+        for families in self._families.values():
+            for family in families:
+                if family.name not in merged:
+                    merged[family.name] = Metric(
+                        family.name, family.documentation, family.type
+                    )
+                    values[family.name] = {}
+                family_values = values[family.name]
+                for sample in family.samples:
+                    key = _sample_key(sample)
+                    family_values[key] = self._merge_value(
+                        family.type, key, family_values.get(key), sample.value
+                    )
+
+        for name, metric in merged.items():
+            for (sample_name, labels), value in values[name].items():
+                metric.add_sample(sample_name, dict(labels), value)
+            yield metric
+
+    def _set_families(self, worker: Hashable, families: List[Metric]):
+        """Set metrics for a worker, tracking changed values."""
+        previous = {
+            _sample_key(sample): sample.value
+            for family in self._families.get(worker, ())
+            for sample in family.samples
+        }
+        for family in families:
+            if family.type in _SUMMED_TYPES:
+                continue
+            for sample in family.samples:
+                key = _sample_key(sample)
+                if previous.get(key) != sample.value:
+                    self._latest[key] = sample.value
+        self._families[worker] = families
+
+    def _refresh_local(self):
+        """Update metrics from the local registry, if set."""
+        if self._local is not None:
+            self._set_families(_LOCAL, list(self._local.collect()))
+
+    def _merge_value(
+        self, metric_type: str, key: SampleKey, current: Optional[float], value: float
+    ) -> float:
+        if metric_type not in _SUMMED_TYPES:
+            return self._latest.get(key, value)
+        if current is None:
+            return value
+        if key[0].endswith("_created"):
+            return min(current, value)
+        return current + value
+
+
+class WorkerProcess(Loggable):
+    """A process analyzing a subset of log files.
+
+    The ``target`` is called in the child process with a :class:`Connection`
+    to send metrics updates through.  These are passed to the
+    :class:`MergedCollector`.
+
+    """
+
+    _process: Optional[multiprocessing.process.BaseProcess] = None
+    _conn: Optional[Connection] = None
+    _stopping = False
+
+    def __init__(
+        self,
+        index: int,
+        target: Callable[[Connection], None],
+        collector: MergedCollector,
+        loop: asyncio.AbstractEventLoop,
+    ):
+        self.index = index
+        self.name = f"worker-{index}"  # for the logger
+        self.loop = loop
+        self._target = target
+        self._collector = collector
+
+    def start(self):
+        """Start the worker process."""
+        conn, child_conn = multiprocessing.Pipe()
+        context = multiprocessing.get_context("fork")
+        self._process = context.Process(
+            target=self._target,
+            args=(child_conn,),
+            name=f"lmetrics-{self.name}",
+            daemon=True,
+        )
+        self._process.start()
+        child_conn.close()
+        self._conn = conn
+        self.loop.add_reader(conn.fileno(), self._receive)
+        self.logger.debug(f"started with PID {self._process.pid}")
+
+    async def stop(self):
+        """Stop the worker process, waiting for final updates."""
+        if not self._process:
+            return
+
+        self._stopping = True
+        try:
+            self._conn.send(None)
+        except OSError:
+            pass  # the process has already exited
+        # updates are still received while waiting for the process to exit
+        await self.loop.run_in_executor(None, self._process.join)
+        self.loop.remove_reader(self._conn.fileno())
+        with contextlib.suppress(EOFError):
+            while self._conn.poll():
+                self._collector.update(self.index, self._conn.recv())
+        self._conn.close()
+        self._process = None
+        self._stopping = False
+        self.logger.debug("stopped")
+
+    def send_signal(self, signum: int):
+        """Send a signal to the worker process, if running."""
+        pid = self._process.pid if self._process else None
+        if pid is not None:
+            os.kill(pid, signum)
+
+    def _receive(self):
+        """Receive an update from the worker."""
+        try:
+            families = self._conn.recv()
+        except EOFError:
+            self.loop.remove_reader(self._conn.fileno())
+            if not self._stopping:
+                self.logger.error("worker exited unexpectedly")
+            return
+        self._collector.update(self.index, families)
+
+
+def run_worker(
+    conn: Connection,
+    loop: asyncio.AbstractEventLoop,
+    registry: CollectorRegistry,
+    start: Callable[[], Awaitable],
+    stop: Callable[[], Awaitable],
+    update_interval: float = UPDATE_INTERVAL,
+):
+    """Run a worker process until told to stop.
+
+    Metrics from the registry are periodically sent through the connection.
+    The worker stops when a message is received or the connection is closed.
+
+    """
+    # the parent process handles interruption
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # reloading rules is only handled once the worker has started
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    asyncio.set_event_loop(loop)
+
+    def send_update():
+        conn.send(list(registry.collect()))
+
+    stopped = loop.create_future()
+
+    def receive():
+        loop.remove_reader(conn.fileno())
+        # consume the message, since closing the connection with unread data
+        # resets it, and the final update could be lost
+        with contextlib.suppress(EOFError):
+            conn.recv()
+        stopped.set_result(None)
+
+    loop.add_reader(conn.fileno(), receive)
+    updates = PeriodicCall(loop, send_update)
+    loop.run_until_complete(start())
+    updates.start(update_interval)
+    loop.run_until_complete(stopped)
+    loop.run_until_complete(updates.stop())
+    loop.run_until_complete(stop())
+    send_update()
+    conn.close()
+    loop.close()
+
+
+def _sample_key(sample) -> SampleKey:
+    """Return a key identifying a sample."""
+    return sample.name, tuple(sorted(sample.labels.items()))